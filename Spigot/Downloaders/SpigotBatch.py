@@ -0,0 +1,191 @@
+"""
+Spigot: batch download of many SPICE experiments over shared connections.
+"""
+
+import concurrent.futures as cf
+import os
+import time
+from requests_futures.sessions import FuturesSession
+from Downloaders.SpigotHTTP import SpigotHTTP
+from Downloaders.SpigotListingCache import SpigotListingCache
+from Downloaders.SpigotMetrics import SpigotMetrics
+from Downloaders.SpigotRateLimiter import SpigotRateLimiter
+from Downloaders.SpigotSFTP import SpigotSFTP
+from Downloaders.SpigotTerminalProgress import SpigotTerminalProgress
+
+
+class SpigotBatch(object):
+    """
+    SpigotBatch downloads a list of (instrument, IPTS, experiment) jobs with one HTTP connection pool or one
+    authenticated SSH transport for all of them.
+
+    max_workers is the global concurrency budget: HTTP requests in flight, or SFTP channels open, across all jobs.
+    Up to max_parallel_jobs jobs run at once and each gets an equal share of that budget, so a large experiment
+    cannot starve the others. An SFTP job needs at least two channels, one listing and one downloading, so SFTP
+    needs max_workers of at least 2 and runs at most max_workers // 2 jobs at once. Each job's share is a ceiling;
+    within it, the job adapts its concurrency to the link.
+    max_bandwidth (bytes/second) caps the combined transfer rate, and file_filter, a SpigotFilter, selects what is
+    downloaded of every experiment. All jobs report to one progress listener and one
+    SpigotMetrics, so the status line and the metrics cover the whole batch. Listings of settled directories, whose
+    entries are all old, are reused; listing_ttl > 0 also reuses every other listing for that many seconds.
+    """
+
+    def __init__(self, local_path_base, protocol="http", user=None, host="analysis.sns.gov",
+                 url_root="http://neutron.ornl.gov/", remote_path_base="/HFIR", sftp_port=22, max_workers=None,
+                 max_parallel_jobs=2, max_bandwidth=None, progress=None, metrics=None, file_filter=None,
+                 listing_ttl=0):
+        if protocol not in ("http", "sftp"):
+            raise ValueError(f"Unknown protocol {protocol}.")
+        self.local_path_base = local_path_base
+        self.protocol = protocol
+        self.user = user
+        self.host = host
+        self.url_root = url_root
+        self.remote_path_base = remote_path_base
+        self.sftp_port = sftp_port
+        # OpenSSH allows 10 sessions per connection by default, so SFTP gets a smaller budget than HTTP.
+        self.max_workers = max(1, int(max_workers or (64 if protocol == "http" else 8)))
+        if protocol == "sftp" and self.max_workers < 2:
+            raise ValueError("SFTP needs max_workers of at least 2, one channel to list and one to download.")
+        self.max_parallel_jobs = max(1, int(max_parallel_jobs))
+        self.rate_limiter = SpigotRateLimiter(max_bandwidth) if max_bandwidth else None
+        self.progress = progress or SpigotTerminalProgress()
+        self.metrics = metrics or SpigotMetrics()
+        self.file_filter = file_filter
+        self.listing_ttl = listing_ttl
+        self.jobs = []
+        self.results = []
+
+    def add_job(self, instrument, ipts_number, experiment_number):
+        self.jobs.append((instrument, ipts_number, experiment_number))
+
+    def _make_downloader(self, job, share, session, listing_cache):
+        instrument, ipts_number, experiment_number = job
+        if self.protocol == "http":
+            return SpigotHTTP(instrument, experiment_number, self.local_path_base, url_root=self.url_root,
+                              max_in_flight=share, listing_cache=listing_cache, session=session,
+                              rate_limiter=self.rate_limiter, progress=self.progress, metrics=self.metrics,
+                              file_filter=self.file_filter)
+        # Half of the job's channels list directories and the rest download, so together they stay within share.
+        list_channels = max(1, share // 2)
+        download_channels = max(1, share - list_channels)
+        return SpigotSFTP(instrument, ipts_number, experiment_number, self.local_path_base, self.user, self.host,
+                          self.remote_path_base, self.sftp_port, max_workers=download_channels,
+                          max_list_workers=list_channels,
+                          listing_cache=listing_cache, rate_limiter=self.rate_limiter, progress=self.progress,
+                          metrics=self.metrics, file_filter=self.file_filter)
+
+    def _run_job(self, job, share, session, transport, listing_cache, incremental, verify, sink=None):
+        downloader = self._make_downloader(job, share, session, listing_cache)
+        if self.protocol == "http":
+            return downloader.verify() if verify else downloader.download(incremental=incremental, sink=sink)
+        if verify:
+            return downloader.verify(transport=transport)
+        return downloader.download(transport=transport, incremental=incremental, sink=sink)
+
+    def _get_parallel_jobs(self):
+        parallel_jobs = min(self.max_parallel_jobs, max(1, len(self.jobs)))
+        if self.protocol == "sftp":
+            # Every SFTP job gets at least two channels.
+            parallel_jobs = min(parallel_jobs, self.max_workers // 2)
+        return parallel_jobs
+
+    def _connect(self, password, share):
+        """
+        Open the connection pool or SSH transport all jobs share.
+        :param password:
+        :param share:
+        :return: Session (HTTP) and transport (SFTP); the other one is None.
+        """
+        if self.protocol == "http":
+            return FuturesSession(max_workers=self.max_workers), None
+        if self.jobs:
+            return None, self._make_downloader(self.jobs[0], share, None, None).connect(password)
+        return None, None
+
+    def _run_jobs(self, share, session, transport, listing_cache, incremental, verify, sink=None):
+        """
+        Run all jobs over the shared connections. A failed job is reported and does not stop the others.
+        :return: List of (job, result) in job order.
+        """
+        results = []
+        with cf.ThreadPoolExecutor(max_workers=self._get_parallel_jobs()) as executor:
+            futures = [executor.submit(self._run_job, job, share, session, transport, listing_cache, incremental,
+                                       verify, sink)
+                       for job in self.jobs]
+            for job, future in zip(self.jobs, futures):
+                try:
+                    results.append((job, future.result()))
+                except Exception as e:
+                    print(f"\n\nJob {job} failed: {e}")
+                    results.append((job, e))
+        return results
+
+    def run(self, password=None, incremental=True, verify=False, sink=None):
+        """
+        Run all jobs. A failed job is reported and does not stop the others.
+        :param password: Password for the SFTP user. Prompted for once if not given.
+        :param incremental: Only fetch new or changed files, and only the appended tail of files that grew.
+        :param verify: Check the existing local copies instead, downloading bad files again.
+        :param sink: SpigotSink all jobs stream their files into instead of local_path_base, e.g. one archive for
+                     the whole batch. Needs incremental=False. Nothing is written under local_path_base, not even the
+                     listing cache. The sink is left open.
+        :return: List of (job, statistics, list of bad files when verifying, or exception) in job order.
+        """
+        if sink and (incremental or verify):
+            raise ValueError("Downloads into a sink can neither be incremental nor verified.")
+        start_time = time.time()
+        share = max(1, self.max_workers // self._get_parallel_jobs())
+        listing_cache = None
+        if not sink:
+            listing_cache = SpigotListingCache(os.path.join(self.local_path_base, ".spigot", "listings.sqlite"),
+                                               ttl=self.listing_ttl)
+        session, transport = self._connect(password, share)
+        self.results = []
+        try:
+            self.results = self._run_jobs(share, session, transport, listing_cache, incremental, verify, sink)
+        finally:
+            if session:
+                session.close()
+            if transport:
+                transport.close()
+            if listing_cache:
+                listing_cache.close()
+        self._report_batch(start_time)
+        return self.results
+
+    def follow(self, password=None, interval=30.0, polls=None):
+        """
+        Keep up with running experiments: run all jobs incrementally every interval seconds over the same
+        connections, so new files are fetched and files that grew only send what was appended. Listings are not
+        cached, since they go stale between polls.
+        :param password: Password for the SFTP user. Prompted for once if not given.
+        :param interval: Seconds from the start of one poll to the start of the next.
+        :param polls: Number of polls, or None to follow until interrupted.
+        :return: List of the results of each poll, as run returns them.
+        """
+        share = max(1, self.max_workers // self._get_parallel_jobs())
+        session, transport = self._connect(password, share)
+        polls_results = []
+        try:
+            while polls is None or len(polls_results) < polls:
+                start_time = time.time()
+                self.results = self._run_jobs(share, session, transport, None, True, False)
+                polls_results.append(self.results)
+                self._report_batch(start_time)
+                if polls is None or len(polls_results) < polls:
+                    time.sleep(max(0.0, interval - (time.time() - start_time)))
+        finally:
+            if session:
+                session.close()
+            if transport:
+                transport.close()
+        return polls_results
+
+    def _report_batch(self, start_time):
+        failed_jobs = sum(1 for _, result in self.results if isinstance(result, Exception))
+        total_bytes = sum(result['bytes'] for _, result in self.results if isinstance(result, dict))
+        elapsed_time = time.time() - start_time
+        mega_bytes = float(total_bytes)/(1024 * 1024)
+        print(f"\n\nBatch complete: {len(self.jobs) - failed_jobs}/{len(self.jobs)} jobs succeeded ("
+              f"{mega_bytes:.3f} MB, {elapsed_time:.2f} seconds, {mega_bytes/elapsed_time:.3f} MB/sec).")
@@ -0,0 +1,34 @@
+"""
+Spigot: downloads handed to a callback.
+"""
+
+from Downloaders.SpigotSink import SpigotSink
+
+
+class SpigotCallbackSink(SpigotSink):
+    """
+    SpigotCallbackSink hands downloaded files to callback(name, size, data), e.g. to upload them to an object store.
+    data is the next chunk of the file, or None once it is complete. Files arrive one at a time, each in order, and
+    the callback is called from the downloaders' threads, but never concurrently. A file larger than max_buffer
+    that is cut off part way ends with callback(name, None, None) instead, and comes again when it is retried.
+    data may be a memoryview of a buffer that is reused once the callback returns, so copy what is kept.
+    """
+
+    def __init__(self, callback, max_buffer=64 * 1024 * 1024):
+        super().__init__(max_buffer)
+        self.callback = callback
+        self.entry = None
+
+    def _start_entry(self, name, size, mtime):
+        self.entry = (name, size)
+
+    def _write_entry(self, data):
+        self.callback(self.entry[0], self.entry[1], data)
+
+    def _finish_entry(self):
+        self.callback(self.entry[0], self.entry[1], None)
+        self.entry = None
+
+    def _abort_entry(self, size, written):
+        self.callback(self.entry[0], None, None)
+        self.entry = None
@@ -0,0 +1,110 @@
+"""
+Spigot: adaptive limit on concurrent transfers.
+"""
+
+import threading
+import time
+
+
+class SpigotConcurrency(object):
+    """
+    SpigotConcurrency adapts the number of transfers in flight to the link, AIMD style.
+
+    Throughput is measured over windows of window seconds. While it keeps rising, the limit grows: it doubles per
+    window at first ("slow start"), then grows by one. An error, or a request latency more than latency_factor
+    times the running average and at least min_spike seconds, cuts the limit by decrease_factor, at most once per
+    window so that one burst of failures only counts once. The limit stays between minimum and maximum.
+
+    Downloaders either read limit before starting a transfer, or bracket transfers with acquire and release, which
+    block while the limit is reached.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, window=1.0, latency_factor=4.0, min_spike=0.5,
+                 decrease_factor=0.5):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.current_limit = float(min(max(initial, self.minimum), self.maximum))
+        self.window = float(window)
+        self.latency_factor = float(latency_factor)
+        self.min_spike = float(min_spike)
+        self.decrease_factor = float(decrease_factor)
+        self.slow_start = True
+        self.average_latency = None
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_throughput = 0.0
+        self.last_decrease = 0.0
+        self.active = 0
+        self.condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self.current_limit)
+
+    def acquire(self):
+        """
+        Wait until another transfer may start, and count it as started.
+        :return:
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def record_bytes(self, byte_count):
+        """
+        Account for transferred bytes, and adjust the limit when a measurement window is over.
+        :param byte_count:
+        :return:
+        """
+        with self.condition:
+            self.window_bytes += byte_count
+            now = time.monotonic()
+            elapsed = now - self.window_start
+            if elapsed < self.window:
+                return
+            throughput = self.window_bytes / elapsed
+            if throughput > self.last_throughput:
+                if self.slow_start:
+                    self.current_limit = min(self.maximum, self.current_limit * 2)
+                else:
+                    self.current_limit = min(self.maximum, self.current_limit + 1)
+                self.condition.notify_all()
+            else:
+                self.slow_start = False
+            self.last_throughput = throughput
+            self.window_start = now
+            self.window_bytes = 0
+
+    def record_latency(self, latency):
+        """
+        Account for the time a request took to be answered. A spike well above the average counts as congestion.
+        :param latency: Seconds.
+        :return:
+        """
+        with self.condition:
+            if self.average_latency is None:
+                self.average_latency = latency
+                return
+            spike = latency > max(self.latency_factor * self.average_latency, self.min_spike)
+            self.average_latency += 0.1 * (latency - self.average_latency)
+        if spike:
+            self.record_error()
+
+    def record_error(self):
+        with self.condition:
+            now = time.monotonic()
+            self.slow_start = False
+            if now - self.last_decrease < self.window:
+                return
+            self.last_decrease = now
+            self.current_limit = max(self.minimum, self.current_limit * self.decrease_factor)
+            # Measure the next window from scratch, so the cut is not undone by the old throughput.
+            self.last_throughput = 0.0
+            self.window_start = now
+            self.window_bytes = 0
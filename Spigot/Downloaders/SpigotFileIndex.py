@@ -0,0 +1,235 @@
+"""
+Spigot: compact index of the files found in an experiment.
+"""
+
+import collections.abc
+import json
+import os
+import sys
+from array import array
+
+
+class SpigotFileIndex(collections.abc.Mapping):
+    """
+    SpigotFileIndex maps the remote paths (or urls) of the files found in an experiment to their local paths, like a
+    read-only dictionary that add_file and add_directory fill in. Instead of two full path strings per file, it keeps
+    a tree of nested dictionaries below the experiment directory: the common prefix is stored once, each name once
+    per directory, directory names like Datafiles are interned so that all experiments share them, and a file is
+    just its position in arrays of listed sizes and modification times.
+    Remote and local paths are built when asked for, and files() and directories() walk the tree lazily, so an
+    archive-wide crawl holds little more than the names themselves.
+
+    Local paths mirror the remote layout under local_base. Remote directory paths end with directory_suffix, "/" for
+    urls. The index is not thread safe; the downloaders add to it under their own locks.
+    """
+
+    def __init__(self, remote_base, local_base, directory_suffix=""):
+        self.remote_base = remote_base.rstrip("/")
+        self.local_base = local_base
+        self.directory_suffix = directory_suffix
+        # Directories are dictionaries of name -> entry; files are indexes into sizes and mtimes.
+        self.root = {}
+        # -1 where the listing gave no size or modification time (HTTP autoindex pages do not).
+        self.sizes = array('q')
+        self.mtimes = array('d')
+        self.directory_count = 0
+
+    def _split(self, remote_path):
+        """
+        Split a remote path into its names below remote_base.
+        :param remote_path:
+        :return:
+        """
+        if remote_path.rstrip("/") != self.remote_base and not remote_path.startswith(self.remote_base + "/"):
+            raise KeyError(remote_path)
+        relative_path = remote_path[len(self.remote_base):].strip("/")
+        return relative_path.split("/") if relative_path else []
+
+    def _local_path(self, relative_path):
+        return os.path.join(self.local_base, relative_path.replace("/", os.path.sep))
+
+    def _get_directory(self, names):
+        """
+        Find the directory with the given names, adding it and any missing parents.
+        :param names:
+        :return:
+        """
+        directory = self.root
+        for name in names:
+            entry = directory.get(name)
+            if entry is None:
+                entry = directory[sys.intern(name)] = {}
+                self.directory_count += 1
+            elif type(entry) is not dict:
+                raise ValueError(f"{name} is a file, not a directory.")
+            directory = entry
+        return directory
+
+    def add_directory(self, remote_path):
+        """
+        Add a directory.
+        :param remote_path:
+        :return: Local path of the directory.
+        """
+        names = self._split(remote_path)
+        self._get_directory(names)
+        return self._local_path("/".join(names))
+
+    def add_file(self, remote_path, size=-1, mtime=-1, name=None):
+        """
+        Add a file, or update the size and modification time of one already there.
+        :param remote_path:
+        :param size: Size from the listing, if known.
+        :param mtime: Modification time from the listing, if known.
+        :param name: The file's name as a string the caller keeps anyway, to store instead of a copy.
+        :return: Local path of the file.
+        """
+        names = self._split(remote_path)
+        if not names:
+            raise KeyError(remote_path)
+        if name is not None and name == names[-1]:
+            names[-1] = name
+        directory = self._get_directory(names[:-1])
+        index = directory.get(names[-1])
+        if index is None:
+            directory[names[-1]] = len(self.sizes)
+            self.sizes.append(size)
+            self.mtimes.append(mtime)
+        elif type(index) is dict:
+            raise ValueError(f"{names[-1]} is a directory, not a file.")
+        else:
+            self.sizes[index] = size
+            self.mtimes[index] = mtime
+        return self._local_path("/".join(names))
+
+    def _find(self, remote_path):
+        """
+        Find the entry of a remote path.
+        :param remote_path:
+        :return: Names below remote_base and the entry.
+        """
+        names = self._split(remote_path)
+        entry = self.root
+        for name in names:
+            if type(entry) is not dict or name not in entry:
+                raise KeyError(remote_path)
+            entry = entry[name]
+        return names, entry
+
+    def __getitem__(self, remote_path):
+        names, entry = self._find(remote_path)
+        if type(entry) is dict:
+            raise KeyError(remote_path)
+        return self._local_path("/".join(names))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __iter__(self):
+        for remote_path, _ in self.files():
+            yield remote_path
+
+    def get_listing(self, remote_path):
+        """
+        Size and modification time of a file as listed.
+        :param remote_path:
+        :return: (size, mtime), each None if the listing did not give it.
+        """
+        _, index = self._find(remote_path)
+        if type(index) is dict:
+            raise KeyError(remote_path)
+        size, mtime = self.sizes[index], self.mtimes[index]
+        return (size if size >= 0 else None), (mtime if mtime >= 0 else None)
+
+    def _walk(self):
+        """
+        Walk the tree depth-first, parents before their entries. Each directory's entries are copied when it is
+        reached, so memory grows with the depth and width of the tree, not with its size.
+        :return: Generator of (path relative to remote_base, entry).
+        """
+        stack = [("", iter(list(self.root.items())))]
+        while stack:
+            prefix, entries = stack[-1]
+            for name, entry in entries:
+                relative_path = prefix + name
+                yield relative_path, entry
+                if type(entry) is dict:
+                    stack.append((relative_path + "/", iter(list(entry.items()))))
+                    break
+            else:
+                stack.pop()
+
+    def files(self):
+        """
+        :return: Generator of (remote path, local path) of all files.
+        """
+        for relative_path, entry in self._walk():
+            if type(entry) is not dict:
+                yield f"{self.remote_base}/{relative_path}", self._local_path(relative_path)
+
+    def directories(self):
+        """
+        :return: Generator of (remote path, local path) of all directories.
+        """
+        for relative_path, entry in self._walk():
+            if type(entry) is dict:
+                yield f"{self.remote_base}/{relative_path}{self.directory_suffix}", self._local_path(relative_path)
+
+    def save(self, index_path):
+        """
+        Write the index to a temporary file and move it into place. The tree is stored flat, as names and entry
+        counts in depth-first order, so saving and loading are single passes.
+        :param index_path:
+        :return:
+        """
+        names = [""]
+        counts = [len(self.root)]
+        sizes = array('q')
+        mtimes = array('d')
+        for relative_path, entry in self._walk():
+            names.append(relative_path.rpartition("/")[2])
+            if type(entry) is dict:
+                counts.append(len(entry))
+            else:
+                counts.append(-1)
+                sizes.append(self.sizes[entry])
+                mtimes.append(self.mtimes[entry])
+        directory = os.path.dirname(index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = index_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'remote_base': self.remote_base, 'local_base': self.local_base,
+                       'directory_suffix': self.directory_suffix, 'names': names, 'counts': counts,
+                       'sizes': sizes.tolist(), 'mtimes': mtimes.tolist()}, f, separators=(",", ":"))
+        os.replace(temp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        """
+        Read an index written by save.
+        :param index_path:
+        :return:
+        """
+        with open(index_path, 'r') as f:
+            data = json.load(f)
+        index = cls(data['remote_base'], data['local_base'], data['directory_suffix'])
+        # Files were saved in depth-first order, so they are numbered in the order they come back.
+        index.sizes = array('q', data['sizes'])
+        index.mtimes = array('d', data['mtimes'])
+        file_index = 0
+        # Each directory with the number of its entries still to come.
+        stack = [[index.root, data['counts'][0]]]
+        for name, count in zip(data['names'][1:], data['counts'][1:]):
+            while stack[-1][1] == 0:
+                stack.pop()
+            parent = stack[-1]
+            parent[1] -= 1
+            if count < 0:
+                parent[0][name] = file_index
+                file_index += 1
+            else:
+                directory = parent[0][sys.intern(name)] = {}
+                index.directory_count += 1
+                stack.append([directory, count])
+        return index
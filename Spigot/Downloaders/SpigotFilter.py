@@ -0,0 +1,149 @@
+"""
+Spigot: include/exclude rules for selective downloads.
+"""
+
+import fnmatch
+import re
+
+SCAN_NUMBER = re.compile(r"scan(\d+)", re.IGNORECASE)
+
+
+class SpigotFilter(object):
+    """
+    SpigotFilter decides which parts of an experiment are downloaded. Paths are relative to the experiment
+    directory and "/" separated, e.g. "Datafiles/HB3A_exp0714_scan0012.dat".
+
+    include and exclude are lists of rules. A rule is a glob, a regular expression (a compiled pattern, or a string
+    starting with "re:") searched for in the path, or a glob ending in "/" that only applies to directories. In
+    globs, "*" stays within one path segment and "**" spans any number of them; a glob without "/" matches names at
+    any depth, like "*.dat" or "Images". A rule that matches a directory covers everything below it.
+
+    A file is downloaded if it matches an include rule (or there are none), matches no exclude rule, and, if scans
+    is given, has a scan number in one of its ranges; files without a scan number, such as logs, are not held to
+    the ranges. scans is a list of (first, last) pairs, last None for an open end, or text like "1-10,15,20-".
+
+    The downloaders ask while walking the tree, so an excluded directory is never listed and an excluded file is
+    never requested.
+    """
+
+    def __init__(self, include=None, exclude=None, scans=None):
+        self.include = [self._compile(rule) for rule in include or []]
+        self.exclude = [self._compile(rule) for rule in exclude or []]
+        self.scans = self.parse_scans(scans) if isinstance(scans, str) else scans
+
+    @staticmethod
+    def parse_scans(text):
+        """
+        Parse scan ranges like "1-10,15,20-".
+        :param text:
+        :return: List of (first, last) pairs, last None for an open end.
+        """
+        ranges = []
+        for part in text.replace(" ", "").split(","):
+            if not part:
+                continue
+            first, separator, last = part.partition("-")
+            try:
+                if not separator:
+                    ranges.append((int(first), int(first)))
+                else:
+                    ranges.append((int(first or 0), int(last) if last else None))
+            except ValueError:
+                raise ValueError(f"Scan range {part!r} is not N, N-M, N- or -M.")
+        return ranges
+
+    @staticmethod
+    def _compile(rule):
+        """
+        Turn a rule into ('regex', pattern, directories only) or ('glob', segments, directories only).
+        :param rule:
+        :return:
+        """
+        if not isinstance(rule, str):
+            return 'regex', rule, False
+        if rule.startswith("re:"):
+            return 'regex', re.compile(rule[3:]), False
+        directories_only = rule.endswith("/")
+        rule = rule.strip("/")
+        segments = rule.split("/") if "/" in rule else ["**", rule]
+        return 'glob', segments, directories_only
+
+    @classmethod
+    def _match_segments(cls, pattern, segments):
+        if not pattern:
+            return not segments
+        if pattern[0] == "**":
+            return cls._match_segments(pattern[1:], segments) or \
+                (bool(segments) and cls._match_segments(pattern, segments[1:]))
+        return bool(segments) and fnmatch.fnmatchcase(segments[0], pattern[0]) and \
+            cls._match_segments(pattern[1:], segments[1:])
+
+    @classmethod
+    def _may_match_below(cls, pattern, segments):
+        """
+        Whether a glob may match the directory with the given segments or something below it.
+        :param pattern:
+        :param segments:
+        :return:
+        """
+        if not segments:
+            return True
+        if not pattern:
+            return False
+        if pattern[0] == "**":
+            return cls._may_match_below(pattern[1:], segments) or cls._may_match_below(pattern, segments[1:])
+        return fnmatch.fnmatchcase(segments[0], pattern[0]) and cls._may_match_below(pattern[1:], segments[1:])
+
+    @classmethod
+    def _matches(cls, rule, segments, is_directory):
+        """
+        Whether a rule matches a path or one of the directories above it.
+        :param rule:
+        :param segments: Segments of the path.
+        :param is_directory: Whether the path itself is a directory.
+        :return:
+        """
+        kind, pattern, directories_only = rule
+        for length in range(len(segments), 0, -1):
+            if length == len(segments) and directories_only and not is_directory:
+                continue
+            path = "/".join(segments[:length])
+            if kind == 'regex':
+                if pattern.search(path + ("/" if length < len(segments) or is_directory else "")):
+                    return True
+            elif cls._match_segments(pattern, segments[:length]):
+                return True
+        return False
+
+    def wants_directory(self, relative_path):
+        """
+        Whether a directory may hold wanted files, and so needs listing.
+        :param relative_path:
+        :return:
+        """
+        segments = relative_path.strip("/").split("/")
+        if any(self._matches(rule, segments, True) for rule in self.exclude):
+            return False
+        if not self.include:
+            return True
+        # Regular expressions can match anything below, so only globs can rule a directory out.
+        return any(kind == 'regex' or self._may_match_below(pattern, segments)
+                   for kind, pattern, _ in self.include)
+
+    def wants_file(self, relative_path):
+        """
+        Whether a file is to be downloaded.
+        :param relative_path:
+        :return:
+        """
+        segments = relative_path.strip("/").split("/")
+        if self.include and not any(self._matches(rule, segments, False) for rule in self.include):
+            return False
+        if any(self._matches(rule, segments, False) for rule in self.exclude):
+            return False
+        if self.scans:
+            match = SCAN_NUMBER.search(segments[-1])
+            if match:
+                scan = int(match.group(1))
+                return any(first <= scan and (last is None or scan <= last) for first, last in self.scans)
+        return True
@@ -1,163 +1,868 @@
-"""
-Spigot: SPICE data download tool (HTTP).
-"""
-
-import os
-import sys
-import time
-import urllib.parse
-from bs4 import BeautifulSoup, SoupStrainer
-import concurrent.futures as cf
-from requests_futures.sessions import FuturesSession
-
-
-class SpigotHTTP(object):
-    """
-    SpigotHTTP downloads SPICE experiment data via HTTP interface.
-    """
-
-    def __init__(self, instrument, experiment_number, file_store_base, url_root="http://neutron.ornl.gov/"):
-        self.instrument = instrument
-        self.experiment_number = experiment_number
-        self.file_store_base = file_store_base
-        self.download_session = FuturesSession(max_workers=20)
-        self.url_root = url_root
-        self.all_directory_urls = {}
-        self.all_file_urls = {}
-        self.overwrite_len = 200
-
-    def _get_file_and_directory_urls_in_html_directories(self, html_directories):
-        """
-        Retrieve file and directory urls for the given html directories.
-        :param html_directories:
-        :return:
-        """
-        # Get directories asynchronously.
-        async_downloads = {}
-
-        for url, file_path in html_directories.items():
-                file_request = self.download_session.get(url, stream=True)
-                async_downloads[file_request] = {'url': url, 'file_path': file_path}
-
-        directory_urls = {}
-        file_urls = {}
-
-        for file_request in cf.as_completed(async_downloads, timeout=500000):
-            page = file_request.result().content
-            url_base = async_downloads[file_request]['url']
-            file_path_base = async_downloads[file_request]['file_path']
-            for link in BeautifulSoup(page, "html.parser", parse_only=SoupStrainer('a')):
-                if link.has_attr('href'):
-                    filename = link['href']
-                    if filename.startswith("?") or filename.startswith("/"):
-                        continue
-                    url = url_base.rstrip("/") + "/" + filename
-                    file_path = os.path.join(file_path_base, filename.replace("/", ""))
-                    if url.endswith("/"):
-                        self.all_directory_urls[url] = file_path
-                        directory_urls[url] = file_path
-                    else:
-                        self.all_file_urls[url] = file_path
-                        self._print_overwrite(f"Found {len(self.all_file_urls)} files so far ...")
-                        file_urls[url] = file_path
-        return directory_urls, file_urls
-
-    def _get_some_directories_and_files_async(self, html_directories):
-        """
-        Recursive function to get directories and files for given base url and base path.
-        :type html_directories: object
-        """
-        # noinspection PyTypeChecker
-        new_directory_urls, new_file_urls = self._get_file_and_directory_urls_in_html_directories(html_directories)
-        # print(f"Found {len(self.all_file_urls)} files so far ...")
-        if len(new_directory_urls) > 0:
-            self._get_some_directories_and_files_async(new_directory_urls)
-
-    def _get_directories_and_files_async(self, base_url, local_base_path):
-        """
-        Recursive function to get directories and files for given base url and base path.
-        :param base_url:
-        :param local_base_path:
-        :return:
-        """
-        self.all_directory_urls = {}
-        self.all_file_urls = {}
-        html_directories = {base_url: local_base_path}
-        self._get_some_directories_and_files_async(html_directories)
-        print(f"\n\nFound a total of {len(self.all_file_urls)} files.")
-
-    def _print_overwrite(self, message):
-        print('\r', end='')
-        sys.stdout.flush()
-        print(' ' * self.overwrite_len, end='')
-        sys.stdout.flush()
-        print(f'\r{message}', end='')
-        self.overwrite_len = len(message)
-
-    def download(self):
-
-        start_time = time.time()
-
-        instrument_path_part = str(self.instrument).replace("-", "").lower()
-        experiment_path_part = f"exp{int(self.experiment_number)}"
-        url_base = urllib.parse.urljoin(self.url_root, f"user_data/{instrument_path_part}/{experiment_path_part}")
-        file_path_base = os.path.join(os.path.join(self.file_store_base, instrument_path_part), experiment_path_part)
-
-        print("\nIdentifying files...")
-        self._get_directories_and_files_async(url_base, file_path_base)
-        for url, directory_path in self.all_directory_urls.items():
-            # Create directories if they don't exist.
-            if not os.path.exists(directory_path):
-                os.makedirs(directory_path)
-
-        print("\nDownloading files...\n")
-        start_download_time = time.time()
-
-        # Download files asynchronously.
-        async_downloads = {}
-
-        for url, file_path in self.all_file_urls.items():
-                file_request = self.download_session.get(url, stream=True)
-                async_downloads[file_request] = file_path
-
-        total_bytes = 0
-        file_index = 0
-        file_count = len(async_downloads)
-        progress_status = f"{file_index}/{file_count} = {0:.2f}%, {float(file_count)/100:.2f} seconds remaining (estimated)"
-        file_status = ""
-        self._print_overwrite(f"{progress_status} ----> {file_status}")
-        for file_request in cf.as_completed(async_downloads, timeout=500000):
-            response = file_request.result()
-
-            # Update pre-write status.
-            file_path = async_downloads[file_request]
-            file_status = f"Writing {file_path}..."
-            self._print_overwrite(f"{progress_status} ----> {file_status}")
-
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    # filter out keep-alive new chunks
-                    if chunk:
-                        f.write(chunk)
-                        f.flush()
-                        total_bytes += len(chunk)
-
-            # Update post-write status.
-            file_index += 1
-            elapsed_download_time = time.time() - start_download_time
-            fraction_complete = float(file_index)/file_count
-            if fraction_complete > 0:
-                time_remaining_estimate = elapsed_download_time * (1 - fraction_complete) / fraction_complete
-            else:
-                # No completions yet. So just estimate 60 files/second.
-                time_remaining_estimate = float(file_count)/100
-            progress_status = f"{file_index}/{file_count} = {fraction_complete * 100:.2f}%, " \
-                              f"{time_remaining_estimate:.2f} seconds remaining (estimated)"
-            file_status += "complete."
-            self._print_overwrite(f"{progress_status} ----> {file_status}")
-
-        elapsed_time = time.time() - start_time
-        mega_bytes = float(total_bytes)/(1024 * 1024)
-        print(f"\n\nDownload complete for Instrument {self.instrument} Experiment {self.experiment_number} ("
-              f"{file_count} files, {mega_bytes:.3f} MB, {elapsed_time:.2f} seconds,"
-              f" {mega_bytes/elapsed_time:.3f} MB/sec).")
+"""
+Spigot: SPICE data download tool (HTTP).
+"""
+
+import heapq
+import http.client
+import os
+import queue
+import threading
+import time
+import urllib.parse
+from email.utils import parsedate_to_datetime
+from collections import deque
+from functools import partial
+import concurrent.futures as cf
+import requests
+from requests_futures.sessions import FuturesSession
+from Downloaders.SpigotConcurrency import SpigotConcurrency
+from Downloaders.SpigotFileIndex import SpigotFileIndex
+from Downloaders.SpigotFilter import SpigotFilter
+from Downloaders.SpigotIndexParser import SpigotIndexParser
+from Downloaders.SpigotListingCache import SpigotListingCache
+from Downloaders.SpigotManifest import SpigotManifest
+from Downloaders.SpigotMetrics import SpigotMetrics
+from Downloaders.SpigotProgressGroup import SpigotProgressGroup
+from Downloaders.SpigotRetry import SpigotRetry
+from Downloaders.SpigotTerminalProgress import SpigotTerminalProgress
+from Downloaders.SpigotVerifier import SpigotVerifier, new_hash
+
+
+class SpigotHTTP(object):
+    """
+    SpigotHTTP downloads SPICE experiment data via HTTP interface.
+    """
+
+    def __init__(self, instrument, experiment_number, file_store_base, url_root="http://neutron.ornl.gov/",
+                 max_workers=64, max_in_flight=None, write_queue_size=64, listing_cache=True,
+                 index_parser="auto", chunk_size=256 * 1024, session=None, rate_limiter=None, checksum="sha256",
+                 retry=None, concurrency=None, timeout=(10.0, 60.0), progress=None, metrics=None, file_filter=None,
+                 listing_ttl=0):
+        self.instrument = instrument
+        self.experiment_number = experiment_number
+        self.file_store_base = file_store_base
+        # A FuturesSession may be shared between downloaders, so their requests share one pool of connections and
+        # workers.
+        self.download_session = session or FuturesSession(max_workers=max_workers)
+        self.rate_limiter = rate_limiter
+        # File requests submitted at any one time, and chunks waiting for the writer. Together these bound memory
+        # and socket usage no matter how many files the experiment has. Within max_in_flight, the concurrency
+        # controller finds how many requests the link and server actually sustain.
+        self.max_in_flight = max(1, int(max_in_flight or max_workers))
+        self.concurrency = concurrency or SpigotConcurrency(initial=min(8, self.max_in_flight),
+                                                            maximum=self.max_in_flight)
+        # Failed requests are tried again with backoff, and every request gives up after timeout seconds (connect,
+        # read) without progress.
+        self.retry = retry or SpigotRetry()
+        self.timeout = timeout
+        self.write_queue = queue.Queue(maxsize=write_queue_size)
+        self.write_errors = []
+        self.bytes_written = 0
+        # A download into a SpigotSink writes from the workers, which count their bytes under this lock.
+        self.sink = None
+        self.bytes_lock = threading.Lock()
+        # Bodies are read into reusable buffers of chunk_size bytes. Every worker may be filling one while the write
+        # queue is full, so that many buffers are enough; they are only allocated when first needed.
+        self.chunk_size = int(chunk_size)
+        self.buffer_pool = queue.Queue()
+        self.buffer_lock = threading.Lock()
+        self.buffers_allocated = 0
+        self.max_buffers = write_queue_size + self.max_in_flight
+        # True for the default cache under file_store_base, a SpigotListingCache to share one, or None to disable.
+        # Listings whose autoindex rows are all old belong to settled directories and are reused; listing_ttl > 0
+        # also reuses every other listing for that many seconds, at the risk of missing files added meanwhile.
+        self.listing_cache = listing_cache
+        self.listing_ttl = listing_ttl
+        self.cache_key = None
+        self.index_parser = SpigotIndexParser(index_parser)
+        # Files are hashed with this hashlib algorithm as they are written (None to skip).
+        self.checksum = checksum
+        # Incremental downloads only fetch what was appended to a grown file, starting this many bytes early so the
+        # overlap can be checked against the local copy.
+        self.append_overlap = 1024
+        # Only the directories and files file_filter, a SpigotFilter, wants are listed and downloaded.
+        self.file_filter = file_filter or SpigotFilter()
+        # Progress events go to metrics, a SpigotMetrics that may be shared between downloaders, and to progress, a
+        # SpigotProgress listener (default: a status line on the terminal).
+        self.metrics = metrics or SpigotMetrics()
+        self.progress = SpigotProgressGroup([self.metrics, progress or SpigotTerminalProgress()])
+        self.download_errors = []
+        self.url_base = None
+        self.url_root = url_root
+        # Files and directories found by the current download.
+        self.file_index = SpigotFileIndex(url_root, file_store_base, "/")
+        self.manifest = None
+        self.journal = None
+        self.pending_directories = 0
+        self.start_download_time = 0
+        self.discovery_time = 0
+
+    @property
+    def all_file_urls(self):
+        """
+        Url -> local path of the files found, as a SpigotFileIndex.
+        :return:
+        """
+        return self.file_index
+
+    @property
+    def all_directory_urls(self):
+        return dict(self.file_index.directories())
+
+    def _read_directory_response(self, response, **kwargs):
+        """
+        Response hook run on the worker thread: parse the directory listing into response.spigot_links, so the main
+        thread never waits on parsing.
+        :param response:
+        :param kwargs:
+        :return:
+        """
+        if response.is_redirect or not response.ok:
+            return response
+        response.spigot_links = self.index_parser.get_links(response.content)
+        if self.listing_cache:
+            response.spigot_newest_mtime = self._get_newest_mtime(response.content,
+                                                                  response.headers.get('Last-Modified'))
+        return response
+
+    def _get_newest_mtime(self, page, last_modified):
+        """
+        Tell the listing cache when a directory last changed: the newest date in its autoindex rows, or else the
+        Last-Modified header of the listing.
+        :param page: Content of the index page (bytes).
+        :param last_modified: Last-Modified header, or None.
+        :return: Seconds since the epoch, or None if unknown.
+        """
+        newest_mtime = self.index_parser.get_newest_mtime(page)
+        if newest_mtime is None and last_modified:
+            newest_mtime = parsedate_to_datetime(last_modified).timestamp()
+        return newest_mtime
+
+    def _get_file_and_directory_urls_in_html_directory(self, links, url_base, file_path_base):
+        """
+        Retrieve directory urls and file names for the links of one html directory listing.
+        :param links: Relative links of the directory listing.
+        :param url_base: Url of the directory listing.
+        :param file_path_base: Local path corresponding to the directory listing.
+        :return: Dictionary of directory url -> local path, and list of file names.
+        """
+        directory_urls = {}
+        file_names = []
+        for filename in links:
+            url = url_base.rstrip("/") + "/" + filename
+            file_path = os.path.join(file_path_base, filename.replace("/", ""))
+            relative_path = url[len(self.url_base):].strip("/")
+            if url.endswith("/"):
+                if not self.file_filter.wants_directory(relative_path):
+                    continue
+                self.file_index.add_directory(url)
+                directory_urls[url] = file_path
+            elif self.file_filter.wants_file(relative_path):
+                self.file_index.add_file(url, name=filename)
+                file_names.append(filename)
+                self.progress.file_discovered(file_path)
+        return directory_urls, file_names
+
+    @staticmethod
+    def _get_file_url_and_path(directory, name):
+        """
+        Put together the url and local path of a queued file.
+        :param directory: (Url ending with "/", local path) of its directory.
+        :param name: File name as linked from the directory listing.
+        :return:
+        """
+        return directory[0] + name, os.path.join(directory[1], name.replace("/", ""))
+
+    @staticmethod
+    def _get_queued_file(url, file_path):
+        """
+        Queue entry for a single file, in the form _get_file_url_and_path takes.
+        :param url:
+        :param file_path:
+        :return:
+        """
+        directory_url, _, name = url.rpartition("/")
+        return (directory_url + "/", os.path.dirname(file_path)), name
+
+    def _conditional_headers(self, url, file_path):
+        """
+        Build If-None-Match / If-Modified-Since headers for a file we already have locally, and a Range header for
+        the bytes from append_overlap before its end, so a file that grew only sends what was appended.
+        :param url:
+        :param file_path:
+        :return:
+        """
+        entry = self.manifest.get(url)
+        if not entry or not os.path.exists(file_path) or os.path.getsize(file_path) != entry.get('size'):
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        if entry['size'] > 0:
+            headers['Range'] = f"bytes={entry['size'] - min(self.append_overlap, entry['size'])}-"
+        return headers
+
+    @staticmethod
+    def _is_unchanged(status_code, headers, entry):
+        """
+        Decide from the response status and headers whether the remote file matches the manifest entry.
+        Servers that ignore conditional requests still get compared on ETag, or Last-Modified plus Content-Length.
+        :param status_code:
+        :param headers:
+        :param entry:
+        :return:
+        """
+        if status_code == 304:
+            return True
+        etag = headers.get('ETag')
+        if etag and etag == entry.get('etag'):
+            return True
+        last_modified = headers.get('Last-Modified')
+        content_length = headers.get('Content-Length')
+        if status_code == 206:
+            # Only part of the file was sent; Content-Range has the whole length.
+            content_length = headers.get('Content-Range', "").rpartition("/")[2] or None
+        return last_modified is not None and last_modified == entry.get('last_modified') and \
+            content_length is not None and int(content_length) == entry.get('size')
+
+    def _submit_directory(self, url, directory_path, pending, waiting_files):
+        # Create directories if they don't exist.
+        if not self.sink and not os.path.exists(directory_path):
+            os.makedirs(directory_path)
+        self.pending_directories += 1
+        links = None
+        if self.listing_cache:
+            links = self.listing_cache.get(*self.cache_key, url[len(self.url_base):].strip("/"))
+        if links is None:
+            hooks = {'response': self._read_directory_response}
+            pending[self.download_session.get(url, hooks=hooks, timeout=self.timeout)] = ('directory', url,
+                                                                                           directory_path)
+        else:
+            self._handle_directory_links(links, url, directory_path, pending, waiting_files)
+
+    def _handle_directory_links(self, links, url, directory_path, pending, waiting_files):
+        """
+        Schedule the subdirectories and files of a directory listing that has arrived or was found in the cache.
+        :param links:
+        :param url:
+        :param directory_path:
+        :param pending:
+        :param waiting_files:
+        :return:
+        """
+        directory_urls, file_names = self._get_file_and_directory_urls_in_html_directory(links, url, directory_path)
+        for directory_url, new_directory_path in directory_urls.items():
+            self._submit_directory(directory_url, new_directory_path, pending, waiting_files)
+        # Nearly every file found waits here at some point, so it waits as its name and its directory, which all
+        # files of the listing share, rather than as a url and a local path of its own.
+        directory = (url.rstrip("/") + "/", directory_path)
+        waiting_files.extend((directory, name) for name in file_names)
+        self._finish_directory()
+
+    def _finish_directory(self):
+        self.pending_directories -= 1
+        if self.pending_directories == 0:
+            self.discovery_time = time.time() - self.start_download_time
+            self.progress.discovery_finished(len(self.file_index))
+
+    def _resume_headers(self, url, file_path):
+        """
+        Build Range / If-Range headers to continue an interrupted transfer recorded in the journal.
+        :param url:
+        :param file_path:
+        :return:
+        """
+        entry = self.journal.get(url)
+        part_path = file_path + ".part"
+        if not entry or not os.path.exists(part_path):
+            return {}
+        # If-Range needs a strong ETag or a date; either way a changed file is sent in full.
+        validator = entry.get('etag')
+        if not validator or validator.startswith("W/"):
+            validator = entry.get('last_modified')
+        # Preallocated .part files are longer than what was written, so only trust the journal's count.
+        offset = min(entry.get('written', 0), os.path.getsize(part_path))
+        if not validator or offset == 0:
+            return {}
+        return {'Range': f"bytes={offset}-", 'If-Range': validator}
+
+    def _submit_file(self, url, file_path, pending, incremental):
+        headers = self._resume_headers(url, file_path) if not self.sink else {}
+        if not headers and incremental:
+            headers = self._conditional_headers(url, file_path)
+        hooks = {'response': partial(self._read_file_response, url, file_path, incremental)}
+        pending[self.download_session.get(url, stream=True, headers=headers, hooks=hooks,
+                                          timeout=self.timeout)] = ('file', url, file_path)
+
+    def _read_file_response(self, url, file_path, incremental, response, **kwargs):
+        """
+        Response hook run on the worker thread: read the body and hand it to the writer in chunks.
+        Sets response.spigot_result to ('skipped', size), ('written', size), ('short', size) if the connection
+        ended early, or ('rewritten', 0) if a file fetched as an appended tail turned out to have changed throughout.
+        :param url:
+        :param file_path:
+        :param incremental:
+        :param response:
+        :param kwargs:
+        :return:
+        """
+        if response.is_redirect:
+            return response
+        if self.sink:
+            return self._read_file_to_sink(file_path, response)
+        entry = self.manifest.get(url)
+        if incremental and entry and self._is_unchanged(response.status_code, response.headers, entry) and \
+                os.path.exists(file_path) and os.path.getsize(file_path) == entry.get('size'):
+            # Unchanged since the last download, so leave the local copy alone.
+            response.close()
+            if self.journal.get(url):
+                self.journal.remove(url)
+                if os.path.exists(file_path + ".part"):
+                    os.remove(file_path + ".part")
+            response.spigot_result = ('skipped', entry['size'])
+            return response
+
+        offset = 0
+        # A Range without If-Range asks for the tail of a grown file, one with If-Range resumes a .part file.
+        appending = 'Range' in response.request.headers and 'If-Range' not in response.request.headers
+        if appending and response.status_code in (206, 416):
+            # Anything but a longer file that still starts with the local copy is fetched again in full.
+            if response.status_code == 416 or \
+                    int(response.headers['Content-Range'].rpartition("/")[2]) <= entry['size'] or \
+                    not self._overlap_matches(response, file_path, entry['size']):
+                response.close()
+                response.spigot_result = ('rewritten', 0)
+                return response
+            offset = entry['size']
+        elif response.status_code == 206:
+            # Resuming: the body continues the existing .part file.
+            offset = int(response.headers['Content-Range'].split()[1].split("-")[0])
+        elif response.status_code == 416 and 'Range' in response.request.headers:
+            # The .part file may already hold everything; anything else starts over on the next run.
+            offset = int(response.request.headers['Range'][6:-1])
+            if response.headers.get('Content-Range') != f"bytes */{offset}":
+                self.journal.remove(url)
+                response.raise_for_status()
+        else:
+            response.raise_for_status()
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not appending:
+            self.journal.update(url, etag=etag, last_modified=last_modified)
+
+        file_bytes = 0
+        content_length = response.headers.get('Content-Length')
+        size = None
+        if appending and offset:
+            size = int(response.headers['Content-Range'].rpartition("/")[2])
+        elif content_length and response.status_code != 416:
+            size = offset + int(content_length)
+        # Workers hash what they read, so the writer thread only writes. A file that continues data already on disk
+        # gets its hash from the writer instead, started from those bytes once it has opened the file.
+        hasher_future = cf.Future() if self.checksum and offset else None
+        # Appends go straight into the complete local file, which the writer cuts back to offset if they fail.
+        self.write_queue.put(('append' if appending and offset else 'open', file_path, offset, size, url,
+                              hasher_future))
+        hasher = None
+        if self.checksum:
+            hasher = hasher_future.result() if hasher_future else new_hash(self.checksum)
+        try:
+            if response.status_code != 416:
+                file_bytes = self._read_body(response, file_path, hasher=hasher)
+        except Exception:
+            # Keep the .part file and its journal entry so the next run can resume.
+            self.write_queue.put(('abort', file_path))
+            raise
+        if size is not None and 'Content-Encoding' not in response.headers and offset + file_bytes != size:
+            # The connection ended early. What did arrive is kept, so the next request resumes from there.
+            self.write_queue.put(('abort', file_path))
+            response.spigot_result = ('short', file_bytes)
+            return response
+        fields = {'size': offset + file_bytes, 'etag': etag, 'last_modified': last_modified}
+        if hasher:
+            fields[self.checksum] = hasher.hexdigest()
+        self.write_queue.put(('close', file_path, url, fields))
+        response.spigot_result = ('written', file_bytes)
+        return response
+
+    def _read_file_to_sink(self, file_path, response):
+        """
+        Read a response body into the sink. Sets response.spigot_result to ('written', size) or ('short', size).
+        :param file_path: Local path the file would have, which names it in the sink.
+        :param response:
+        :return:
+        """
+        response.raise_for_status()
+        content_length = response.headers.get('Content-Length')
+        size = int(content_length) if content_length and 'Content-Encoding' not in response.headers else None
+        last_modified = response.headers.get('Last-Modified')
+        name = os.path.relpath(file_path, self.file_store_base).replace(os.path.sep, "/")
+        self.sink.begin_file(name, size, parsedate_to_datetime(last_modified).timestamp() if last_modified else None)
+        try:
+            file_bytes = self._read_body(response, file_path, name)
+        except BaseException:
+            self.sink.abort_file(name)
+            raise
+        if size is not None and file_bytes != size:
+            self.sink.abort_file(name)
+            response.spigot_result = ('short', file_bytes)
+            return response
+        self.sink.finish_file(name)
+        response.spigot_result = ('written', file_bytes)
+        return response
+
+    def _overlap_matches(self, response, file_path, old_size):
+        """
+        Read the bytes of a tail response that overlap the local copy, and compare them.
+        :param response: 206 response starting append_overlap bytes (or fewer) before old_size.
+        :param file_path:
+        :param old_size: Size of the local copy.
+        :return: Whether the remote file still starts with the local copy, as far as can be told.
+        """
+        start = int(response.headers['Content-Range'].split()[1].split("-")[0])
+        remote_bytes = response.raw.read(old_size - start, decode_content=True)
+        self.progress.file_bytes(file_path, len(remote_bytes))
+        return self._read_local_bytes(file_path, start, old_size - start) == remote_bytes
+
+    @staticmethod
+    def _read_local_bytes(file_path, offset, count):
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(count)
+
+    def _get_buffer(self):
+        try:
+            return self.buffer_pool.get_nowait()
+        except queue.Empty:
+            with self.buffer_lock:
+                if self.buffers_allocated < self.max_buffers:
+                    self.buffers_allocated += 1
+                    return bytearray(self.chunk_size)
+            return self.buffer_pool.get()
+
+    def _read_body(self, response, file_path, sink_name=None, hasher=None):
+        """
+        Read a response body into pooled buffers and queue them for the writer, or write them to the sink.
+        Without a content encoding the body is read straight from the underlying http.client response with
+        readinto, skipping the copies that urllib3 and iter_content would make, and the connection is handed back
+        to the pool afterwards.
+        :param response:
+        :param file_path:
+        :param sink_name: Name of the file in the sink, if writing to one.
+        :param hasher: Hash to update with the body, or None.
+        :return: Number of bytes read.
+        """
+        file_bytes = 0
+        fp = getattr(response.raw, '_fp', None)
+        if fp is None or 'Content-Encoding' in response.headers:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                # filter out keep-alive new chunks
+                if chunk:
+                    if hasher:
+                        hasher.update(chunk)
+                    if sink_name is None:
+                        self.write_queue.put(('data', file_path, chunk, len(chunk)))
+                    else:
+                        self._write_to_sink(sink_name, chunk, len(chunk))
+                    file_bytes += len(chunk)
+                    self.progress.file_bytes(file_path, len(chunk))
+                    self.concurrency.record_bytes(len(chunk))
+                    if self.rate_limiter:
+                        self.rate_limiter.consume(len(chunk))
+            return file_bytes
+        while True:
+            buffer = self._get_buffer()
+            try:
+                count = fp.readinto(buffer)
+            except BaseException:
+                self.buffer_pool.put(buffer)
+                raise
+            if not count:
+                self.buffer_pool.put(buffer)
+                break
+            if hasher:
+                hasher.update(memoryview(buffer)[:count])
+            if sink_name is None:
+                self.write_queue.put(('data', file_path, buffer, count))
+            else:
+                try:
+                    self._write_to_sink(sink_name, memoryview(buffer)[:count], count)
+                finally:
+                    self.buffer_pool.put(buffer)
+            file_bytes += count
+            self.progress.file_bytes(file_path, count)
+            self.concurrency.record_bytes(count)
+            if self.rate_limiter:
+                self.rate_limiter.consume(count)
+        response.raw.release_conn()
+        return file_bytes
+
+    def _write_to_sink(self, name, data, count):
+        self.sink.write_file(name, data)
+        with self.bytes_lock:
+            self.bytes_written += count
+
+    def _write_files(self):
+        """
+        Writer stage: take open/data/close/abort messages from the write queue until a None sentinel arrives.
+        Data goes to a .part file that only replaces the real file once complete, so an interrupted run never
+        leaves a truncated file under its final name. Files whose writes fail are recorded in write_errors and left
+        out of the manifest.
+        :return:
+        """
+        open_files = {}
+        failed_paths = set()
+        while True:
+            message = self.write_queue.get()
+            if message is None:
+                break
+            file_path = message[1]
+            part_path = file_path + ".part"
+            try:
+                if message[0] == 'append':
+                    failed_paths.discard(file_path)
+                    offset, size, url, hasher_future = message[2:]
+                    f = open(file_path, 'r+b')
+                    f.seek(offset)
+                    f.truncate()
+                    # The last field is where to cut the file back to if the append fails.
+                    open_files[file_path] = [f, url, offset, offset]
+                    if hasher_future:
+                        hasher_future.set_result(new_hash(self.checksum, file_path, offset))
+                elif message[0] == 'open':
+                    failed_paths.discard(file_path)
+                    offset, size, url, hasher_future = message[2:]
+                    if offset > 0:
+                        f = open(part_path, 'r+b')
+                        f.seek(offset)
+                        f.truncate()
+                    else:
+                        f = open(part_path, 'wb')
+                    open_files[file_path] = [f, url, offset, None]
+                    if hasher_future:
+                        hasher_future.set_result(new_hash(self.checksum, part_path, offset))
+                    if size and size > offset and hasattr(os, 'posix_fallocate'):
+                        # Reserve the space up front, so the file system can lay the file out contiguously.
+                        try:
+                            os.posix_fallocate(f.fileno(), offset, size - offset)
+                        except OSError:
+                            pass
+                elif message[0] == 'data':
+                    data, count = message[2:]
+                    try:
+                        if file_path not in failed_paths:
+                            state = open_files[file_path]
+                            state[0].write(memoryview(data)[:count])
+                            state[2] += count
+                            self.bytes_written += count
+                            if state[3] is None:
+                                self.journal.update(state[1], written=state[2])
+                    finally:
+                        if type(data) is bytearray:
+                            self.buffer_pool.put(data)
+                elif file_path in failed_paths:
+                    continue
+                elif message[0] == 'abort':
+                    f, _, _, append_offset = open_files.pop(file_path)
+                    f.truncate(append_offset)
+                    f.close()
+                else:
+                    f, _, _, append_offset = open_files.pop(file_path)
+                    f.truncate()
+                    f.close()
+                    if append_offset is None:
+                        os.replace(part_path, file_path)
+                    self.manifest.update(message[2], **message[3])
+                    self.journal.remove(message[2])
+            except OSError as e:
+                failed_paths.add(file_path)
+                if message[0] in ('open', 'append') and message[5] and not message[5].done():
+                    # The worker waits for its hash; the file is recorded as failed either way.
+                    message[5].set_result(None)
+                state = open_files.pop(file_path, None)
+                if state:
+                    if state[3] is not None:
+                        state[0].truncate(state[3])
+                    state[0].close()
+                self.write_errors.append((file_path, e))
+            self.journal.save_if_due()
+            self.manifest.save_if_due(10.0)
+
+    def download(self, incremental=False, sink=None):
+        """
+        Download all files of the experiment.
+        Directory listings and file downloads share the session's executor: as soon as a listing arrives, its
+        subdirectories are listed and its files are requested, so crawling and transferring overlap. Workers read
+        response bodies and a separate writer thread writes them to disk.
+        :param incremental: Only fetch files that are new or changed since the last download, using the manifest.
+        :param sink: SpigotSink to stream the files into instead of writing them under file_store_base. The sink
+                     is left open. Nothing is written under file_store_base: manifest and journal are not used, so
+                     this always downloads everything, and the default listing cache is not opened.
+        :return: Dictionary of transfer statistics.
+        """
+        if sink and incremental:
+            raise ValueError("Downloads into a sink cannot be incremental.")
+        start_time = time.time()
+        listing_cache = self.listing_cache
+        if sink and listing_cache is True:
+            self.listing_cache = None
+        self.sink = sink
+        try:
+            url_base, file_path_base = self._prepare_download()
+            total_bytes, skipped_files, skipped_bytes = self._transfer([(url_base, file_path_base)], [], incremental)
+        finally:
+            self.sink = None
+            if sink:
+                self.listing_cache = listing_cache
+        return self._report_download(start_time, total_bytes, skipped_files, skipped_bytes, incremental)
+
+    def follow(self, interval=30.0, polls=None):
+        """
+        Keep up with a running experiment: download incrementally every interval seconds, so new files are fetched
+        and files that grew only send what was appended. Listings are not cached meanwhile, since they go stale
+        between polls. A poll that fails is reported and the next one tries again.
+        :param interval: Seconds from the start of one poll to the start of the next.
+        :param polls: Number of polls, or None to follow until interrupted.
+        :return: List of the statistics of each poll, None for the polls that failed.
+        """
+        listing_cache = self.listing_cache
+        self.listing_cache = None
+        results = []
+        try:
+            while polls is None or len(results) < polls:
+                start_time = time.monotonic()
+                try:
+                    results.append(self.download(incremental=True))
+                except IOError as e:
+                    print(f"\n\nPoll failed, trying again in {interval} seconds: {e}")
+                    results.append(None)
+                if polls is None or len(results) < polls:
+                    time.sleep(max(0.0, interval - (time.monotonic() - start_time)))
+        finally:
+            self.listing_cache = listing_cache
+        return results
+
+    def _transfer(self, directories, files, incremental):
+        """
+        Crawl the given directories and download everything found in them, plus the given files.
+        :param directories: List of (url, local path) of directories to crawl.
+        :param files: List of (url, local path) of files to download.
+        :param incremental:
+        :return: Bytes written (including those of attempts that failed), number of skipped files and their bytes.
+        """
+        skipped_files = 0
+        skipped_bytes = 0
+        self.bytes_written = 0
+        self.write_errors = []
+        self.download_errors = []
+        writer = threading.Thread(target=self._write_files, daemon=True)
+        writer.start()
+
+        # Directory listings are submitted as soon as they are found; file requests wait here until the concurrency
+        # controller allows another one. Failed requests wait in retry_queue, ordered by when they may go again.
+        pending = {}
+        waiting_files = deque(self._get_queued_file(url, file_path) for url, file_path in files)
+        files_in_flight = 0
+        retry_queue = []
+        attempts = {}
+        for url, directory_path in directories:
+            self._submit_directory(url, directory_path, pending, waiting_files)
+        try:
+            while pending or waiting_files or retry_queue:
+                while retry_queue and retry_queue[0][0] <= time.monotonic():
+                    _, kind, url, file_path = heapq.heappop(retry_queue)
+                    if kind == 'directory':
+                        # Counted as pending all along, so discovery is not reported complete in the meantime.
+                        self.pending_directories -= 1
+                        self._submit_directory(url, file_path, pending, waiting_files)
+                    else:
+                        waiting_files.appendleft(self._get_queued_file(url, file_path))
+                while waiting_files and files_in_flight < self.concurrency.limit:
+                    url, file_path = self._get_file_url_and_path(*waiting_files.popleft())
+                    self.progress.file_started(file_path, len(waiting_files))
+                    self._submit_file(url, file_path, pending, incremental)
+                    files_in_flight += 1
+                timeout = max(0.0, retry_queue[0][0] - time.monotonic()) if retry_queue else None
+                if not pending:
+                    time.sleep(timeout or 0)
+                    continue
+                done, _ = cf.wait(pending, timeout=timeout, return_when=cf.FIRST_COMPLETED)
+                for future in done:
+                    kind, url, file_path = pending.pop(future)
+                    if kind == 'file':
+                        files_in_flight -= 1
+                    try:
+                        response = future.result()
+                        if kind == 'directory':
+                            response.raise_for_status()
+                        elif response.spigot_result[0] == 'short':
+                            # What did arrive is kept, so the retry resumes from there.
+                            raise IOError("Transfer ended early.")
+                    except Exception as e:
+                        attempts[url] = attempts.get(url, 0) + 1
+                        delay = self.retry.get_delay(attempts[url]) if self._is_retryable(e) else None
+                        if kind == 'directory':
+                            self.progress.directory_failed(file_path, e, delay)
+                        else:
+                            self.progress.file_failed(file_path, e, delay)
+                        if delay is None:
+                            self.download_errors.append((file_path, e))
+                            if kind == 'directory':
+                                self._finish_directory()
+                            continue
+                        self.concurrency.record_error()
+                        heapq.heappush(retry_queue, (time.monotonic() + delay, kind, url, file_path))
+                        continue
+                    self.concurrency.record_latency(response.elapsed.total_seconds())
+
+                    if kind == 'directory':
+                        links = response.spigot_links
+                        if self.listing_cache:
+                            self.listing_cache.put(*self.cache_key, url[len(self.url_base):].strip("/"), links,
+                                                   response.spigot_newest_mtime)
+                        self._handle_directory_links(links, url, file_path, pending, waiting_files)
+                        continue
+
+                    result, file_bytes = response.spigot_result
+                    if result == 'rewritten':
+                        # The file changed rather than grew, so fetch it again from the start.
+                        self.manifest.remove(url)
+                        waiting_files.appendleft(self._get_queued_file(url, file_path))
+                        continue
+                    if result == 'skipped':
+                        skipped_files += 1
+                        skipped_bytes += file_bytes
+                    self.progress.file_done(file_path, file_bytes, skipped=result == 'skipped')
+        except BaseException:
+            # Let the running transfers finish (their .part files stay resumable) and drop the rest.
+            for future in pending:
+                future.cancel()
+            cf.wait(pending)
+            raise
+        finally:
+            self.write_queue.put(None)
+            writer.join()
+            self.journal.save()
+            self.manifest.save()
+            if self.listing_cache:
+                self.listing_cache.evict()
+        errors = self.write_errors + self.download_errors
+        if errors:
+            file_path, error = errors[0]
+            print(f"\n\nFailed to download {len(errors)} files.")
+            raise IOError(f"Failed to download {file_path}: {error}")
+        return self.bytes_written, skipped_files, skipped_bytes
+
+    @staticmethod
+    def _is_retryable(error):
+        """
+        Network errors, timeouts and server-side HTTP errors are worth retrying; missing files and the like are not.
+        :param error:
+        :return:
+        """
+        if isinstance(error, requests.exceptions.HTTPError):
+            status_code = error.response.status_code if error.response is not None else 0
+            return status_code in (408, 429) or status_code >= 500
+        # Bodies are read straight from http.client, so its errors can surface as well as those of requests.
+        return isinstance(error, (OSError, http.client.HTTPException))
+
+    def verify(self, max_workers=None, redownload=True):
+        """
+        Check the local copy of the experiment against the manifest: every file must exist with the recorded size
+        and, where one was recorded, checksum. Files are hashed in parallel by a process pool. Bad files are dropped
+        from the manifest and, with redownload, downloaded again.
+        :param max_workers: Number of hashing processes (default: one per core).
+        :param redownload:
+        :return: List of (url, reason) for the files that failed verification.
+        """
+        start_time = time.time()
+        files = self._get_manifest_files()
+        print(f"\nVerifying {len(files)} files...")
+        bad_files = SpigotVerifier(self.checksum, max_workers).verify(files)
+        for url, reason in bad_files:
+            print(f"{files[url][0]}: {reason}")
+            self.manifest.remove(url)
+        self.manifest.save()
+        print(f"\n{len(files) - len(bad_files)}/{len(files)} files verified in {time.time() - start_time:.2f} seconds.")
+
+        if bad_files and redownload:
+            self._prepare_download()
+            for url, _ in bad_files:
+                # The file's directory may be gone too.
+                os.makedirs(os.path.dirname(files[url][0]), exist_ok=True)
+                self.progress.file_discovered(self.file_index.add_file(url))
+            self.progress.discovery_finished(len(self.file_index))
+            total_bytes, _, _ = self._transfer([], list(self.file_index.files()), False)
+            self._report_download(start_time, total_bytes, 0, 0, False)
+        return bad_files
+
+    def _get_manifest_files(self):
+        """
+        Open the manifest and map the entries that the file filter wants to local paths.
+        :return: Dictionary of url -> (local path, manifest entry).
+        """
+        url_base, file_path_base = self._open_manifest()
+        files = {}
+        for url, entry in self.manifest.items():
+            relative_path = url[len(url_base):].strip("/")
+            if url.startswith(url_base.rstrip("/") + "/") and self.file_filter.wants_file(relative_path):
+                files[url] = (os.path.join(file_path_base, *relative_path.split("/")), entry)
+        return files
+
+    def _open_manifest(self):
+        """
+        Open the manifest and journal of the experiment. Downloads into a sink keep them in memory only.
+        :return: Url of the experiment directory and its local path.
+        """
+        instrument_path_part = str(self.instrument).replace("-", "").lower()
+        experiment_path_part = f"exp{int(self.experiment_number)}"
+        url_base = urllib.parse.urljoin(self.url_root, f"user_data/{instrument_path_part}/{experiment_path_part}")
+        file_path_base = os.path.join(os.path.join(self.file_store_base, instrument_path_part), experiment_path_part)
+        manifest_path = journal_path = None
+        if not self.sink:
+            manifest_path = os.path.join(self.file_store_base, ".spigot",
+                                         f"{instrument_path_part}_{experiment_path_part}.json")
+            journal_path = os.path.join(self.file_store_base, ".spigot",
+                                        f"{instrument_path_part}_{experiment_path_part}.journal.json")
+        self.manifest = SpigotManifest(manifest_path)
+        self.journal = SpigotManifest(journal_path)
+        self.cache_key = (instrument_path_part, experiment_path_part)
+        self.url_base = url_base
+        return url_base, file_path_base
+
+    def _prepare_download(self):
+        """
+        Open the manifest, journal and listing cache of the experiment and reset the progress state.
+        :return: Url of the experiment directory and its local path.
+        """
+        url_base, file_path_base = self._open_manifest()
+        if self.listing_cache is True:
+            self.listing_cache = SpigotListingCache(os.path.join(self.file_store_base, ".spigot", "listings.sqlite"),
+                                                    ttl=self.listing_ttl)
+
+        print("\nIdentifying and downloading files...\n")
+        self.start_download_time = time.time()
+        self.file_index = SpigotFileIndex(url_base, file_path_base, "/")
+        self.pending_directories = 0
+        self.progress.download_started(f"{self.instrument} Experiment {self.experiment_number}")
+        return url_base, file_path_base
+
+    def _report_download(self, start_time, total_bytes, skipped_files, skipped_bytes, incremental):
+        """
+        Print the download summary.
+        :return: Dictionary of transfer statistics.
+        """
+        file_count = len(self.file_index)
+        elapsed_time = time.time() - start_time
+        statistics = {'files': file_count, 'bytes': total_bytes, 'skipped_files': skipped_files,
+                      'skipped_bytes': skipped_bytes, 'elapsed': elapsed_time, 'discovery_time': self.discovery_time}
+        self.progress.download_finished(statistics)
+        mega_bytes = float(total_bytes)/(1024 * 1024)
+        print(f"\n\nDownload complete for Instrument {self.instrument} Experiment {self.experiment_number} ("
+              f"{file_count} files, {mega_bytes:.3f} MB, {elapsed_time:.2f} seconds,"
+              f" {mega_bytes/elapsed_time:.3f} MB/sec).")
+        if incremental:
+            print(f"Skipped {skipped_files} unchanged files ({float(skipped_bytes)/(1024 * 1024):.3f} MB).")
+        return statistics
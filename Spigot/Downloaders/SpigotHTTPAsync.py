@@ -0,0 +1,471 @@
+"""
+Spigot: SPICE data download tool (HTTP, asyncio).
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import partial
+from Downloaders.SpigotHTTP import SpigotHTTP
+from Downloaders.SpigotVerifier import SpigotVerifier, new_hash
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class SpigotHTTPAsync(SpigotHTTP):
+    """
+    SpigotHTTPAsync downloads SPICE experiment data via HTTP interface on an asyncio event loop.
+
+    It crawls and downloads like SpigotHTTP, with the same manifest, journal, listing cache and .part files, but
+    every request is a coroutine on one aiohttp session instead of a thread, so hundreds of transfers can be in
+    flight from a single thread. Disk writes, manifest and journal saves, listing cache lookups and large index
+    pages go to the loop's default executor, so the loop is never blocked by them. max_concurrency is the ceiling
+    for the concurrency controller, as max_workers is for SpigotHTTP.
+    """
+
+    def __init__(self, instrument, experiment_number, file_store_base, url_root="http://neutron.ornl.gov/",
+                 max_concurrency=100, listing_cache=True, index_parser="auto", chunk_size=256 * 1024, session=None,
+                 checksum="sha256", retry=None, concurrency=None, timeout=(10.0, 60.0), progress=None, metrics=None,
+                 file_filter=None, listing_ttl=0):
+        if aiohttp is None:
+            raise ImportError("SpigotHTTPAsync needs the aiohttp package.")
+        super().__init__(instrument, experiment_number, file_store_base, url_root=url_root,
+                         max_workers=max_concurrency, listing_cache=listing_cache, index_parser=index_parser,
+                         chunk_size=chunk_size, checksum=checksum, retry=retry, concurrency=concurrency,
+                         timeout=timeout, progress=progress, metrics=metrics, file_filter=file_filter,
+                         listing_ttl=listing_ttl)
+        # An aiohttp.ClientSession may be shared with the rest of the application; its connector then decides how
+        # many connections are opened.
+        self.download_session = session
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.request_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout[0], sock_read=timeout[1])
+        self.download_errors = []
+        self.total_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.attempts = {}
+        self.retry_tasks = set()
+        self.slot_condition = None
+        self.active_transfers = 0
+        # Threads for the sink's calls while downloading into one, see download.
+        self.sink_executor = None
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status in (408, 429) or error.status >= 500
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+    async def _acquire_slot(self):
+        """
+        Wait until the concurrency controller allows another transfer.
+        :return:
+        """
+        async with self.slot_condition:
+            await self.slot_condition.wait_for(lambda: self.active_transfers < self.concurrency.limit)
+            self.active_transfers += 1
+
+    async def _release_slot(self):
+        async with self.slot_condition:
+            self.active_transfers -= 1
+            self.slot_condition.notify_all()
+
+    async def _retry_later(self, work_queue, item, delay):
+        await asyncio.sleep(delay)
+        work_queue.put_nowait(item)
+        # Only now is the failed attempt done, so the queue never looks finished while a retry is waiting.
+        work_queue.task_done()
+
+    @staticmethod
+    def _write_chunk(f, hasher, chunk):
+        f.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+
+    def _save_state(self):
+        """
+        Save the journal and manifest and trim the listing cache once a transfer is over, from an executor thread.
+        :return:
+        """
+        self.journal.save()
+        self.manifest.save()
+        if self.listing_cache:
+            self.listing_cache.evict()
+
+    async def _list_directory(self, session, url, directory_path, work_queue, sequence):
+        """
+        List one directory and queue its subdirectories and files.
+        :param session:
+        :param url:
+        :param directory_path:
+        :param work_queue:
+        :param sequence: Counter that keeps queue entries of the same kind in discovery order.
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        if not self.sink:
+            await loop.run_in_executor(None, partial(os.makedirs, directory_path, exist_ok=True))
+        relative_path = url[len(self.url_base):].strip("/")
+        links = None
+        if self.listing_cache:
+            links = await loop.run_in_executor(None, self.listing_cache.get, *self.cache_key, relative_path)
+        if links is None:
+            request_time = time.monotonic()
+            async with session.get(url, timeout=self.request_timeout) as response:
+                self.concurrency.record_latency(time.monotonic() - request_time)
+                response.raise_for_status()
+                page = await response.read()
+                last_modified = response.headers.get('Last-Modified')
+            links = await loop.run_in_executor(None, self.index_parser.get_links, page)
+            if self.listing_cache:
+                newest_mtime = await loop.run_in_executor(None, self._get_newest_mtime, page, last_modified)
+                await loop.run_in_executor(None, self.listing_cache.put, *self.cache_key, relative_path, links,
+                                           newest_mtime)
+
+        directory_urls, file_names = self._get_file_and_directory_urls_in_html_directory(links, url, directory_path)
+        # Directories sort ahead of files, so the whole tree is found early while the files keep every slot busy.
+        for directory_url, new_directory_path in directory_urls.items():
+            self.pending_directories += 1
+            work_queue.put_nowait((0, next(sequence), 'directory', directory_url, new_directory_path))
+        # Files wait as their directory and name, as in SpigotHTTP._handle_directory_links.
+        directory = (url.rstrip("/") + "/", directory_path)
+        for name in file_names:
+            work_queue.put_nowait((1, next(sequence), 'file', directory, name))
+
+    async def _download_file(self, session, url, file_path, incremental):
+        """
+        Download one file into its .part file, resuming, appending to or skipping it as SpigotHTTP would.
+        :param session:
+        :param url:
+        :param file_path:
+        :param incremental:
+        :return: ('skipped', size), ('written', size), ('short', size) if the connection ended early, or
+                 ('rewritten', 0) if a file fetched as an appended tail turned out to have changed throughout.
+        """
+        loop = asyncio.get_running_loop()
+        headers = self._resume_headers(url, file_path) if not self.sink else {}
+        if not headers and incremental:
+            headers = self._conditional_headers(url, file_path)
+        request_time = time.monotonic()
+        async with session.get(url, headers=headers, timeout=self.request_timeout) as response:
+            self.concurrency.record_latency(time.monotonic() - request_time)
+            if self.sink:
+                return await self._read_file_to_sink(file_path, response)
+            entry = self.manifest.get(url)
+            if incremental and entry and self._is_unchanged(response.status, response.headers, entry) and \
+                    os.path.exists(file_path) and os.path.getsize(file_path) == entry.get('size'):
+                # Unchanged since the last download, so leave the local copy alone.
+                if self.journal.get(url):
+                    self.journal.remove(url)
+                    if os.path.exists(file_path + ".part"):
+                        await loop.run_in_executor(None, os.remove, file_path + ".part")
+                return 'skipped', entry['size']
+
+            offset = 0
+            # A Range without If-Range asks for the tail of a grown file, one with If-Range resumes a .part file.
+            appending = 'Range' in headers and 'If-Range' not in headers
+            if appending and response.status in (206, 416):
+                # Anything but a longer file that still starts with the local copy is fetched again in full.
+                if response.status == 416 or \
+                        int(response.headers['Content-Range'].rpartition("/")[2]) <= entry['size']:
+                    return 'rewritten', 0
+                start = int(response.headers['Content-Range'].split()[1].split("-")[0])
+                try:
+                    remote_bytes = await response.content.readexactly(entry['size'] - start)
+                except asyncio.IncompleteReadError:
+                    return 'short', 0
+                self.progress.file_bytes(file_path, len(remote_bytes))
+                local_bytes = await loop.run_in_executor(None, self._read_local_bytes, file_path, start,
+                                                         entry['size'] - start)
+                if local_bytes != remote_bytes:
+                    return 'rewritten', 0
+                offset = entry['size']
+            elif response.status == 206:
+                # Resuming: the body continues the existing .part file.
+                offset = int(response.headers['Content-Range'].split()[1].split("-")[0])
+            elif response.status == 416 and 'Range' in headers:
+                # The .part file may already hold everything; anything else starts over on the next run.
+                offset = int(headers['Range'][6:-1])
+                if response.headers.get('Content-Range') != f"bytes */{offset}":
+                    self.journal.remove(url)
+                    response.raise_for_status()
+            else:
+                response.raise_for_status()
+            # A server that ignores Range sends the whole file, which is then downloaded as usual.
+            appending = appending and offset > 0
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if appending:
+                size = int(response.headers['Content-Range'].rpartition("/")[2])
+            else:
+                self.journal.update(url, etag=etag, last_modified=last_modified)
+                content_length = response.headers.get('Content-Length')
+                size = None
+                if content_length and response.status != 416 and 'Content-Encoding' not in response.headers:
+                    size = offset + int(content_length)
+
+            # Appends go straight into the complete local file, which is cut back to offset if they fail.
+            part_path = file_path if appending else file_path + ".part"
+            f = await loop.run_in_executor(None, open, part_path, 'r+b' if offset else 'wb')
+            file_bytes = 0
+            complete = False
+            try:
+                hasher = None
+                if self.checksum:
+                    hasher = await loop.run_in_executor(None, new_hash, self.checksum, part_path, offset)
+                if offset:
+                    f.seek(offset)
+                if response.status != 416:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        await loop.run_in_executor(None, self._write_chunk, f, hasher, chunk)
+                        file_bytes += len(chunk)
+                        self.total_bytes += len(chunk)
+                        self.progress.file_bytes(file_path, len(chunk))
+                        self.concurrency.record_bytes(len(chunk))
+                        if not appending:
+                            self.journal.update(url, written=offset + file_bytes)
+                complete = size is None or offset + file_bytes == size
+            finally:
+                # On failure the .part file and its journal entry stay behind, so the next run can resume.
+                f.truncate(offset if appending and not complete else None)
+                f.close()
+        if not complete:
+            return 'short', file_bytes
+        if not appending:
+            await loop.run_in_executor(None, os.replace, part_path, file_path)
+        self.manifest.update(url, size=offset + file_bytes, etag=etag, last_modified=last_modified)
+        if hasher:
+            self.manifest.update(url, **{self.checksum: hasher.hexdigest()})
+        self.journal.remove(url)
+        await loop.run_in_executor(None, self.journal.save_if_due)
+        await loop.run_in_executor(None, self.manifest.save_if_due, 10.0)
+        return 'written', file_bytes
+
+    async def _read_file_to_sink(self, file_path, response):
+        """
+        Read a response body into the sink, as SpigotHTTP._read_file_to_sink does.
+        :param file_path: Local path the file would have, which names it in the sink.
+        :param response:
+        :return: ('written', size) or ('short', size) as _download_file.
+        """
+        loop = asyncio.get_running_loop()
+        response.raise_for_status()
+        content_length = response.headers.get('Content-Length')
+        size = int(content_length) if content_length and 'Content-Encoding' not in response.headers else None
+        last_modified = response.headers.get('Last-Modified')
+        name = os.path.relpath(file_path, self.file_store_base).replace(os.path.sep, "/")
+        await loop.run_in_executor(self.sink_executor, self.sink.begin_file, name, size,
+                                   parsedate_to_datetime(last_modified).timestamp() if last_modified else None)
+        file_bytes = 0
+        try:
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                await loop.run_in_executor(self.sink_executor, self.sink.write_file, name, chunk)
+                file_bytes += len(chunk)
+                self.total_bytes += len(chunk)
+                self.progress.file_bytes(file_path, len(chunk))
+                self.concurrency.record_bytes(len(chunk))
+        except BaseException:
+            # Shielded, so that a cancelled transfer still gives back its share of the sink.
+            await asyncio.shield(loop.run_in_executor(self.sink_executor, self.sink.abort_file, name))
+            raise
+        if size is not None and file_bytes != size:
+            await loop.run_in_executor(self.sink_executor, self.sink.abort_file, name)
+            return 'short', file_bytes
+        await loop.run_in_executor(self.sink_executor, self.sink.finish_file, name)
+        return 'written', file_bytes
+
+    async def _worker(self, session, work_queue, sequence, incremental):
+        """
+        Take directories and files from the work queue until cancelled. Failed requests go back on the queue after
+        a backoff delay; once out of retries they are recorded in download_errors, without stopping the other
+        transfers.
+        :param session:
+        :param work_queue:
+        :param sequence:
+        :param incremental:
+        :return:
+        """
+        while True:
+            item = await work_queue.get()
+            kind = item[2]
+            if kind == 'directory':
+                url, file_path = item[3:]
+            else:
+                url, file_path = self._get_file_url_and_path(*item[3:])
+            retrying = False
+            try:
+                if kind == 'directory':
+                    await self._list_directory(session, url, file_path, work_queue, sequence)
+                    continue
+                await self._acquire_slot()
+                self.progress.file_started(file_path, work_queue.qsize())
+                try:
+                    result, file_bytes = await self._download_file(session, url, file_path, incremental)
+                finally:
+                    await self._release_slot()
+                if result == 'short':
+                    # What did arrive is kept, so the retry resumes from there.
+                    raise IOError("Transfer ended early.")
+                if result == 'rewritten':
+                    # The file changed rather than grew, so fetch it again from the start.
+                    self.manifest.remove(url)
+                    work_queue.put_nowait(item)
+                    continue
+                if result == 'skipped':
+                    self.skipped_files += 1
+                    self.skipped_bytes += file_bytes
+                self.progress.file_done(file_path, file_bytes, skipped=result == 'skipped')
+            except Exception as e:
+                self.attempts[url] = self.attempts.get(url, 0) + 1
+                delay = self.retry.get_delay(self.attempts[url]) if self._is_retryable(e) else None
+                if kind == 'directory':
+                    self.progress.directory_failed(file_path, e, delay)
+                else:
+                    self.progress.file_failed(file_path, e, delay)
+                if delay is None:
+                    self.download_errors.append((file_path, e))
+                else:
+                    retrying = True
+                    self.concurrency.record_error()
+                    task = asyncio.ensure_future(self._retry_later(work_queue, item, delay))
+                    self.retry_tasks.add(task)
+                    task.add_done_callback(self.retry_tasks.discard)
+            finally:
+                if not retrying:
+                    if kind == 'directory':
+                        self._finish_directory()
+                    work_queue.task_done()
+
+    async def download(self, incremental=False, sink=None):
+        """
+        Download all files of the experiment.
+        :param incremental: Only fetch files that are new or changed since the last download, using the manifest.
+        :param sink: SpigotSink to stream the files into, as for SpigotHTTP.download. The sink is left open.
+        :return: Dictionary of transfer statistics.
+        """
+        if sink and incremental:
+            raise ValueError("Downloads into a sink cannot be incremental.")
+        start_time = time.time()
+        listing_cache = self.listing_cache
+        if sink:
+            # A sink's calls may wait for each other, so every transfer gets a thread of its own for them rather
+            # than sharing the loop's default executor, which could fill up with waiting calls.
+            self.sink = sink
+            self.sink_executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+            if listing_cache is True:
+                self.listing_cache = None
+        try:
+            url_base, file_path_base = await asyncio.get_running_loop().run_in_executor(None, self._prepare_download)
+            await self._transfer([(url_base, file_path_base)], [], incremental)
+        finally:
+            if sink:
+                self.sink_executor.shutdown()
+                self.sink_executor = None
+                self.sink = None
+                self.listing_cache = listing_cache
+        return self._report_download(start_time, self.total_bytes, self.skipped_files, self.skipped_bytes,
+                                     incremental)
+
+    async def follow(self, interval=30.0, polls=None):
+        """
+        Keep up with a running experiment, as SpigotHTTP.follow does.
+        :param interval: Seconds from the start of one poll to the start of the next.
+        :param polls: Number of polls, or None to follow until cancelled.
+        :return: List of the statistics of each poll, None for the polls that failed.
+        """
+        listing_cache = self.listing_cache
+        self.listing_cache = None
+        results = []
+        try:
+            while polls is None or len(results) < polls:
+                start_time = time.monotonic()
+                try:
+                    results.append(await self.download(incremental=True))
+                except IOError as e:
+                    print(f"\n\nPoll failed, trying again in {interval} seconds: {e}")
+                    results.append(None)
+                if polls is None or len(results) < polls:
+                    await asyncio.sleep(max(0.0, interval - (time.monotonic() - start_time)))
+        finally:
+            self.listing_cache = listing_cache
+        return results
+
+    async def _transfer(self, directories, files, incremental):
+        """
+        Crawl the given directories and download everything found in them, plus the given files.
+        :param directories: List of (url, local path) of directories to crawl.
+        :param files: List of (url, local path) of files to download.
+        :param incremental:
+        :return:
+        """
+        self.download_errors = []
+        self.total_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.attempts = {}
+        self.active_transfers = 0
+        self.slot_condition = asyncio.Condition()
+
+        session = self.download_session
+        if session is None:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+        work_queue = asyncio.PriorityQueue()
+        sequence = itertools.count()
+        self.pending_directories = len(directories)
+        for url, directory_path in directories:
+            work_queue.put_nowait((0, next(sequence), 'directory', url, directory_path))
+        for url, file_path in files:
+            work_queue.put_nowait((1, next(sequence), 'file', *self._get_queued_file(url, file_path)))
+        workers = [asyncio.ensure_future(self._worker(session, work_queue, sequence, incremental))
+                   for _ in range(self.max_concurrency)]
+        try:
+            await work_queue.join()
+        finally:
+            tasks = workers + list(self.retry_tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.download_session is None:
+                await session.close()
+            await asyncio.get_running_loop().run_in_executor(None, self._save_state)
+        if self.download_errors:
+            url, error = self.download_errors[0]
+            print(f"\n\nFailed to download {len(self.download_errors)} files.")
+            raise IOError(f"Failed to download {url}: {error}")
+
+    async def verify(self, max_workers=None, redownload=True):
+        """
+        Check the local copy of the experiment against the manifest like SpigotHTTP.verify, with the process pool
+        run from an executor thread.
+        :param max_workers: Number of hashing processes (default: one per core).
+        :param redownload:
+        :return: List of (url, reason) for the files that failed verification.
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        files = await loop.run_in_executor(None, self._get_manifest_files)
+        print(f"\nVerifying {len(files)} files...")
+        verifier = SpigotVerifier(self.checksum, max_workers)
+        bad_files = await loop.run_in_executor(None, verifier.verify, files)
+        for url, reason in bad_files:
+            print(f"{files[url][0]}: {reason}")
+            self.manifest.remove(url)
+        await loop.run_in_executor(None, self.manifest.save)
+        print(f"\n{len(files) - len(bad_files)}/{len(files)} files verified in {time.time() - start_time:.2f} seconds.")
+
+        if bad_files and redownload:
+            await loop.run_in_executor(None, self._prepare_download)
+            for url, _ in bad_files:
+                # The file's directory may be gone too.
+                await loop.run_in_executor(None, partial(os.makedirs, os.path.dirname(files[url][0]), exist_ok=True))
+                self.progress.file_discovered(self.file_index.add_file(url))
+            self.progress.discovery_finished(len(self.file_index))
+            await self._transfer([], list(self.file_index.files()), False)
+            self._report_download(start_time, self.total_bytes, 0, 0, False)
+        return bad_files
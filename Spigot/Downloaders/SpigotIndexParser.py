@@ -0,0 +1,109 @@
+"""
+Spigot: link extraction from HTTP directory index pages.
+"""
+
+import calendar
+import html
+import re
+import urllib.parse
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+class SpigotIndexParser(object):
+    """
+    SpigotIndexParser extracts the relative links of a directory index page.
+
+    Apache, nginx and Python autoindex pages are generated, one anchor per entry, so a regular expression over the
+    raw bytes finds the links far faster than building a tree. Other pages go through lxml when it is installed and
+    through BeautifulSoup otherwise. method may be "auto", "regex", "lxml" or "bs4".
+
+    Autoindex rows also show when each entry last changed, which get_newest_mtime reads for the listing cache.
+    """
+
+    autoindex_titles = re.compile(rb"<title>\s*(Index of |Directory listing for )", re.IGNORECASE)
+    anchor_href = re.compile(rb"""<a\s[^>]*?href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
+    # Apache 2.4 writes 2019-05-01 10:12, nginx and older Apache 01-May-2019 10:12.
+    iso_date = re.compile(rb"(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2})")
+    named_month_date = re.compile(rb"(\d{2})-(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)-(\d{4}) (\d{2}):(\d{2})")
+    months = {name: f"{index:02}".encode() for index, name in enumerate(
+        (b"Jan", b"Feb", b"Mar", b"Apr", b"May", b"Jun", b"Jul", b"Aug", b"Sep", b"Oct", b"Nov", b"Dec"), 1)}
+
+    def __init__(self, method="auto"):
+        if method not in ("auto", "regex", "lxml", "bs4"):
+            raise ValueError(f"Unknown index parser method {method}.")
+        if method == "lxml" and etree is None:
+            raise ImportError("The lxml index parser needs the lxml package.")
+        self.method = method
+
+    def get_links(self, page):
+        """
+        Retrieve the links to the entries of a directory index page. Sort links ("?C=N;O=D"), absolute paths,
+        links to other hosts and links that leave the directory, such as "../", are left out.
+        :param page: Content of the index page (bytes).
+        :return:
+        """
+        method = self.method
+        if method == "auto":
+            if self.autoindex_titles.search(page, 0, 4096):
+                method = "regex"
+            elif etree is not None:
+                method = "lxml"
+            else:
+                method = "bs4"
+        if method == "regex":
+            hrefs = self._get_hrefs_regex(page)
+        elif method == "lxml":
+            hrefs = self._get_hrefs_lxml(page)
+        else:
+            hrefs = self._get_hrefs_beautifulsoup(page)
+        links = []
+        for href in hrefs:
+            if not href or href.startswith(("?", "#", "/")) or (":" in href and urllib.parse.urlsplit(href).scheme):
+                continue
+            if href.startswith("./"):
+                # Apache links names with a colon as ./name, so they are not read as a scheme.
+                href = href[2:]
+            if href and not any(segment in (".", "..") for segment in href.split("?")[0].split("/")):
+                links.append(href)
+        return links
+
+    def get_newest_mtime(self, page):
+        """
+        Find the newest modification date shown in the rows of an autoindex page. The dates are to the minute and in
+        the server's time zone, which is close enough to tell settled directories from active ones.
+        :param page: Content of the index page (bytes).
+        :return: Seconds since the epoch, or None for other pages and autoindex pages without dates.
+        """
+        if not self.autoindex_titles.search(page, 0, 4096):
+            return None
+        # Fixed width fields compare as bytes in date order.
+        dates = [match.groups() for match in self.iso_date.finditer(page)]
+        dates += [(year, self.months[month], day, hour, minute)
+                  for day, month, year, hour, minute in self.named_month_date.findall(page)]
+        if not dates:
+            return None
+        return float(calendar.timegm(tuple(int(field) for field in max(dates)) + (0,)))
+
+    def _get_hrefs_regex(self, page):
+        hrefs = []
+        for match in self.anchor_href.finditer(page):
+            href = match.group(1) or match.group(2) or match.group(3) or b""
+            hrefs.append(html.unescape(href.decode("utf-8", "replace")))
+        return hrefs
+
+    @staticmethod
+    def _get_hrefs_lxml(page):
+        tree = etree.fromstring(page, etree.HTMLParser())
+        if tree is None:
+            return []
+        return [str(href) for href in tree.xpath("//a/@href")]
+
+    @staticmethod
+    def _get_hrefs_beautifulsoup(page):
+        return [link['href'] for link in BeautifulSoup(page, "html.parser", parse_only=SoupStrainer('a'))
+                if link.has_attr('href')]
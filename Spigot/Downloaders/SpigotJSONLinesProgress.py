@@ -0,0 +1,78 @@
+"""
+Spigot: progress events as JSON lines.
+"""
+
+import json
+import threading
+import time
+from Downloaders.SpigotProgress import SpigotProgress
+
+
+class SpigotJSONLinesProgress(SpigotProgress):
+    """
+    SpigotJSONLinesProgress writes every progress event to a stream as one JSON object per line, with its name under
+    "event" and a Unix "time", for log shippers and dashboards to pick up. Chunks arrive far too often for a line
+    each, so bytes are summed into a "bytes" event at most every bytes_interval seconds.
+    """
+
+    def __init__(self, stream, bytes_interval=1.0):
+        self.stream = stream
+        self.bytes_interval = float(bytes_interval)
+        self.lock = threading.Lock()
+        self.pending_bytes = 0
+        self.last_bytes_time = time.monotonic()
+
+    def _write(self, event, **fields):
+        """
+        Write one event line. Called with the lock held.
+        :param event:
+        :param fields:
+        :return:
+        """
+        self.stream.write(json.dumps({'time': time.time(), 'event': event, **fields}) + "\n")
+        self.stream.flush()
+
+    def _write_bytes(self):
+        if self.pending_bytes:
+            self._write('bytes', bytes=self.pending_bytes)
+            self.pending_bytes = 0
+        self.last_bytes_time = time.monotonic()
+
+    def download_started(self, name):
+        with self.lock:
+            self._write('download_started', name=name)
+
+    def file_discovered(self, path):
+        with self.lock:
+            self._write('file_discovered', path=path)
+
+    def discovery_finished(self, file_count):
+        with self.lock:
+            self._write('discovery_finished', files=file_count)
+
+    def file_started(self, path, queued):
+        with self.lock:
+            self._write('file_started', path=path, queued=queued)
+
+    def file_bytes(self, path, byte_count):
+        with self.lock:
+            self.pending_bytes += byte_count
+            if time.monotonic() - self.last_bytes_time >= self.bytes_interval:
+                self._write_bytes()
+
+    def file_done(self, path, byte_count, skipped=False):
+        with self.lock:
+            self._write('file_done', path=path, bytes=byte_count, skipped=skipped)
+
+    def file_failed(self, path, error, retry_delay=None):
+        with self.lock:
+            self._write('file_failed', path=path, error=str(error), retry_delay=retry_delay)
+
+    def directory_failed(self, path, error, retry_delay=None):
+        with self.lock:
+            self._write('directory_failed', path=path, error=str(error), retry_delay=retry_delay)
+
+    def download_finished(self, statistics):
+        with self.lock:
+            self._write_bytes()
+            self._write('download_finished', **statistics)
@@ -0,0 +1,111 @@
+"""
+Spigot: on-disk cache of remote directory listings.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SpigotListingCache(object):
+    """
+    SpigotListingCache keeps directory listings in a SQLite file, keyed by instrument, experiment and directory path,
+    so repeated runs against an experiment do not have to list directories that have not changed.
+
+    A listing is reused for ttl seconds. A directory whose newest entry was already older than stable_age when it was
+    listed belongs to an experiment that is most likely closed, so its listing is reused for stable_ttl seconds
+    instead. With the defaults, active directories are always listed again and settled ones are answered from the
+    cache for a month.
+    """
+
+    def __init__(self, cache_path, ttl=0, stable_age=7 * 86400, stable_ttl=30 * 86400, max_entries=200000):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.stable_age = stable_age
+        self.stable_ttl = stable_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        directory = os.path.dirname(cache_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        # The cache can always be rebuilt by listing again, so don't pay for durability.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS listings ("
+                                "instrument TEXT, experiment TEXT, path TEXT, listed_at REAL, newest_mtime REAL, "
+                                "entries TEXT, PRIMARY KEY (instrument, experiment, path))")
+        self.connection.commit()
+
+    def _is_fresh(self, listed_at, newest_mtime, now):
+        age = now - listed_at
+        if age < self.ttl:
+            return True
+        return newest_mtime is not None and listed_at - newest_mtime > self.stable_age and age < self.stable_ttl
+
+    def get(self, instrument, experiment, path):
+        """
+        Return the cached entries for a directory, or None if there are none or they have expired.
+        :param instrument:
+        :param experiment:
+        :param path: Directory path relative to the experiment.
+        :return:
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT listed_at, newest_mtime, entries FROM listings "
+                                          "WHERE instrument=? AND experiment=? AND path=?",
+                                          (instrument, experiment, path)).fetchone()
+        if row is None or not self._is_fresh(row[0], row[1], time.time()):
+            return None
+        return json.loads(row[2])
+
+    def put(self, instrument, experiment, path, entries, newest_mtime=None):
+        """
+        Store the entries of a directory.
+        :param instrument:
+        :param experiment:
+        :param path: Directory path relative to the experiment.
+        :param entries: JSON serializable list of entries.
+        :param newest_mtime: Newest modification time (seconds since the epoch) in the directory, if known.
+        :return:
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)",
+                                    (instrument, experiment, path, time.time(), newest_mtime, json.dumps(entries)))
+            self.connection.commit()
+
+    def invalidate(self, instrument, experiment, path=None):
+        """
+        Forget the listing of one directory, or of a whole experiment if no path is given.
+        :param instrument:
+        :param experiment:
+        :param path:
+        :return:
+        """
+        with self.lock:
+            if path is None:
+                self.connection.execute("DELETE FROM listings WHERE instrument=? AND experiment=?",
+                                        (instrument, experiment))
+            else:
+                self.connection.execute("DELETE FROM listings WHERE instrument=? AND experiment=? AND path=?",
+                                        (instrument, experiment, path))
+            self.connection.commit()
+
+    def evict(self):
+        """
+        Drop listings that can no longer be fresh, then the oldest ones beyond max_entries.
+        :return:
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM listings WHERE listed_at < ?",
+                                    (time.time() - max(self.ttl, self.stable_ttl),))
+            self.connection.execute("DELETE FROM listings WHERE rowid NOT IN "
+                                    "(SELECT rowid FROM listings ORDER BY listed_at DESC LIMIT ?)",
+                                    (self.max_entries,))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,85 @@
+"""
+Spigot: local manifest of downloaded SPICE files.
+"""
+
+import json
+import os
+import threading
+import time
+
+
+class SpigotManifest(object):
+    """
+    SpigotManifest remembers what was downloaded for an experiment (size and HTTP validators per remote file) so that
+    later runs can skip files that have not changed. The same format serves as the transfer journal, which records
+    the transfers that are still in progress so that an interrupted run can resume them.
+
+    A manifest without a manifest_path is only kept in memory, as for downloads into a sink, which leave nothing
+    but the archive behind.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.last_save_time = 0
+        self.load()
+
+    def load(self):
+        """
+        Load the manifest from disk. A missing or unreadable manifest just means nothing is known yet.
+        :return:
+        """
+        self.entries = {}
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            print(f"\nIgnoring unreadable manifest {self.manifest_path}.")
+            self.entries = {}
+
+    def save(self):
+        """
+        Write the manifest to a temporary file and move it into place, so a crash never leaves a truncated manifest.
+        :return:
+        """
+        if not self.manifest_path:
+            return
+        directory = os.path.dirname(self.manifest_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = self.manifest_path + ".tmp"
+        # Workers may save concurrently, and they share the temporary file.
+        with self.lock:
+            with open(temp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(temp_path, self.manifest_path)
+            self.last_save_time = time.time()
+
+    def save_if_due(self, interval=1.0):
+        """
+        Save the manifest if it was last saved more than interval seconds ago.
+        :param interval:
+        :return:
+        """
+        if time.time() - self.last_save_time >= interval:
+            self.save()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def update(self, key, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(key, {})
+            entry.update(fields)
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
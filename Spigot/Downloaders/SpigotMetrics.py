@@ -0,0 +1,166 @@
+"""
+Spigot: transfer counters and histograms.
+"""
+
+import bisect
+import os
+import threading
+import time
+from Downloaders.SpigotProgress import SpigotProgress
+
+COUNTERS = {
+    'files_discovered': "Files found while listing.",
+    'files_started': "File transfers started, including retries.",
+    'files_completed': "Files downloaded completely.",
+    'files_skipped': "Files skipped as unchanged.",
+    'files_failed': "Files given up on.",
+    'directories_failed': "Directory listings given up on.",
+    'retries': "Failed transfers and listings that are tried again.",
+    'bytes': "Bytes transferred, including those of failed tries.",
+}
+
+GAUGES = {
+    'files_queued': "Files waiting for a transfer slot when the last transfer started.",
+    'files_in_flight': "File transfers running.",
+}
+
+HISTOGRAMS = {
+    'file_duration_seconds': ("Time from the start of a transfer to the complete file.",
+                              [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]),
+    'file_throughput_bytes_per_second': ("Transfer rate of each file.",
+                                         [2.0 ** exponent for exponent in range(14, 31, 2)]),
+    'queue_depth': ("Files waiting for a transfer slot, sampled whenever a transfer starts.",
+                    [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096]),
+}
+
+
+class SpigotMetrics(SpigotProgress):
+    """
+    SpigotMetrics counts progress events and keeps histograms of per-file duration and throughput and of the depth
+    of the transfer queue. snapshot() returns them as a dictionary and prometheus_text() in the Prometheus text
+    exposition format. Given a prometheus_path, the text is also written there every interval seconds and at the
+    end of each download, for node_exporter's textfile collector to serve.
+    """
+
+    def __init__(self, labels=None, prometheus_path=None, interval=10.0):
+        self.labels = dict(labels or {})
+        self.prometheus_path = prometheus_path
+        self.interval = float(interval)
+        self.lock = threading.Lock()
+        self.counters = {name: 0 for name in COUNTERS}
+        self.gauges = {name: 0 for name in GAUGES}
+        # Per histogram: count per bucket (the last one unbounded), sum and count of the observations.
+        self.histograms = {name: [[0] * (len(bounds) + 1), 0.0, 0] for name, (_, bounds) in HISTOGRAMS.items()}
+        self.start_times = {}
+        self.last_write = time.monotonic()
+
+    def _observe(self, name, value):
+        buckets, total, count = self.histograms[name]
+        buckets[bisect.bisect_left(HISTOGRAMS[name][1], value)] += 1
+        self.histograms[name][1] = total + value
+        self.histograms[name][2] = count + 1
+
+    def _write_if_due(self, force=False):
+        if self.prometheus_path and (force or time.monotonic() - self.last_write >= self.interval):
+            self.last_write = time.monotonic()
+            self.write_prometheus(self.prometheus_path)
+
+    def file_discovered(self, path):
+        with self.lock:
+            self.counters['files_discovered'] += 1
+
+    def file_started(self, path, queued):
+        with self.lock:
+            self.counters['files_started'] += 1
+            self.start_times[path] = time.monotonic()
+            self.gauges['files_queued'] = queued
+            self.gauges['files_in_flight'] = len(self.start_times)
+            self._observe('queue_depth', queued)
+
+    def file_bytes(self, path, byte_count):
+        with self.lock:
+            self.counters['bytes'] += byte_count
+
+    def file_done(self, path, byte_count, skipped=False):
+        with self.lock:
+            start_time = self.start_times.pop(path, None)
+            self.gauges['files_in_flight'] = len(self.start_times)
+            if skipped:
+                self.counters['files_skipped'] += 1
+            else:
+                self.counters['files_completed'] += 1
+                if start_time is not None:
+                    duration = time.monotonic() - start_time
+                    self._observe('file_duration_seconds', duration)
+                    self._observe('file_throughput_bytes_per_second', byte_count / max(duration, 1e-6))
+        self._write_if_due()
+
+    def file_failed(self, path, error, retry_delay=None):
+        with self.lock:
+            self.start_times.pop(path, None)
+            self.gauges['files_in_flight'] = len(self.start_times)
+            self.counters['files_failed' if retry_delay is None else 'retries'] += 1
+        self._write_if_due()
+
+    def directory_failed(self, path, error, retry_delay=None):
+        with self.lock:
+            self.counters['directories_failed' if retry_delay is None else 'retries'] += 1
+
+    def download_finished(self, statistics):
+        self._write_if_due(force=True)
+
+    def snapshot(self):
+        """
+        Current values of all metrics.
+        :return: Dictionary with 'counters', 'gauges' and 'histograms'; each histogram is a dictionary with the
+        cumulative 'buckets' as (upper bound, count) pairs, and the 'sum' and 'count' of its observations.
+        """
+        with self.lock:
+            histograms = {}
+            for name, (buckets, total, count) in self.histograms.items():
+                cumulative = 0
+                cumulative_buckets = []
+                for bound, bucket_count in zip(HISTOGRAMS[name][1] + [float('inf')], buckets):
+                    cumulative += bucket_count
+                    cumulative_buckets.append((bound, cumulative))
+                histograms[name] = {'buckets': cumulative_buckets, 'sum': total, 'count': count}
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges), 'histograms': histograms}
+
+    def prometheus_text(self):
+        """
+        Render all metrics in the Prometheus text exposition format, with a spigot_ prefix.
+        :return:
+        """
+        snapshot = self.snapshot()
+        label_text = ",".join(f'{key}="{value}"' for key, value in sorted(self.labels.items()))
+
+        def sample(name, value, extra_label=""):
+            labels = ",".join(part for part in (label_text, extra_label) if part)
+            return f"spigot_{name}{{{labels}}} {value}" if labels else f"spigot_{name} {value}"
+
+        lines = []
+        for name, value in snapshot['counters'].items():
+            lines += [f"# HELP spigot_{name}_total {COUNTERS[name]}", f"# TYPE spigot_{name}_total counter",
+                      sample(f"{name}_total", value)]
+        for name, value in snapshot['gauges'].items():
+            lines += [f"# HELP spigot_{name} {GAUGES[name]}", f"# TYPE spigot_{name} gauge", sample(name, value)]
+        for name, histogram in snapshot['histograms'].items():
+            lines += [f"# HELP spigot_{name} {HISTOGRAMS[name][0]}", f"# TYPE spigot_{name} histogram"]
+            for bound, count in histogram['buckets']:
+                lines.append(sample(f"{name}_bucket", count, f'le="{"+Inf" if bound == float("inf") else bound}"'))
+            lines += [sample(f"{name}_sum", histogram['sum']), sample(f"{name}_count", histogram['count'])]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Write prometheus_text() to path, replacing the file in one step so readers never see half of it.
+        :param path:
+        :return:
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary_path, path)
@@ -0,0 +1,75 @@
+"""
+Spigot: progress events of a download.
+"""
+
+
+class SpigotProgress(object):
+    """
+    SpigotProgress receives the progress events of the downloaders. Subclasses override the events they are
+    interested in; this class ignores all of them, so passing it as progress silences a download.
+
+    Paths are local paths. Events arrive from the downloaders' worker threads, so listeners must be thread safe, and
+    they should be quick: file_bytes is sent for every chunk.
+    """
+
+    def download_started(self, name):
+        """
+        A download or verification re-download of an experiment starts.
+        :param name: Description of the experiment.
+        :return:
+        """
+        pass
+
+    def file_discovered(self, path):
+        pass
+
+    def discovery_finished(self, file_count):
+        """
+        All directories of the experiment have been listed.
+        :param file_count: Number of files found.
+        :return:
+        """
+        pass
+
+    def file_started(self, path, queued):
+        """
+        A transfer, or another try of one, starts.
+        :param path:
+        :param queued: Number of files still waiting for a transfer slot.
+        :return:
+        """
+        pass
+
+    def file_bytes(self, path, byte_count):
+        pass
+
+    def file_done(self, path, byte_count, skipped=False):
+        """
+        A file is complete.
+        :param path:
+        :param byte_count: Bytes transferred by the last try, or the size of a skipped file.
+        :param skipped: Whether the file was unchanged and left alone.
+        :return:
+        """
+        pass
+
+    def file_failed(self, path, error, retry_delay=None):
+        """
+        A transfer failed.
+        :param path:
+        :param error:
+        :param retry_delay: Seconds until the next try, or None if the file is given up on.
+        :return:
+        """
+        pass
+
+    def directory_failed(self, path, error, retry_delay=None):
+        pass
+
+    def download_finished(self, statistics):
+        """
+        A download completed without errors.
+        :param statistics: The dictionary of transfer statistics the downloader returns.
+        :return:
+        """
+        pass
@@ -0,0 +1,50 @@
+"""
+Spigot: fan-out of progress events to several listeners.
+"""
+
+from Downloaders.SpigotProgress import SpigotProgress
+
+
+class SpigotProgressGroup(SpigotProgress):
+    """
+    SpigotProgressGroup passes every progress event on to each of its listeners, in order.
+    """
+
+    def __init__(self, listeners):
+        self.listeners = list(listeners)
+
+    def download_started(self, name):
+        for listener in self.listeners:
+            listener.download_started(name)
+
+    def file_discovered(self, path):
+        for listener in self.listeners:
+            listener.file_discovered(path)
+
+    def discovery_finished(self, file_count):
+        for listener in self.listeners:
+            listener.discovery_finished(file_count)
+
+    def file_started(self, path, queued):
+        for listener in self.listeners:
+            listener.file_started(path, queued)
+
+    def file_bytes(self, path, byte_count):
+        for listener in self.listeners:
+            listener.file_bytes(path, byte_count)
+
+    def file_done(self, path, byte_count, skipped=False):
+        for listener in self.listeners:
+            listener.file_done(path, byte_count, skipped)
+
+    def file_failed(self, path, error, retry_delay=None):
+        for listener in self.listeners:
+            listener.file_failed(path, error, retry_delay)
+
+    def directory_failed(self, path, error, retry_delay=None):
+        for listener in self.listeners:
+            listener.directory_failed(path, error, retry_delay)
+
+    def download_finished(self, statistics):
+        for listener in self.listeners:
+            listener.download_finished(statistics)
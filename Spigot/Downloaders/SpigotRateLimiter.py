@@ -0,0 +1,36 @@
+"""
+Spigot: shared bandwidth budget for concurrent transfers.
+"""
+
+import threading
+import time
+
+
+class SpigotRateLimiter(object):
+    """
+    SpigotRateLimiter is a token bucket that any number of transfer threads can draw from, keeping their combined
+    rate under bytes_per_second. A transfer reports what it has just read and sleeps off whatever it overdrew, so
+    threads are throttled in proportion to what they read.
+    """
+
+    def __init__(self, bytes_per_second, burst_bytes=None):
+        self.rate = float(bytes_per_second)
+        self.capacity = float(burst_bytes or bytes_per_second)
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, byte_count):
+        """
+        Account for byte_count bytes just transferred, sleeping if the budget is exhausted.
+        :param byte_count:
+        :return:
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= byte_count
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
@@ -0,0 +1,28 @@
+"""
+Spigot: retry policy with exponential backoff.
+"""
+
+import random
+
+
+class SpigotRetry(object):
+    """
+    SpigotRetry decides whether and when a failed request is tried again. The delay before each retry grows
+    exponentially from base_delay up to max_delay, and a random part of it ("full jitter") keeps transfers that
+    failed together from all retrying at the same moment.
+    """
+
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.max_retries = int(max_retries)
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+
+    def get_delay(self, attempt):
+        """
+        Seconds to wait before the next try.
+        :param attempt: Number of failed tries so far.
+        :return: The delay, or None if no retries are left.
+        """
+        if attempt > self.max_retries:
+            return None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
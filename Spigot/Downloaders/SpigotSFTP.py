@@ -1,280 +1,871 @@
-"""
-Spigot: SPICE data download tool (HTTP).
-"""
-
-
-import sys
-import paramiko
-import os
-import getpass
-import time
-from stat import S_ISDIR
-
-# paramiko.util.log_to_file('E:\\Temp\\paramiko.log')
-
-
-class SpigotSFTP(object):
-    """
-    SpigotSFTP downloads SPICE experiment data via SFTP interface.
-    """
-
-    def __init__(self, instrument, ipts_number, experiment_number, local_path_base,
-                 user=None, host="analysis.sns.gov", remote_path_base="/HFIR", sftp_port=22):
-        self.instrument = instrument
-        # Handle IPTS numbers like 12345.7, 'IPTS-0003', and 'IPTS 00455'.
-        self.ipts_number = int(float(str(ipts_number).upper().replace("IPTS", "").replace("-", "")))
-        self.experiment_number = int(experiment_number)
-        self.local_path_base = local_path_base
-        self.user = user
-        self.host = host
-        self.remote_path_base = remote_path_base
-        self.sftp_port = sftp_port
-        self.all_directories = {}
-        self.all_files = {}
-        self.overwrite_len = 200
-        remote_path_suffix = self.instrument.upper().replace("-", "") + "/" + f"IPTS-{self.ipts_number:04}" + f"/exp{self.experiment_number}"
-        self.remote_path_initial = self.remote_path_base.rstrip("/") + "/" + remote_path_suffix
-        self.local_path_initial = os.path.join(self.local_path_base, remote_path_suffix.replace("/", os.path.sep))
-        self.sftp_client = None
-
-    def _print_overwrite(self, message):
-        print('\r', end='')
-        sys.stdout.flush()
-        print(' ' * self.overwrite_len, end='')
-        sys.stdout.flush()
-        print(f'\r{message}', end='')
-        self.overwrite_len = len(message)
-
-    def _get_local_path_from_remote_path(self, remote_path):
-        new_part_of_path = remote_path.replace(self.remote_path_initial, "").strip("/")
-        local_path = os.path.join(self.local_path_initial, new_part_of_path.replace("/", os.path.sep))
-        return local_path
-
-    def _register_directory(self, remote_directory_path):
-        local_path = self._get_local_path_from_remote_path(remote_directory_path)
-        self.all_directories[remote_directory_path] = local_path
-
-    def _register_file(self, remote_file_path):
-        local_path = self._get_local_path_from_remote_path(remote_file_path)
-        self.all_files[remote_file_path] = local_path
-        self._print_overwrite(f"Found {len(self.all_files)} files so far ...")
-
-    def _assure_local_directory_exists(self, remote_directory_path):
-        directory = self._get_local_path_from_remote_path(remote_directory_path)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
-    def _find_directories_and_files(self, remote_path):
-        folder_paths = []
-        for f in self.sftp_client.listdir_attr(remote_path):
-            if S_ISDIR(f.st_mode):
-                folder_path = remote_path.rstrip("/") + "/" + f.filename
-                self._register_directory(folder_path)
-                folder_paths.append(folder_path)
-            else:
-                file_path = remote_path.rstrip("/") + "/" + f.filename
-                self._register_file(file_path)
-        for folder_path in folder_paths:
-            self._find_directories_and_files(folder_path)
-
-    def _assure_all_local_directories_exist(self):
-        self._assure_local_directory_exists(self.local_path_initial)
-        for remote_path in self.all_directories.keys():
-            self._assure_local_directory_exists(remote_path)
-
-    def download(self, password=None):
-        start_time = time.time()
-        print("\nIdentifying files...")
-        # noinspection PyTypeChecker
-        transport = paramiko.Transport((self.host, self.sftp_port))
-        if not password:
-            password = getpass.getpass(prompt=f"Password for {self.user} on {self.host}: ", stream=sys.stderr)
-        transport.connect(username=self.user, password=password)
-        self.sftp_client = paramiko.SFTPClient.from_transport(transport)
-        self._find_directories_and_files(self.remote_path_initial)
-        print(f"\n\nFound a total of {len(self.all_files)} files.")
-
-        self._assure_all_local_directories_exist()
-
-        print("\nDownloading files...\n")
-        start_download_time = time.time()
-
-        total_bytes = 0
-        file_index = 0
-        file_count = len(self.all_files)
-        progress_status = f"{file_index}/{file_count} = {0:.2f}%, {float(file_count)/100:.2f} seconds remaining (estimated)"
-        file_status = ""
-        self._print_overwrite(f"{progress_status} ----> {file_status}")
-        for remote_path, local_path in self.all_files.items():
-            # Update pre-write status.
-            file_status = f"Writing {local_path}..."
-            self._print_overwrite(f"{progress_status} ----> {file_status}")
-
-            self.sftp_client.get(remote_path, local_path)
-
-            # Update post-write status.
-            file_index += 1
-            total_bytes += os.path.getsize(local_path)
-            elapsed_download_time = time.time() - start_download_time
-            fraction_complete = float(file_index)/file_count
-            if fraction_complete > 0:
-                time_remaining_estimate = elapsed_download_time * (1 - fraction_complete) / fraction_complete
-            else:
-                # No completions yet. So just estimate 60 files/second.
-                time_remaining_estimate = float(file_count)/100
-            progress_status = f"{file_index}/{file_count} = {fraction_complete * 100:.2f}%, " \
-                              f"{time_remaining_estimate:.2f} seconds remaining (estimated)"
-            file_status += "complete."
-            self._print_overwrite(f"{progress_status} ----> {file_status}")
-
-        self.sftp_client.close()
-        elapsed_time = time.time() - start_time
-        mega_bytes = float(total_bytes)/(1024 * 1024)
-        print(f"\n\nDownload complete for Instrument {self.instrument.upper()} IPTS-{self.ipts_number:04} Experiment {self.experiment_number} ("
-              f"{file_count} files, {mega_bytes:.3f} MB, {elapsed_time:.2f} seconds,"
-              f" {mega_bytes/elapsed_time:.3f} MB/sec).")
-
-# class SpigotSFTP(object):
-#     """
-#     SpigotSFTP downloads SPICE experiment data via SFTP interface.
-#     """
-#
-#     def __init__(self, instrument, ipts_number, experiment_number, file_store_base, url_root="http://neutron.ornl.gov/"):
-#         self.instrument = instrument
-#         self.experiment_number = experiment_number
-#         self.file_store_base = file_store_base
-#         self.download_session = FuturesSession(max_workers=20)
-#         self.url_root = url_root
-#         self.all_directory_urls = {}
-#         self.all_file_urls = {}
-#         self.overwrite_len = 200
-#
-#     def _get_file_and_directory_urls_in_html_directories(self, html_directories):
-#         """
-#         Retrieve file and directory urls for the given html directories.
-#         :param html_directories:
-#         :return:
-#         """
-#         # Get directories asynchronously.
-#         async_downloads = {}
-#
-#         for url, file_path in html_directories.items():
-#                 file_request = self.download_session.get(url, stream=True)
-#                 async_downloads[file_request] = {'url': url, 'file_path': file_path}
-#
-#         directory_urls = {}
-#         file_urls = {}
-#
-#         for file_request in cf.as_completed(async_downloads, timeout=500000):
-#             page = file_request.result().content
-#             url_base = async_downloads[file_request]['url']
-#             file_path_base = async_downloads[file_request]['file_path']
-#             for link in BeautifulSoup(page, "html.parser", parse_only=SoupStrainer('a')):
-#                 if link.has_attr('href'):
-#                     filename = link['href']
-#                     if filename.startswith("?") or filename.startswith("/"):
-#                         continue
-#                     url = url_base.rstrip("/") + "/" + filename
-#                     file_path = os.path.join(file_path_base, filename.replace("/", ""))
-#                     if url.endswith("/"):
-#                         self.all_directory_urls[url] = file_path
-#                         directory_urls[url] = file_path
-#                     else:
-#                         self.all_file_urls[url] = file_path
-#                         self._print_overwrite(f"Found {len(self.all_file_urls)} files so far ...")
-#                         file_urls[url] = file_path
-#         return directory_urls, file_urls
-#
-#     def _get_some_directories_and_files_async(self, html_directories):
-#         """
-#         Recursive function to get directories and files for given base url and base path.
-#         :type html_directories: object
-#         """
-#         # noinspection PyTypeChecker
-#         new_directory_urls, new_file_urls = self._get_file_and_directory_urls_in_html_directories(html_directories)
-#         # print(f"Found {len(self.all_file_urls)} files so far ...")
-#         if len(new_directory_urls) > 0:
-#             self._get_some_directories_and_files_async(new_directory_urls)
-#
-#     def _get_directories_and_files_async(self, base_url, local_base_path):
-#         """
-#         Recursive function to get directories and files for given base url and base path.
-#         :param base_url:
-#         :param local_base_path:
-#         :return:
-#         """
-#         self.all_directory_urls = {}
-#         self.all_file_urls = {}
-#         html_directories = {base_url: local_base_path}
-#         self._get_some_directories_and_files_async(html_directories)
-#         print(f"\n\nFound a total of {len(self.all_file_urls)} files.")
-#
-#     def _print_overwrite(self, message):
-#         print('\r', end='')
-#         sys.stdout.flush()
-#         print(' ' * self.overwrite_len, end='')
-#         sys.stdout.flush()
-#         print(f'\r{message}', end='')
-#         self.overwrite_len = len(message)
-#
-#     def download(self):
-#
-#         start_time = time.time()
-#
-#         instrument_path_part = str(self.instrument).replace("-", "").lower()
-#         experiment_path_part = f"exp{int(self.experiment_number)}"
-#         url_base = urllib.parse.urljoin(self.url_root, f"user_data/{instrument_path_part}/{experiment_path_part}")
-#         file_path_base = os.path.join(os.path.join(self.file_store_base, instrument_path_part), experiment_path_part)
-#
-#         print("\nIdentifying files...")
-#         self._get_directories_and_files_async(url_base, file_path_base)
-#         for url, directory_path in self.all_directory_urls.items():
-#             # Create directories if they don't exist.
-#             if not os.path.exists(directory_path):
-#                 os.makedirs(directory_path)
-#
-#         print("\nDownloading files...\n")
-#         start_download_time = time.time()
-#
-#         # Download files asynchronously.
-#         async_downloads = {}
-#
-#         for url, file_path in self.all_file_urls.items():
-#                 file_request = self.download_session.get(url, stream=True)
-#                 async_downloads[file_request] = file_path
-#
-#         total_bytes = 0
-#         file_index = 0
-#         file_count = len(async_downloads)
-#         progress_status = f"{file_index}/{file_count} = {0:.2f}%, {float(file_count)/100:.2f} seconds remaining (estimated)"
-#         file_status = ""
-#         self._print_overwrite(f"{progress_status} ----> {file_status}")
-#         for file_request in cf.as_completed(async_downloads, timeout=500000):
-#             response = file_request.result()
-#             file_path = async_downloads[file_request]
-#             file_status = f"Writing {file_path}..."
-#             self._print_overwrite(f"{progress_status} ----> {file_status}")
-#             with open(file_path, 'wb') as f:
-#                 for chunk in response.iter_content(chunk_size=8192):
-#                     # filter out keep-alive new chunks
-#                     if chunk:
-#                         f.write(chunk)
-#                         f.flush()
-#                         total_bytes += len(chunk)
-#             file_index += 1
-#             elapsed_download_time = time.time() - start_download_time
-#             fraction_complete = float(file_index)/file_count
-#             if fraction_complete > 0:
-#                 time_remaining_estimate = elapsed_download_time * (1 - fraction_complete) / fraction_complete
-#             else:
-#                 # No completions yet. So just estimate 60 files/second.
-#                 time_remaining_estimate = float(file_count)/100
-#             progress_status = f"{file_index}/{file_count} = {fraction_complete * 100:.2f}%, " \
-#                               f"{time_remaining_estimate:.2f} seconds remaining (estimated)"
-#             file_status += "complete."
-#             self._print_overwrite(f"{progress_status} ----> {file_status}")
-#         elapsed_time = time.time() - start_time
-#         mega_bytes = float(total_bytes)/1000000
-#         print(f"\n\nDownload complete for Instrument {self.instrument} Experiment {self.experiment_number} ("
-#               f"{file_count} files, {mega_bytes:.3f} MB, {elapsed_time:.2f} seconds,"
-#               f" {mega_bytes/elapsed_time:.3f} MB/sec).")
+"""
+Spigot: SPICE data download tool (HTTP).
+"""
+
+
+import sys
+import paramiko
+import os
+import getpass
+import queue
+import threading
+import time
+from functools import partial
+from stat import S_ISDIR
+from Downloaders.SpigotConcurrency import SpigotConcurrency
+from Downloaders.SpigotFileIndex import SpigotFileIndex
+from Downloaders.SpigotFilter import SpigotFilter
+from Downloaders.SpigotListingCache import SpigotListingCache
+from Downloaders.SpigotManifest import SpigotManifest
+from Downloaders.SpigotMetrics import SpigotMetrics
+from Downloaders.SpigotProgressGroup import SpigotProgressGroup
+from Downloaders.SpigotRetry import SpigotRetry
+from Downloaders.SpigotTerminalProgress import SpigotTerminalProgress
+from Downloaders.SpigotVerifier import SpigotVerifier, new_hash
+
+# paramiko.util.log_to_file('E:\\Temp\\paramiko.log')
+
+
+class SpigotSFTP(object):
+    """
+    SpigotSFTP downloads SPICE experiment data via SFTP interface.
+    """
+
+    def __init__(self, instrument, ipts_number, experiment_number, local_path_base,
+                 user=None, host="analysis.sns.gov", remote_path_base="/HFIR", sftp_port=22, max_workers=4,
+                 max_list_workers=4, listing_cache=True, rate_limiter=None, checksum="sha256", retry=None,
+                 concurrency=None, timeout=60.0, progress=None, metrics=None, file_filter=None, listing_ttl=0):
+        self.instrument = instrument
+        # Handle IPTS numbers like 12345.7, 'IPTS-0003', and 'IPTS 00455'.
+        self.ipts_number = int(float(str(ipts_number).upper().replace("IPTS", "").replace("-", "")))
+        self.experiment_number = int(experiment_number)
+        self.local_path_base = local_path_base
+        self.user = user
+        self.host = host
+        self.remote_path_base = remote_path_base
+        self.sftp_port = sftp_port
+        # Number of SFTP channels used to download files and to list directories concurrently. How many of the
+        # download channels are busy at a time is up to the concurrency controller.
+        self.max_workers = max(1, int(max_workers))
+        self.max_list_workers = max(1, int(max_list_workers))
+        self.concurrency = concurrency or SpigotConcurrency(initial=max(1, self.max_workers // 2),
+                                                            maximum=self.max_workers)
+        # Failed listings and downloads are tried again with backoff, and a channel that sees no reply for timeout
+        # seconds counts as failed.
+        self.retry = retry or SpigotRetry()
+        self.timeout = timeout
+        # True for the default cache under local_path_base, a SpigotListingCache to share one, or None to disable.
+        # SFTP listings carry modification times, so by default (listing_ttl 0) only settled directories are reused.
+        self.listing_cache = listing_cache
+        self.listing_ttl = listing_ttl
+        self.rate_limiter = rate_limiter
+        # Files are hashed with this hashlib algorithm as they are read (None to skip).
+        self.checksum = checksum
+        # Incremental downloads only fetch what was appended to a grown file, starting this many bytes early so the
+        # overlap can be checked against the local copy.
+        self.append_overlap = 1024
+        # Only the directories and files file_filter, a SpigotFilter, wants are listed and downloaded.
+        self.file_filter = file_filter or SpigotFilter()
+        # Progress events go to metrics, a SpigotMetrics that may be shared between downloaders, and to progress, a
+        # SpigotProgress listener (default: a status line on the terminal).
+        self.metrics = metrics or SpigotMetrics()
+        self.progress = SpigotProgressGroup([self.metrics, progress or SpigotTerminalProgress()])
+        remote_path_suffix = self.instrument.upper().replace("-", "") + "/" + f"IPTS-{self.ipts_number:04}" + f"/exp{self.experiment_number}"
+        self.remote_path_initial = self.remote_path_base.rstrip("/") + "/" + remote_path_suffix
+        self.local_path_initial = os.path.join(self.local_path_base, remote_path_suffix.replace("/", os.path.sep))
+        # Files and directories found by the current download, with their listed sizes and modification times.
+        self.file_index = SpigotFileIndex(self.remote_path_initial, self.local_path_initial)
+        self.progress_lock = threading.Lock()
+        self.file_count = 0
+        self.total_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.start_download_time = 0
+        self.discovery_time = 0
+        self.download_errors = []
+        self.pending_directories = 0
+        self.journal = None
+        self.manifest = None
+        # SpigotSink the current download streams into, if any.
+        self.sink = None
+
+    def _get_relative_path(self, remote_path):
+        return remote_path[len(self.remote_path_initial):].strip("/")
+
+    def _get_local_path_from_remote_path(self, remote_path):
+        new_part_of_path = remote_path.replace(self.remote_path_initial, "").strip("/")
+        local_path = os.path.join(self.local_path_initial, new_part_of_path.replace("/", os.path.sep))
+        return local_path
+
+    @property
+    def all_files(self):
+        """
+        Remote path -> local path of the files found, as a SpigotFileIndex.
+        :return:
+        """
+        return self.file_index
+
+    @property
+    def all_directories(self):
+        return dict(self.file_index.directories())
+
+    def _register_directory(self, remote_directory_path):
+        with self.progress_lock:
+            self.file_index.add_directory(remote_directory_path)
+
+    def _register_file(self, remote_file_path, size=-1, mtime=-1):
+        with self.progress_lock:
+            local_path = self.file_index.add_file(remote_file_path, size, mtime)
+            self.file_count = len(self.file_index)
+        self.progress.file_discovered(local_path)
+        return local_path
+
+    def _assure_local_directory_exists(self, remote_directory_path):
+        directory = self._get_local_path_from_remote_path(remote_directory_path)
+        if not self.sink and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def _list_directory(self, sftp_client, remote_path, directory_queue, file_queue):
+        """
+        List one remote directory. Subdirectories go back on the directory queue for any walker to pick up, files go
+        straight to the download workers.
+        :param sftp_client:
+        :param remote_path:
+        :param directory_queue:
+        :param file_queue:
+        :return:
+        """
+        entries = self._get_directory_entries(sftp_client, remote_path)
+        for filename, is_directory, size, mtime in entries:
+            if is_directory:
+                folder_path = remote_path.rstrip("/") + "/" + filename
+                if not self.file_filter.wants_directory(self._get_relative_path(folder_path)):
+                    continue
+                self._register_directory(folder_path)
+                # Create the local directory before any of its files can be queued.
+                self._assure_local_directory_exists(folder_path)
+                with self.progress_lock:
+                    self.pending_directories += 1
+                directory_queue.put(folder_path)
+            else:
+                file_path = remote_path.rstrip("/") + "/" + filename
+                if not self.file_filter.wants_file(self._get_relative_path(file_path)):
+                    continue
+                local_path = self._register_file(file_path, size, mtime)
+                file_queue.put((file_path, local_path, size, mtime))
+
+    def _get_directory_entries(self, sftp_client, remote_path):
+        """
+        List a remote directory as (name, is_directory, size, mtime) entries, answering from the listing cache when
+        it has a fresh copy.
+        :param sftp_client:
+        :param remote_path:
+        :return:
+        """
+        entries = self._get_cached_entries(remote_path)
+        if entries is None:
+            entries = [(f.filename, S_ISDIR(f.st_mode), f.st_size, f.st_mtime)
+                       for f in sftp_client.listdir_attr(remote_path)]
+            self._cache_entries(remote_path, entries)
+        return entries
+
+    def _get_cache_key(self, remote_path):
+        experiment_key = f"IPTS-{self.ipts_number:04}/exp{self.experiment_number}"
+        return self.instrument.upper().replace("-", ""), experiment_key, self._get_relative_path(remote_path)
+
+    def _get_cached_entries(self, remote_path):
+        if not self.listing_cache:
+            return None
+        return self.listing_cache.get(*self._get_cache_key(remote_path))
+
+    def _cache_entries(self, remote_path, entries):
+        if self.listing_cache:
+            newest_mtime = max((entry[3] for entry in entries), default=None)
+            self.listing_cache.put(*self._get_cache_key(remote_path), entries, newest_mtime)
+
+    def _list_worker(self, transport, directory_queue, file_queue):
+        """
+        Walk the remote tree breadth-first over a dedicated SFTP channel until a None sentinel arrives.
+        The walker that finishes the last pending directory tells all walkers to stop.
+        :param transport:
+        :param directory_queue:
+        :param file_queue:
+        :return:
+        """
+        sftp_client = None
+        try:
+            while True:
+                remote_path = directory_queue.get()
+                if remote_path is None:
+                    break
+                attempt = 0
+                try:
+                    while True:
+                        try:
+                            sftp_client = sftp_client or self._open_sftp_client(transport)
+                            self._list_directory(sftp_client, remote_path, directory_queue, file_queue)
+                            break
+                        except (IOError, paramiko.SSHException) as e:
+                            attempt += 1
+                            sftp_client = self._drop_closed_sftp_client(sftp_client)
+                            if not self._wait_to_retry(attempt, remote_path, e):
+                                break
+                finally:
+                    with self.progress_lock:
+                        self.pending_directories -= 1
+                        walk_complete = self.pending_directories == 0
+                    if walk_complete:
+                        for _ in range(self.max_list_workers):
+                            directory_queue.put(None)
+        finally:
+            if sftp_client:
+                sftp_client.close()
+
+    def _download_file(self, sftp_client, remote_path, local_path, size, mtime, incremental=False):
+        """
+        Download one file into a .part file and move it into place once complete. If the journal shows an earlier
+        attempt at the same remote file (same size and modification time), continue from the end of its .part file.
+        :param sftp_client:
+        :param remote_path:
+        :param local_path:
+        :param size: Remote size from the directory listing.
+        :param mtime: Remote modification time from the directory listing.
+        :param incremental: Leave files alone that are unchanged since the last download, using the manifest, and
+                            only fetch the tail of files that grew.
+        :return: ('skipped', size), ('written', size) or ('short', size) if the transfer ended before the listed
+                 size.
+        """
+        if self.sink:
+            return self._download_to_sink(sftp_client, remote_path, local_path, size, mtime)
+        part_path = local_path + ".part"
+        if incremental:
+            entry = self.manifest.get(remote_path)
+            if entry and os.path.exists(local_path) and os.path.getsize(local_path) == entry.get('size'):
+                if entry['size'] == size and entry.get('mtime') == mtime:
+                    if self.journal.get(remote_path):
+                        self.journal.remove(remote_path)
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                    return 'skipped', size
+                if 0 < entry['size'] < size:
+                    result = self._append_file(sftp_client, remote_path, local_path, entry['size'], size, mtime)
+                    if result:
+                        return result
+
+        entry = self.journal.get(remote_path)
+        offset = 0
+        if entry and entry.get('size') == size and entry.get('mtime') == mtime and os.path.exists(part_path):
+            offset = min(os.path.getsize(part_path), size)
+        else:
+            self.journal.update(remote_path, size=size, mtime=mtime)
+            self.journal.save_if_due()
+
+        hasher = new_hash(self.checksum, part_path, offset) if self.checksum else None
+        request_time = time.monotonic()
+        with sftp_client.open(remote_path, 'rb') as remote_file, open(part_path, 'r+b' if offset else 'wb') as f:
+            self.concurrency.record_latency(time.monotonic() - request_time)
+            if offset:
+                f.seek(offset)
+                f.truncate()
+                remote_file.seek(offset)
+            file_bytes = self._copy_remote_file(remote_file, partial(self._write_chunk, f, hasher), local_path, size)
+        complete = self._complete_file(remote_path, local_path, offset + file_bytes, size, mtime, hasher)
+        return 'written' if complete else 'short', file_bytes
+
+    def _append_file(self, sftp_client, remote_path, local_path, old_size, size, mtime):
+        """
+        Fetch only what was appended to a file that grew since the last download, writing it straight onto the
+        local copy. The append starts append_overlap bytes early, and if those differ from the local copy the file
+        changed rather than grew. A failed append is cut off again, leaving the local copy as it was.
+        :param sftp_client:
+        :param remote_path:
+        :param local_path:
+        :param old_size: Size of the local copy, as recorded in the manifest.
+        :param size: Remote size from the directory listing.
+        :param mtime: Remote modification time from the directory listing.
+        :return: ('written', size) or ('short', size) as _download_file, or None if the file needs downloading in
+                 full.
+        """
+        overlap = min(self.append_overlap, old_size)
+        request_time = time.monotonic()
+        with sftp_client.open(remote_path, 'rb') as remote_file, open(local_path, 'r+b') as f:
+            self.concurrency.record_latency(time.monotonic() - request_time)
+            remote_file.seek(old_size - overlap)
+            remote_bytes = remote_file.read(overlap)
+            with self.progress_lock:
+                self.total_bytes += len(remote_bytes)
+            self.progress.file_bytes(local_path, len(remote_bytes))
+            f.seek(old_size - overlap)
+            if f.read(overlap) != remote_bytes:
+                return None
+            hasher = new_hash(self.checksum, local_path, old_size) if self.checksum else None
+            try:
+                file_bytes = self._copy_remote_file(remote_file, partial(self._write_chunk, f, hasher), local_path,
+                                                    size)
+            except BaseException:
+                f.truncate(old_size)
+                raise
+            if old_size + file_bytes < size:
+                f.truncate(old_size)
+                return 'short', len(remote_bytes) + file_bytes
+        fields = {'size': old_size + file_bytes, 'mtime': mtime}
+        if hasher:
+            fields[self.checksum] = hasher.hexdigest()
+        self.manifest.update(remote_path, **fields)
+        self.manifest.save_if_due(10.0)
+        return 'written', len(remote_bytes) + file_bytes
+
+    def _download_to_sink(self, sftp_client, remote_path, local_path, size, mtime):
+        """
+        Download one file into the sink, as it was listed: a file that grows meanwhile is cut off at the listed size.
+        :param sftp_client:
+        :param remote_path:
+        :param local_path: Local path the file would have, which names it in the sink.
+        :param size: Remote size from the directory listing.
+        :param mtime: Remote modification time from the directory listing.
+        :return: ('written', size) or ('short', size) as _download_file.
+        """
+        name = os.path.relpath(local_path, self.local_path_base).replace(os.path.sep, "/")
+        self.sink.begin_file(name, size, mtime)
+        try:
+            request_time = time.monotonic()
+            with sftp_client.open(remote_path, 'rb') as remote_file:
+                self.concurrency.record_latency(time.monotonic() - request_time)
+                file_bytes = self._copy_remote_file(remote_file, partial(self.sink.write_file, name), local_path,
+                                                    size, limit=size)
+        except BaseException:
+            self.sink.abort_file(name)
+            raise
+        if file_bytes < size:
+            self.sink.abort_file(name)
+            return 'short', file_bytes
+        self.sink.finish_file(name)
+        return 'written', file_bytes
+
+    @staticmethod
+    def _write_chunk(f, hasher, chunk):
+        f.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+
+    def _copy_remote_file(self, remote_file, write, local_path, size, limit=None):
+        """
+        Copy a remote file from its current position to the end, or at most limit bytes of it.
+        :param remote_file:
+        :param write: Function to pass each chunk to.
+        :param local_path:
+        :param size: Remote size from the directory listing.
+        :param limit:
+        :return: Number of bytes copied.
+        """
+        # Pipeline the reads instead of waiting on one round trip per block.
+        remote_file.prefetch(size)
+        file_bytes = 0
+        while limit is None or file_bytes < limit:
+            data = remote_file.read(32768 if limit is None else min(32768, limit - file_bytes))
+            if not data:
+                break
+            write(data)
+            file_bytes += len(data)
+            # Bytes of a failed attempt count too; the retry continues after them.
+            with self.progress_lock:
+                self.total_bytes += len(data)
+            self.concurrency.record_bytes(len(data))
+            self.progress.file_bytes(local_path, len(data))
+            if self.rate_limiter:
+                self.rate_limiter.consume(len(data))
+        return file_bytes
+
+    def _complete_file(self, remote_path, local_path, file_size, size, mtime, hasher):
+        """
+        Check a finished .part file against the listed size, move it into place and record it in the manifest.
+        A file that grew since it was listed is kept whole; one that came up short stays in the journal, so the next
+        attempt continues it.
+        :param remote_path:
+        :param local_path:
+        :param file_size: Size of the .part file.
+        :param size: Remote size from the directory listing.
+        :param mtime: Remote modification time from the directory listing.
+        :param hasher: Hash of the file, or None.
+        :return: Whether the file is complete.
+        """
+        if file_size < size:
+            return False
+        os.replace(local_path + ".part", local_path)
+        fields = {'size': file_size, 'mtime': mtime}
+        if hasher:
+            fields[self.checksum] = hasher.hexdigest()
+        self.manifest.update(remote_path, **fields)
+        self.journal.remove(remote_path)
+        self.journal.save_if_due()
+        self.manifest.save_if_due(10.0)
+        return True
+
+    def _download_worker(self, transport, file_queue, incremental=False):
+        """
+        Download files taken from the queue over a dedicated SFTP channel until a None sentinel arrives.
+        :param transport:
+        :param file_queue:
+        :param incremental:
+        :return:
+        """
+        sftp_client = None
+        try:
+            while True:
+                item = file_queue.get()
+                if item is None:
+                    break
+                remote_path, local_path, size, mtime = item
+                attempt = 0
+                while True:
+                    try:
+                        sftp_client = sftp_client or self._open_sftp_client(transport)
+                        self.concurrency.acquire()
+                        try:
+                            self.progress.file_started(local_path, file_queue.qsize())
+                            result, file_bytes = self._download_file(sftp_client, remote_path, local_path, size,
+                                                                     mtime, incremental)
+                        finally:
+                            self.concurrency.release()
+                        if result != 'short':
+                            if result == 'skipped':
+                                with self.progress_lock:
+                                    self.skipped_files += 1
+                                    self.skipped_bytes += file_bytes
+                            self.progress.file_done(local_path, file_bytes, skipped=result == 'skipped')
+                            break
+                        # What did arrive is kept, so the retry continues from there.
+                        error = IOError(f"Transfer ended before the listed {size} bytes.")
+                    except (IOError, paramiko.SSHException) as e:
+                        error = e
+                        sftp_client = self._drop_closed_sftp_client(sftp_client)
+                    attempt += 1
+                    if not self._wait_to_retry(attempt, remote_path, error, local_path):
+                        break
+        finally:
+            if sftp_client:
+                sftp_client.close()
+
+    def _open_sftp_client(self, transport):
+        sftp_client = paramiko.SFTPClient.from_transport(transport)
+        sftp_client.get_channel().settimeout(self.timeout)
+        return sftp_client
+
+    @staticmethod
+    def _drop_closed_sftp_client(sftp_client):
+        """
+        Close the SFTP client if its channel broke, so the next attempt opens a new one.
+        :param sftp_client:
+        :return: The client if it is still usable, None otherwise.
+        """
+        if sftp_client is None or not sftp_client.get_channel().closed:
+            return sftp_client
+        sftp_client.close()
+        return None
+
+    def _wait_to_retry(self, attempt, remote_path, error, local_path=None):
+        """
+        Back off after a failed listing or download. Errors that another try cannot fix, and failures that are out
+        of retries, are recorded in download_errors.
+        :param attempt: Number of failed tries so far.
+        :param remote_path:
+        :param error:
+        :param local_path: Local path of a file, or None for a directory listing.
+        :return: Whether to try again.
+        """
+        delay = None
+        if not isinstance(error, (FileNotFoundError, PermissionError)):
+            self.concurrency.record_error()
+            delay = self.retry.get_delay(attempt)
+        if local_path is None:
+            self.progress.directory_failed(self._get_local_path_from_remote_path(remote_path), error, delay)
+        else:
+            self.progress.file_failed(local_path, error, delay)
+        if delay is None:
+            with self.progress_lock:
+                self.download_errors.append((remote_path, error))
+            return False
+        time.sleep(delay)
+        return True
+
+    def verify(self, password=None, transport=None, max_workers=None, redownload=True):
+        """
+        Check the local copy of the experiment against the manifest: every file must exist with the recorded size
+        and, where one was recorded, checksum. Files are hashed in parallel by a process pool. Bad files are dropped
+        from the manifest and, with redownload, downloaded again.
+        :param password: Password for the SFTP user, if files need downloading. Prompted for if not given.
+        :param transport: Authenticated transport to use instead of connecting; it is left open.
+        :param max_workers: Number of hashing processes (default: one per core).
+        :param redownload:
+        :return: List of (remote path, reason) for the files that failed verification.
+        """
+        start_time = time.time()
+        files = self._get_manifest_files()
+        print(f"\nVerifying {len(files)} files...")
+        bad_files = SpigotVerifier(self.checksum, max_workers).verify(files)
+        for remote_path, reason in bad_files:
+            print(f"{files[remote_path][0]}: {reason}")
+            self.manifest.remove(remote_path)
+        self.manifest.save()
+        print(f"\n{len(files) - len(bad_files)}/{len(files)} files verified in {time.time() - start_time:.2f} seconds.")
+        if not bad_files or not redownload:
+            return bad_files
+
+        own_transport = transport is None
+        if own_transport:
+            transport = self.connect(password)
+        self._prepare_download()
+        self.pending_directories = 0
+        file_queue = queue.Queue()
+        sftp_client = self._open_sftp_client(transport)
+        try:
+            for remote_path, _ in bad_files:
+                # Fresh attributes, since the remote file may have changed too.
+                try:
+                    attributes = sftp_client.stat(remote_path)
+                except IOError as e:
+                    self.download_errors.append((remote_path, e))
+                    continue
+                local_path = self._register_file(remote_path, attributes.st_size, attributes.st_mtime)
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                file_queue.put((remote_path, local_path, attributes.st_size, attributes.st_mtime))
+        finally:
+            sftp_client.close()
+        self.progress.discovery_finished(len(self.file_index))
+        workers = [threading.Thread(target=self._download_worker, args=(transport, file_queue), daemon=True)
+                   for _ in range(self.max_workers)]
+        for worker in workers:
+            file_queue.put(None)
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if own_transport:
+            transport.close()
+        self._finish_download(start_time)
+        return bad_files
+
+    def connect(self, password=None):
+        """
+        Open and authenticate an SSH transport to the host. One transport can serve several downloads.
+        :param password: Password for the SFTP user. Prompted for if not given.
+        :return:
+        """
+        # noinspection PyTypeChecker
+        transport = paramiko.Transport((self.host, self.sftp_port))
+        if not password:
+            password = getpass.getpass(prompt=f"Password for {self.user} on {self.host}: ", stream=sys.stderr)
+        transport.connect(username=self.user, password=password)
+        return transport
+
+    def download(self, password=None, transport=None, incremental=False, sink=None):
+        """
+        Download all files of the experiment.
+        :param password: Password for the SFTP user. Prompted for if not given.
+        :param transport: Authenticated transport to use instead of connecting; it is left open.
+        :param incremental: Only fetch files that are new or changed since the last download, using the manifest.
+                            Of files that grew, only the appended tail is fetched.
+        :param sink: SpigotSink to stream the files into instead of writing them under local_path_base. The sink is
+                     left open. Nothing is written under local_path_base: manifest and journal are not used, so
+                     this always downloads everything, and the default listing cache is not opened.
+        :return: Dictionary of transfer statistics.
+        """
+        if sink and incremental:
+            raise ValueError("Downloads into a sink cannot be incremental.")
+        start_time = time.time()
+        own_transport = transport is None
+        if own_transport:
+            transport = self.connect(password)
+        listing_cache = self.listing_cache
+        if sink and listing_cache is True:
+            self.listing_cache = None
+        self.sink = sink
+        try:
+            return self._download_tree(transport, own_transport, start_time, incremental)
+        finally:
+            self.sink = None
+            if sink:
+                self.listing_cache = listing_cache
+
+    def _download_tree(self, transport, own_transport, start_time, incremental):
+        self._prepare_download()
+
+        # Walkers list directories on their own SFTP channels and hand files straight to the download workers, which
+        # each have a channel too, so transfers start as soon as the first directory has been listed. The bounded
+        # file queue throttles the walkers if downloading falls behind.
+        directory_queue = queue.Queue()
+        directory_queue.put(self.remote_path_initial)
+        file_queue = queue.Queue(maxsize=self.max_workers * 2)
+        walkers = [threading.Thread(target=self._list_worker, args=(transport, directory_queue, file_queue),
+                                    daemon=True)
+                   for _ in range(self.max_list_workers)]
+        workers = [threading.Thread(target=self._download_worker, args=(transport, file_queue, incremental),
+                                    daemon=True)
+                   for _ in range(self.max_workers)]
+        for thread in walkers + workers:
+            thread.start()
+        for walker in walkers:
+            walker.join()
+        self.discovery_time = time.time() - self.start_download_time
+        self.progress.discovery_finished(len(self.file_index))
+        for _ in workers:
+            file_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+        if own_transport:
+            transport.close()
+        return self._finish_download(start_time, incremental)
+
+    def follow(self, password=None, transport=None, interval=30.0, polls=None):
+        """
+        Keep up with a running experiment: download incrementally every interval seconds over one connection, so
+        new files are fetched and files that grew only send what was appended. Listings are not cached meanwhile,
+        since they go stale between polls. A poll that fails is reported and the next one tries again.
+        :param password: Password for the SFTP user. Prompted for if not given.
+        :param transport: Authenticated transport to use instead of connecting; it is left open.
+        :param interval: Seconds from the start of one poll to the start of the next.
+        :param polls: Number of polls, or None to follow until interrupted.
+        :return: List of the statistics of each poll, None for the polls that failed.
+        """
+        own_transport = transport is None
+        if own_transport:
+            transport = self.connect(password)
+        listing_cache = self.listing_cache
+        self.listing_cache = None
+        results = []
+        try:
+            while polls is None or len(results) < polls:
+                start_time = time.monotonic()
+                try:
+                    results.append(self.download(transport=transport, incremental=True))
+                except IOError as e:
+                    print(f"\n\nPoll failed, trying again in {interval} seconds: {e}")
+                    results.append(None)
+                if polls is None or len(results) < polls:
+                    time.sleep(max(0.0, interval - (time.monotonic() - start_time)))
+        finally:
+            self.listing_cache = listing_cache
+            if own_transport:
+                transport.close()
+        return results
+
+    def _get_manifest_files(self):
+        """
+        Open the manifest and map the entries that the file filter wants to local paths.
+        :return: Dictionary of remote path -> (local path, manifest entry).
+        """
+        self._open_manifest()
+        return {remote_path: (self._get_local_path_from_remote_path(remote_path), entry)
+                for remote_path, entry in self.manifest.items()
+                if self.file_filter.wants_file(self._get_relative_path(remote_path))}
+
+    def _open_manifest(self):
+        """
+        Open the manifest and journal of the experiment. Downloads into a sink keep them in memory only.
+        :return:
+        """
+        name = f"{self.instrument.upper().replace('-', '')}_IPTS-{self.ipts_number:04}_exp{self.experiment_number}"
+        manifest_path = journal_path = None
+        if not self.sink:
+            manifest_path = os.path.join(self.local_path_base, ".spigot", f"{name}.json")
+            journal_path = os.path.join(self.local_path_base, ".spigot", f"{name}.journal.json")
+        self.manifest = SpigotManifest(manifest_path)
+        self.journal = SpigotManifest(journal_path)
+
+    def _prepare_download(self):
+        """
+        Open the manifest, journal and listing cache of the experiment, reset the progress state and create the
+        local experiment directory.
+        :return:
+        """
+        self._open_manifest()
+        if self.listing_cache is True:
+            self.listing_cache = SpigotListingCache(os.path.join(self.local_path_base, ".spigot", "listings.sqlite"),
+                                                    ttl=self.listing_ttl)
+
+        print("\nIdentifying and downloading files...\n")
+        self.start_download_time = time.time()
+        self.file_index = SpigotFileIndex(self.remote_path_initial, self.local_path_initial)
+        self.total_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.file_count = 0
+        self.download_errors = []
+        self.pending_directories = 1
+        self.progress.download_started(f"{self.instrument.upper()} IPTS-{self.ipts_number:04} "
+                                       f"Experiment {self.experiment_number}")
+        self._assure_local_directory_exists(self.remote_path_initial)
+
+    def _finish_download(self, start_time, incremental=False):
+        """
+        Save the journal, raise the first error if any file failed and print the download summary.
+        :param start_time:
+        :param incremental:
+        :return: Dictionary of transfer statistics.
+        """
+        self.journal.save()
+        self.manifest.save()
+        if self.listing_cache:
+            self.listing_cache.evict()
+        if self.download_errors:
+            remote_path, error = self.download_errors[0]
+            print(f"\n\nFailed to download {len(self.download_errors)} files.")
+            raise IOError(f"Failed to download {remote_path}: {error}")
+
+        elapsed_time = time.time() - start_time
+        statistics = {'files': self.file_count, 'bytes': self.total_bytes, 'skipped_files': self.skipped_files,
+                      'skipped_bytes': self.skipped_bytes, 'elapsed': elapsed_time,
+                      'discovery_time': self.discovery_time}
+        self.progress.download_finished(statistics)
+        mega_bytes = float(self.total_bytes)/(1024 * 1024)
+        print(f"\n\nDownload complete for Instrument {self.instrument.upper()} IPTS-{self.ipts_number:04} Experiment {self.experiment_number} ("
+              f"{self.file_count} files, {mega_bytes:.3f} MB, {elapsed_time:.2f} seconds,"
+              f" {mega_bytes/elapsed_time:.3f} MB/sec).")
+        if incremental:
+            print(f"Skipped {self.skipped_files} unchanged files ({float(self.skipped_bytes)/(1024 * 1024):.3f} MB).")
+        return statistics
+
+# class SpigotSFTP(object):
+#     """
+#     SpigotSFTP downloads SPICE experiment data via SFTP interface.
+#     """
+#
+#     def __init__(self, instrument, ipts_number, experiment_number, file_store_base, url_root="http://neutron.ornl.gov/"):
+#         self.instrument = instrument
+#         self.experiment_number = experiment_number
+#         self.file_store_base = file_store_base
+#         self.download_session = FuturesSession(max_workers=20)
+#         self.url_root = url_root
+#         self.all_directory_urls = {}
+#         self.all_file_urls = {}
+#         self.overwrite_len = 200
+#
+#     def _get_file_and_directory_urls_in_html_directories(self, html_directories):
+#         """
+#         Retrieve file and directory urls for the given html directories.
+#         :param html_directories:
+#         :return:
+#         """
+#         # Get directories asynchronously.
+#         async_downloads = {}
+#
+#         for url, file_path in html_directories.items():
+#                 file_request = self.download_session.get(url, stream=True)
+#                 async_downloads[file_request] = {'url': url, 'file_path': file_path}
+#
+#         directory_urls = {}
+#         file_urls = {}
+#
+#         for file_request in cf.as_completed(async_downloads, timeout=500000):
+#             page = file_request.result().content
+#             url_base = async_downloads[file_request]['url']
+#             file_path_base = async_downloads[file_request]['file_path']
+#             for link in BeautifulSoup(page, "html.parser", parse_only=SoupStrainer('a')):
+#                 if link.has_attr('href'):
+#                     filename = link['href']
+#                     if filename.startswith("?") or filename.startswith("/"):
+#                         continue
+#                     url = url_base.rstrip("/") + "/" + filename
+#                     file_path = os.path.join(file_path_base, filename.replace("/", ""))
+#                     if url.endswith("/"):
+#                         self.all_directory_urls[url] = file_path
+#                         directory_urls[url] = file_path
+#                     else:
+#                         self.all_file_urls[url] = file_path
+#                         self._print_overwrite(f"Found {len(self.all_file_urls)} files so far ...")
+#                         file_urls[url] = file_path
+#         return directory_urls, file_urls
+#
+#     def _get_some_directories_and_files_async(self, html_directories):
+#         """
+#         Recursive function to get directories and files for given base url and base path.
+#         :type html_directories: object
+#         """
+#         # noinspection PyTypeChecker
+#         new_directory_urls, new_file_urls = self._get_file_and_directory_urls_in_html_directories(html_directories)
+#         # print(f"Found {len(self.all_file_urls)} files so far ...")
+#         if len(new_directory_urls) > 0:
+#             self._get_some_directories_and_files_async(new_directory_urls)
+#
+#     def _get_directories_and_files_async(self, base_url, local_base_path):
+#         """
+#         Recursive function to get directories and files for given base url and base path.
+#         :param base_url:
+#         :param local_base_path:
+#         :return:
+#         """
+#         self.all_directory_urls = {}
+#         self.all_file_urls = {}
+#         html_directories = {base_url: local_base_path}
+#         self._get_some_directories_and_files_async(html_directories)
+#         print(f"\n\nFound a total of {len(self.all_file_urls)} files.")
+#
+#     def _print_overwrite(self, message):
+#         print('\r', end='')
+#         sys.stdout.flush()
+#         print(' ' * self.overwrite_len, end='')
+#         sys.stdout.flush()
+#         print(f'\r{message}', end='')
+#         self.overwrite_len = len(message)
+#
+#     def download(self):
+#
+#         start_time = time.time()
+#
+#         instrument_path_part = str(self.instrument).replace("-", "").lower()
+#         experiment_path_part = f"exp{int(self.experiment_number)}"
+#         url_base = urllib.parse.urljoin(self.url_root, f"user_data/{instrument_path_part}/{experiment_path_part}")
+#         file_path_base = os.path.join(os.path.join(self.file_store_base, instrument_path_part), experiment_path_part)
+#
+#         print("\nIdentifying files...")
+#         self._get_directories_and_files_async(url_base, file_path_base)
+#         for url, directory_path in self.all_directory_urls.items():
+#             # Create directories if they don't exist.
+#             if not os.path.exists(directory_path):
+#                 os.makedirs(directory_path)
+#
+#         print("\nDownloading files...\n")
+#         start_download_time = time.time()
+#
+#         # Download files asynchronously.
+#         async_downloads = {}
+#
+#         for url, file_path in self.all_file_urls.items():
+#                 file_request = self.download_session.get(url, stream=True)
+#                 async_downloads[file_request] = file_path
+#
+#         total_bytes = 0
+#         file_index = 0
+#         file_count = len(async_downloads)
+#         progress_status = f"{file_index}/{file_count} = {0:.2f}%, {float(file_count)/100:.2f} seconds remaining (estimated)"
+#         file_status = ""
+#         self._print_overwrite(f"{progress_status} ----> {file_status}")
+#         for file_request in cf.as_completed(async_downloads, timeout=500000):
+#             response = file_request.result()
+#             file_path = async_downloads[file_request]
+#             file_status = f"Writing {file_path}..."
+#             self._print_overwrite(f"{progress_status} ----> {file_status}")
+#             with open(file_path, 'wb') as f:
+#                 for chunk in response.iter_content(chunk_size=8192):
+#                     # filter out keep-alive new chunks
+#                     if chunk:
+#                         f.write(chunk)
+#                         f.flush()
+#                         total_bytes += len(chunk)
+#             file_index += 1
+#             elapsed_download_time = time.time() - start_download_time
+#             fraction_complete = float(file_index)/file_count
+#             if fraction_complete > 0:
+#                 time_remaining_estimate = elapsed_download_time * (1 - fraction_complete) / fraction_complete
+#             else:
+#                 # No completions yet. So just estimate 60 files/second.
+#                 time_remaining_estimate = float(file_count)/100
+#             progress_status = f"{file_index}/{file_count} = {fraction_complete * 100:.2f}%, " \
+#                               f"{time_remaining_estimate:.2f} seconds remaining (estimated)"
+#             file_status += "complete."
+#             self._print_overwrite(f"{progress_status} ----> {file_status}")
+#         elapsed_time = time.time() - start_time
+#         mega_bytes = float(total_bytes)/1000000
+#         print(f"\n\nDownload complete for Instrument {self.instrument} Experiment {self.experiment_number} ("
+#               f"{file_count} files, {mega_bytes:.3f} MB, {elapsed_time:.2f} seconds,"
+#               f" {mega_bytes/elapsed_time:.3f} MB/sec).")
@@ -0,0 +1,512 @@
+"""
+Spigot: SPICE data download tool (SFTP, asyncio).
+"""
+
+import asyncio
+import getpass
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from stat import S_ISDIR
+from Downloaders.SpigotConcurrency import SpigotConcurrency
+from Downloaders.SpigotSFTP import SpigotSFTP
+from Downloaders.SpigotVerifier import SpigotVerifier, new_hash
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+class SpigotSFTPAsync(SpigotSFTP):
+    """
+    SpigotSFTPAsync downloads SPICE experiment data via SFTP interface on an asyncio event loop.
+
+    All listings and transfers are multiplexed over a few SFTP sessions of one asyncssh connection, so the number of
+    concurrent transfers is not bound by the server's limit on channels per connection. A server handles the
+    requests of one session in order, so sftp_sessions sessions keep several of its requests working at once. The
+    journal, listing cache and .part files are the same as SpigotSFTP's, and their disk and SQLite work goes to the
+    loop's default executor. max_concurrency is the ceiling for the concurrency controller, and every request is
+    abandoned after timeout seconds without a reply. The host key is checked against known_hosts as asyncssh.connect
+    does, by default against ~/.ssh/known_hosts; only known_hosts=None turns the check off.
+    """
+
+    def __init__(self, instrument, ipts_number, experiment_number, local_path_base,
+                 user=None, host="analysis.sns.gov", remote_path_base="/HFIR", sftp_port=22, max_concurrency=64,
+                 sftp_sessions=4, listing_cache=True, chunk_size=1024 * 1024, checksum="sha256", retry=None,
+                 concurrency=None, timeout=60.0, progress=None, metrics=None, file_filter=None, listing_ttl=0,
+                 known_hosts=()):
+        if asyncssh is None:
+            raise ImportError("SpigotSFTPAsync needs the asyncssh package.")
+        concurrency = concurrency or SpigotConcurrency(initial=min(8, max_concurrency), maximum=max_concurrency)
+        super().__init__(instrument, ipts_number, experiment_number, local_path_base, user, host, remote_path_base,
+                         sftp_port, max_workers=max_concurrency, listing_cache=listing_cache, checksum=checksum,
+                         retry=retry, concurrency=concurrency, timeout=timeout, progress=progress, metrics=metrics,
+                         file_filter=file_filter, listing_ttl=listing_ttl)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.known_hosts = known_hosts
+        self.sftp_sessions = max(1, min(int(sftp_sessions), self.max_concurrency))
+        # Each read of chunk_size bytes is split by asyncssh into several block reads sent in parallel.
+        self.chunk_size = int(chunk_size)
+        self.attempts = {}
+        self.retry_tasks = set()
+        self.slot_condition = None
+        self.active_transfers = 0
+        # Threads for the sink's calls while downloading into one, see download.
+        self.sink_executor = None
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, (asyncssh.SFTPNoSuchFile, asyncssh.SFTPPermissionDenied, FileNotFoundError,
+                              PermissionError)):
+            return False
+        return isinstance(error, (asyncssh.Error, asyncio.TimeoutError, OSError))
+
+    async def _acquire_slot(self):
+        """
+        Wait until the concurrency controller allows another transfer.
+        :return:
+        """
+        async with self.slot_condition:
+            await self.slot_condition.wait_for(lambda: self.active_transfers < self.concurrency.limit)
+            self.active_transfers += 1
+
+    async def _release_slot(self):
+        async with self.slot_condition:
+            self.active_transfers -= 1
+            self.slot_condition.notify_all()
+
+    async def _retry_later(self, work_queue, item, delay):
+        await asyncio.sleep(delay)
+        work_queue.put_nowait(item)
+        # Only now is the failed attempt done, so the queue never looks finished while a retry is waiting.
+        work_queue.task_done()
+
+    async def _list_directory(self, sftp_client, remote_path, work_queue):
+        """
+        List one remote directory and queue its subdirectories and files.
+        :param sftp_client:
+        :param remote_path:
+        :param work_queue:
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        entries = await loop.run_in_executor(None, self._get_cached_entries, remote_path)
+        if entries is None:
+            entries = [(f.filename, S_ISDIR(f.attrs.permissions), f.attrs.size, f.attrs.mtime)
+                       for f in await asyncio.wait_for(sftp_client.readdir(remote_path), self.timeout)
+                       if f.filename not in (".", "..")]
+            await loop.run_in_executor(None, self._cache_entries, remote_path, entries)
+        for filename, is_directory, size, mtime in entries:
+            if is_directory:
+                folder_path = remote_path.rstrip("/") + "/" + filename
+                if not self.file_filter.wants_directory(self._get_relative_path(folder_path)):
+                    continue
+                self._register_directory(folder_path)
+                await loop.run_in_executor(None, self._assure_local_directory_exists, folder_path)
+                self.pending_directories += 1
+                work_queue.put_nowait((0, 'directory', folder_path, None, None, None))
+            else:
+                file_path = remote_path.rstrip("/") + "/" + filename
+                if not self.file_filter.wants_file(self._get_relative_path(file_path)):
+                    continue
+                local_path = self._register_file(file_path, size, mtime)
+                work_queue.put_nowait((1, 'file', file_path, local_path, size, mtime))
+
+    async def _download_file(self, sftp_client, remote_path, local_path, size, mtime, incremental=False):
+        """
+        Download one file into a .part file and move it into place once complete, resuming, appending to or skipping
+        it as SpigotSFTP would.
+        :param sftp_client:
+        :param remote_path:
+        :param local_path:
+        :param size: Remote size from the directory listing.
+        :param mtime: Remote modification time from the directory listing.
+        :param incremental:
+        :return: ('skipped', size), ('written', size) or ('short', size) if the transfer ended before the listed
+                 size.
+        """
+        if self.sink:
+            return await self._download_to_sink(sftp_client, remote_path, local_path, size, mtime)
+        loop = asyncio.get_running_loop()
+        part_path = local_path + ".part"
+        if incremental:
+            entry = self.manifest.get(remote_path)
+            if entry and os.path.exists(local_path) and os.path.getsize(local_path) == entry.get('size'):
+                if entry['size'] == size and entry.get('mtime') == mtime:
+                    if self.journal.get(remote_path):
+                        self.journal.remove(remote_path)
+                        if os.path.exists(part_path):
+                            await loop.run_in_executor(None, os.remove, part_path)
+                    return 'skipped', size
+                if 0 < entry['size'] < size:
+                    result = await self._append_file(sftp_client, remote_path, local_path, entry['size'], size,
+                                                     mtime)
+                    if result:
+                        return result
+
+        entry = self.journal.get(remote_path)
+        offset = 0
+        if entry and entry.get('size') == size and entry.get('mtime') == mtime and os.path.exists(part_path):
+            offset = min(os.path.getsize(part_path), size)
+        else:
+            self.journal.update(remote_path, size=size, mtime=mtime)
+            await loop.run_in_executor(None, self.journal.save_if_due)
+
+        request_time = time.monotonic()
+        remote_file = await asyncio.wait_for(sftp_client.open(remote_path, 'rb'), self.timeout)
+        self.concurrency.record_latency(time.monotonic() - request_time)
+        async with remote_file:
+            f = await loop.run_in_executor(None, open, part_path, 'r+b' if offset else 'wb')
+            try:
+                hasher = None
+                if self.checksum:
+                    hasher = await loop.run_in_executor(None, new_hash, self.checksum, part_path, offset)
+                if offset:
+                    f.seek(offset)
+                    f.truncate()
+                file_bytes = await self._copy_remote_range(remote_file, partial(self._write_chunk, f, hasher),
+                                                           local_path, offset, size)
+            finally:
+                f.close()
+        complete = await loop.run_in_executor(None, self._complete_file, remote_path, local_path, offset + file_bytes,
+                                              size, mtime, hasher)
+        return 'written' if complete else 'short', file_bytes
+
+    async def _append_file(self, sftp_client, remote_path, local_path, old_size, size, mtime):
+        """
+        Fetch only what was appended to a file that grew since the last download, as SpigotSFTP._append_file does.
+        :param sftp_client:
+        :param remote_path:
+        :param local_path:
+        :param old_size: Size of the local copy, as recorded in the manifest.
+        :param size: Remote size from the directory listing.
+        :param mtime: Remote modification time from the directory listing.
+        :return: ('written', size) or ('short', size) as _download_file, or None if the file needs downloading in
+                 full.
+        """
+        loop = asyncio.get_running_loop()
+        overlap = min(self.append_overlap, old_size)
+        request_time = time.monotonic()
+        remote_file = await asyncio.wait_for(sftp_client.open(remote_path, 'rb'), self.timeout)
+        self.concurrency.record_latency(time.monotonic() - request_time)
+        async with remote_file:
+            remote_bytes = await asyncio.wait_for(remote_file.read(overlap, old_size - overlap), self.timeout)
+            self.total_bytes += len(remote_bytes)
+            self.progress.file_bytes(local_path, len(remote_bytes))
+            local_bytes = await loop.run_in_executor(None, self._read_local_bytes, local_path, old_size - overlap,
+                                                     overlap)
+            if local_bytes != remote_bytes:
+                return None
+            f = await loop.run_in_executor(None, open, local_path, 'r+b')
+            file_bytes = 0
+            try:
+                hasher = None
+                if self.checksum:
+                    hasher = await loop.run_in_executor(None, new_hash, self.checksum, local_path, old_size)
+                f.seek(old_size)
+                file_bytes = await self._copy_remote_range(remote_file, partial(self._write_chunk, f, hasher),
+                                                           local_path, old_size, size)
+            finally:
+                # A failed append is cut off again, leaving the local copy as it was.
+                if old_size + file_bytes < size:
+                    f.truncate(old_size)
+                f.close()
+        if old_size + file_bytes < size:
+            return 'short', len(remote_bytes) + file_bytes
+        fields = {'size': old_size + file_bytes, 'mtime': mtime}
+        if hasher:
+            fields[self.checksum] = hasher.hexdigest()
+        self.manifest.update(remote_path, **fields)
+        await loop.run_in_executor(None, self.manifest.save_if_due, 10.0)
+        return 'written', len(remote_bytes) + file_bytes
+
+    async def _download_to_sink(self, sftp_client, remote_path, local_path, size, mtime):
+        """
+        Download one file into the sink, as SpigotSFTP._download_to_sink does.
+        :param sftp_client:
+        :param remote_path:
+        :param local_path: Local path the file would have, which names it in the sink.
+        :param size: Remote size from the directory listing.
+        :param mtime: Remote modification time from the directory listing.
+        :return: ('written', size) or ('short', size) as _download_file.
+        """
+        loop = asyncio.get_running_loop()
+        name = os.path.relpath(local_path, self.local_path_base).replace(os.path.sep, "/")
+        await loop.run_in_executor(self.sink_executor, self.sink.begin_file, name, size, mtime)
+        try:
+            request_time = time.monotonic()
+            remote_file = await asyncio.wait_for(sftp_client.open(remote_path, 'rb'), self.timeout)
+            self.concurrency.record_latency(time.monotonic() - request_time)
+            async with remote_file:
+                file_bytes = await self._copy_remote_range(remote_file, partial(self.sink.write_file, name),
+                                                           local_path, 0, size)
+        except BaseException:
+            # Shielded, so that a cancelled transfer still gives back its share of the sink.
+            await asyncio.shield(loop.run_in_executor(self.sink_executor, self.sink.abort_file, name))
+            raise
+        if file_bytes < size:
+            await loop.run_in_executor(self.sink_executor, self.sink.abort_file, name)
+            return 'short', file_bytes
+        await loop.run_in_executor(self.sink_executor, self.sink.finish_file, name)
+        return 'written', file_bytes
+
+    async def _copy_remote_range(self, remote_file, write, local_path, offset, size):
+        """
+        Copy a remote file from offset up to the listed size.
+        :param remote_file:
+        :param write: Function to pass each chunk to, called in an executor thread.
+        :param local_path:
+        :param offset:
+        :param size: Remote size from the directory listing.
+        :return: Number of bytes copied.
+        """
+        loop = asyncio.get_running_loop()
+        file_bytes = 0
+        # Never ask for more than the listed size: reads past the end cost the server a round of replies.
+        while offset + file_bytes < size:
+            data = await asyncio.wait_for(
+                remote_file.read(min(self.chunk_size, size - offset - file_bytes), offset + file_bytes),
+                self.timeout)
+            if not data:
+                break
+            await loop.run_in_executor(self.sink_executor, write, data)
+            file_bytes += len(data)
+            # Bytes of a failed attempt count too; the retry continues after them.
+            self.total_bytes += len(data)
+            self.concurrency.record_bytes(len(data))
+            self.progress.file_bytes(local_path, len(data))
+        return file_bytes
+
+    @staticmethod
+    def _read_local_bytes(file_path, offset, count):
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(count)
+
+    async def _worker(self, sftp_client, work_queue, incremental):
+        """
+        Take directories and files from the work queue until cancelled. Failed requests go back on the queue after
+        a backoff delay; once out of retries they are recorded in download_errors, without stopping the other
+        transfers.
+        :param sftp_client:
+        :param work_queue:
+        :param incremental:
+        :return:
+        """
+        while True:
+            item = await work_queue.get()
+            _, kind, remote_path, local_path, size, mtime = item
+            retrying = False
+            try:
+                if kind == 'directory':
+                    await self._list_directory(sftp_client, remote_path, work_queue)
+                    continue
+                await self._acquire_slot()
+                self.progress.file_started(local_path, work_queue.qsize())
+                try:
+                    result, file_bytes = await self._download_file(sftp_client, remote_path, local_path, size,
+                                                                   mtime, incremental)
+                finally:
+                    await self._release_slot()
+                if result == 'short':
+                    # What did arrive is kept, so the retry continues from there.
+                    raise IOError(f"Transfer ended before the listed {size} bytes.")
+                if result == 'skipped':
+                    self.skipped_files += 1
+                    self.skipped_bytes += file_bytes
+                self.progress.file_done(local_path, file_bytes, skipped=result == 'skipped')
+            except Exception as e:
+                self.attempts[remote_path] = self.attempts.get(remote_path, 0) + 1
+                delay = self.retry.get_delay(self.attempts[remote_path]) if self._is_retryable(e) else None
+                if kind == 'directory':
+                    self.progress.directory_failed(self._get_local_path_from_remote_path(remote_path), e, delay)
+                else:
+                    self.progress.file_failed(local_path, e, delay)
+                if delay is None:
+                    self.download_errors.append((remote_path, e))
+                else:
+                    retrying = True
+                    self.concurrency.record_error()
+                    task = asyncio.ensure_future(self._retry_later(work_queue, item, delay))
+                    self.retry_tasks.add(task)
+                    task.add_done_callback(self.retry_tasks.discard)
+            finally:
+                if not retrying:
+                    if kind == 'directory':
+                        self.pending_directories -= 1
+                        if self.pending_directories == 0:
+                            self.discovery_time = time.time() - self.start_download_time
+                            self.progress.discovery_finished(len(self.file_index))
+                    work_queue.task_done()
+
+    async def connect(self, password=None):
+        """
+        Open and authenticate an SSH connection to the host. One connection can serve several downloads.
+        :param password: Password for the SFTP user. Prompted for if not given.
+        :return:
+        """
+        if not password:
+            prompt = f"Password for {self.user} on {self.host}: "
+            password = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: getpass.getpass(prompt=prompt, stream=sys.stderr))
+        return await asyncssh.connect(self.host, port=self.sftp_port, username=self.user, password=password,
+                                      known_hosts=self.known_hosts)
+
+    async def download(self, password=None, connection=None, incremental=False, sink=None):
+        """
+        Download all files of the experiment.
+        :param password: Password for the SFTP user. Prompted for if not given.
+        :param connection: Authenticated asyncssh connection to use instead of connecting; it is left open.
+        :param incremental: Only fetch files that are new or changed since the last download, using the manifest.
+                            Of files that grew, only the appended tail is fetched.
+        :param sink: SpigotSink to stream the files into, as for SpigotSFTP.download. The sink is left open.
+        :return: Dictionary of transfer statistics.
+        """
+        if sink and incremental:
+            raise ValueError("Downloads into a sink cannot be incremental.")
+        start_time = time.time()
+        own_connection = connection is None
+        if own_connection:
+            connection = await self.connect(password)
+        listing_cache = self.listing_cache
+        if sink:
+            # A sink's calls may wait for each other, so every transfer gets a thread of its own for them rather
+            # than sharing the loop's default executor, which could fill up with waiting calls.
+            self.sink = sink
+            self.sink_executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+            if listing_cache is True:
+                self.listing_cache = None
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._prepare_download)
+            await self._transfer(connection, [(0, 'directory', self.remote_path_initial, None, None, None)],
+                                 incremental)
+            return await asyncio.get_running_loop().run_in_executor(None, self._finish_download, start_time,
+                                                                     incremental)
+        finally:
+            if sink:
+                self.sink_executor.shutdown()
+                self.sink_executor = None
+                self.sink = None
+                self.listing_cache = listing_cache
+            if own_connection:
+                connection.close()
+                await connection.wait_closed()
+
+    async def follow(self, password=None, connection=None, interval=30.0, polls=None):
+        """
+        Keep up with a running experiment over one connection, as SpigotSFTP.follow does.
+        :param password: Password for the SFTP user. Prompted for if not given.
+        :param connection: Authenticated asyncssh connection to use instead of connecting; it is left open.
+        :param interval: Seconds from the start of one poll to the start of the next.
+        :param polls: Number of polls, or None to follow until cancelled.
+        :return: List of the statistics of each poll, None for the polls that failed.
+        """
+        own_connection = connection is None
+        if own_connection:
+            connection = await self.connect(password)
+        listing_cache = self.listing_cache
+        self.listing_cache = None
+        results = []
+        try:
+            while polls is None or len(results) < polls:
+                start_time = time.monotonic()
+                try:
+                    results.append(await self.download(connection=connection, incremental=True))
+                except IOError as e:
+                    print(f"\n\nPoll failed, trying again in {interval} seconds: {e}")
+                    results.append(None)
+                if polls is None or len(results) < polls:
+                    await asyncio.sleep(max(0.0, interval - (time.monotonic() - start_time)))
+        finally:
+            self.listing_cache = listing_cache
+            if own_connection:
+                connection.close()
+                await connection.wait_closed()
+        return results
+
+    async def _transfer(self, connection, items, incremental=False):
+        """
+        Work through the given directory and file items, and everything found in the directories.
+        :param connection:
+        :param items: Work queue entries to start with.
+        :param incremental:
+        :return:
+        """
+        self.attempts = {}
+        self.active_transfers = 0
+        self.slot_condition = asyncio.Condition()
+        sftp_clients = []
+        try:
+            for _ in range(self.sftp_sessions):
+                sftp_clients.append(await connection.start_sftp_client())
+            # Directories sort ahead of files, so the whole tree is found early while the files keep every slot busy.
+            work_queue = asyncio.PriorityQueue()
+            for item in items:
+                work_queue.put_nowait(item)
+            workers = [asyncio.ensure_future(self._worker(sftp_clients[index % len(sftp_clients)], work_queue,
+                                                          incremental))
+                       for index in range(self.max_concurrency)]
+            try:
+                await work_queue.join()
+            finally:
+                tasks = workers + list(self.retry_tasks)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for sftp_client in sftp_clients:
+                sftp_client.exit()
+
+    async def verify(self, password=None, connection=None, max_workers=None, redownload=True):
+        """
+        Check the local copy of the experiment against the manifest like SpigotSFTP.verify, with the process pool
+        run from an executor thread.
+        :param password: Password for the SFTP user, if files need downloading. Prompted for if not given.
+        :param connection: Authenticated asyncssh connection to use instead of connecting; it is left open.
+        :param max_workers: Number of hashing processes (default: one per core).
+        :param redownload:
+        :return: List of (remote path, reason) for the files that failed verification.
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        files = await loop.run_in_executor(None, self._get_manifest_files)
+        print(f"\nVerifying {len(files)} files...")
+        verifier = SpigotVerifier(self.checksum, max_workers)
+        bad_files = await loop.run_in_executor(None, verifier.verify, files)
+        for remote_path, reason in bad_files:
+            print(f"{files[remote_path][0]}: {reason}")
+            self.manifest.remove(remote_path)
+        await loop.run_in_executor(None, self.manifest.save)
+        print(f"\n{len(files) - len(bad_files)}/{len(files)} files verified in {time.time() - start_time:.2f} seconds.")
+        if not bad_files or not redownload:
+            return bad_files
+
+        own_connection = connection is None
+        if own_connection:
+            connection = await self.connect(password)
+        try:
+            await loop.run_in_executor(None, self._prepare_download)
+            self.pending_directories = 0
+            items = []
+            async with connection.start_sftp_client() as sftp_client:
+                for remote_path, _ in bad_files:
+                    # Fresh attributes, since the remote file may have changed too.
+                    try:
+                        attributes = await sftp_client.stat(remote_path)
+                    except asyncssh.SFTPError as e:
+                        self.download_errors.append((remote_path, e))
+                        continue
+                    local_path = self._register_file(remote_path, attributes.size, attributes.mtime)
+                    await loop.run_in_executor(None, partial(os.makedirs, os.path.dirname(local_path), exist_ok=True))
+                    items.append((1, 'file', remote_path, local_path, attributes.size, attributes.mtime))
+            self.progress.discovery_finished(len(self.file_index))
+            await self._transfer(connection, items)
+        finally:
+            if own_connection:
+                connection.close()
+                await connection.wait_closed()
+        await loop.run_in_executor(None, self._finish_download, start_time)
+        return bad_files
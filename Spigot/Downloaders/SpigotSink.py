@@ -0,0 +1,143 @@
+"""
+Spigot: destination for downloaded files other than the local directory tree.
+"""
+
+import threading
+
+
+class SpigotSink(object):
+    """
+    SpigotSink receives downloaded files as a single sequential stream of entries, e.g. one archive, instead of one
+    local file each. Downloads run concurrently but entries are written one at a time, so a sink holds files in
+    memory until they are complete, reserving their size from a budget of max_buffer bytes; a download waits in
+    begin_file until its file fits. A file larger than the whole budget is streamed straight into the sink instead,
+    with the sink to itself until the file is done.
+
+    Names are "/" separated paths relative to the download directory, e.g. "hb3a/exp714/Datafiles/x.dat". The
+    downloaders call begin_file, write_file for each chunk, and finish_file or abort_file, from any thread; names
+    are only in progress once at a time. An aborted file is dropped if it was held in memory. If it was being
+    streamed, the sink ends the entry as well as it can (padded or short) and the retry adds it again, which archive
+    tools resolve in favour of the last copy.
+
+    Subclasses write the entries in _start_entry, _write_entry and _finish_entry, and override _abort_entry if a
+    cut-off entry needs more than finishing. The sink must be closed after the last download.
+    """
+
+    def __init__(self, max_buffer=64 * 1024 * 1024):
+        self.max_buffer = int(max_buffer)
+        self.condition = threading.Condition()
+        self.reserved = 0
+        # Held while an entry is being written, and by a streamed file from begin_file to finish_file.
+        self.write_lock = threading.Lock()
+        # Name -> [size, modification time, buffer (None while streaming), bytes received, reserved bytes].
+        self.files = {}
+
+    def begin_file(self, name, size, mtime=None):
+        """
+        Start a file, waiting until there is room for it.
+        :param name:
+        :param size: Expected size. None if unknown, which only works for files that fit in the buffer.
+        :param mtime: Modification time, if known.
+        :return:
+        """
+        if size is not None and size > self.max_buffer:
+            self.write_lock.acquire()
+            try:
+                self._start_entry(name, size, mtime)
+            except BaseException:
+                self.write_lock.release()
+                raise
+            with self.condition:
+                self.files[name] = [size, mtime, None, 0, 0]
+            return
+        # A file of unknown size might need the whole budget.
+        reservation = self.max_buffer if size is None else size
+        with self.condition:
+            while self.reserved + reservation > self.max_buffer and self.reserved > 0:
+                self.condition.wait()
+            self.reserved += reservation
+            self.files[name] = [size, mtime, bytearray(), 0, reservation]
+
+    def write_file(self, name, data):
+        """
+        Add the next chunk of a file.
+        :param name:
+        :param data: Bytes-like chunk.
+        :return:
+        """
+        state = self.files[name]
+        state[3] += len(data)
+        if state[2] is None:
+            if state[3] > state[0]:
+                raise IOError(f"{name} is longer than the {state[0]} bytes announced.")
+            self._write_entry(data)
+        else:
+            if state[3] > state[4]:
+                raise IOError(f"{name} is longer than the {state[4]} bytes reserved for it.")
+            state[2] += data
+
+    def finish_file(self, name):
+        """
+        Complete a file, writing it out if it was held in memory.
+        :param name:
+        :return:
+        """
+        with self.condition:
+            size, mtime, buffer, _, reservation = self.files.pop(name)
+        if buffer is None:
+            try:
+                self._finish_entry()
+            finally:
+                self.write_lock.release()
+            return
+        try:
+            with self.write_lock:
+                self._start_entry(name, len(buffer), mtime)
+                self._write_entry(buffer)
+                self._finish_entry()
+        finally:
+            self._release(reservation)
+
+    def abort_file(self, name):
+        """
+        Give up on a file after a failed transfer.
+        :param name:
+        :return:
+        """
+        with self.condition:
+            state = self.files.pop(name, None)
+        if state is None:
+            return
+        if state[2] is None:
+            try:
+                self._abort_entry(state[0], state[3])
+            finally:
+                self.write_lock.release()
+        else:
+            self._release(state[4])
+
+    def _release(self, reservation):
+        with self.condition:
+            self.reserved -= reservation
+            self.condition.notify_all()
+
+    def _start_entry(self, name, size, mtime):
+        raise NotImplementedError
+
+    def _write_entry(self, data):
+        raise NotImplementedError
+
+    def _finish_entry(self):
+        raise NotImplementedError
+
+    def _abort_entry(self, size, written):
+        """
+        End a streamed entry that was cut off after written of its size bytes.
+        :param size:
+        :param written:
+        :return:
+        """
+        self._finish_entry()
+
+    def close(self):
+        pass
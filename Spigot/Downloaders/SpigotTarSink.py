@@ -0,0 +1,80 @@
+"""
+Spigot: downloads streamed into a tar archive.
+"""
+
+import gzip
+import tarfile
+import time
+from Downloaders.SpigotSink import SpigotSink
+
+
+class SpigotTarSink(SpigotSink):
+    """
+    SpigotTarSink writes downloaded files into one tar archive, in a single sequential pass: target is a path, or
+    a writable binary file object such as sys.stdout.buffer or an upload stream, which is never seeked. Archives
+    whose path ends in .gz or .tgz, or any archive with compress=True, are gzip compressed.
+
+    Headers are written from the tar module's own TarInfo (PAX format), but the archive is not kept open as a
+    TarFile, so no member list builds up however many files pass through.
+    """
+
+    def __init__(self, target, compress=None, max_buffer=64 * 1024 * 1024):
+        super().__init__(max_buffer)
+        self.own_file = isinstance(target, str)
+        self.file = open(target, 'wb') if self.own_file else target
+        if compress is None:
+            compress = self.own_file and target.endswith((".gz", ".tgz"))
+        self.stream = gzip.GzipFile(fileobj=self.file, mode='wb') if compress else self.file
+        self.entry_size = 0
+        self.entry_written = 0
+        self.archive_bytes = 0
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.archive_bytes += len(data)
+
+    def _start_entry(self, name, size, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(mtime if mtime is not None else time.time())
+        info.mode = 0o644
+        self._write(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+        self.entry_size = size
+        self.entry_written = 0
+
+    def _write_entry(self, data):
+        self._write(data)
+        self.entry_written += len(data)
+
+    def _finish_entry(self):
+        # Data is padded to whole blocks.
+        remainder = self.entry_size % tarfile.BLOCKSIZE
+        if remainder:
+            self._write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
+    def _abort_entry(self, size, written):
+        # The header promised size bytes, so fill in the rest to keep the archive readable.
+        missing = size - written
+        while missing > 0:
+            count = min(missing, 1024 * 1024)
+            self._write(tarfile.NUL * count)
+            missing -= count
+        self._finish_entry()
+
+    def close(self):
+        """
+        End the archive with two zero blocks, padded to a whole record as tar does, and close the output if this
+        sink opened it.
+        :return:
+        """
+        with self.write_lock:
+            self._write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+            remainder = self.archive_bytes % tarfile.RECORDSIZE
+            if remainder:
+                self._write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+            if self.stream is not self.file:
+                self.stream.close()
+            if self.own_file:
+                self.file.close()
+            else:
+                self.file.flush()
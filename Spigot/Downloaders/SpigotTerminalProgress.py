@@ -0,0 +1,123 @@
+"""
+Spigot: progress status line on the terminal.
+"""
+
+import sys
+import threading
+import time
+from Downloaders.SpigotProgress import SpigotProgress
+
+
+class SpigotTerminalProgress(SpigotProgress):
+    """
+    SpigotTerminalProgress keeps a one-line progress/ETA status on the terminal. The line is redrawn at most every
+    interval seconds, in one write, whatever the rate of events; discovery results and the final state are always
+    shown. Several downloads may share one instance, which then shows their combined progress.
+    """
+
+    def __init__(self, stream=None, interval=0.1):
+        # None writes to whatever sys.stdout is at the time, so redirect_stdout still works.
+        self.stream = stream
+        self.interval = float(interval)
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.listing = 0
+        self.discovered = 0
+        self.finished = 0
+        self.total_bytes = 0
+        self.file_status = ""
+        self.last_render = 0.0
+        self.line_length = 0
+
+    def _render(self, force=False):
+        """
+        Redraw the status line, unless it was redrawn less than interval seconds ago. Called with the lock held.
+        :param force:
+        :return:
+        """
+        now = time.monotonic()
+        if not force and now - self.last_render < self.interval:
+            return
+        self.last_render = now
+        elapsed_time = max(now - self.start_time, 1e-9)
+        mega_bytes = float(self.total_bytes)/(1024 * 1024)
+        if self.listing > 0 or self.discovered == 0:
+            # Still listing, so the total is not known yet.
+            status = f"{self.finished}/{self.discovered} files so far (still listing), {mega_bytes:.3f} MB"
+        else:
+            fraction_complete = min(1.0, float(self.finished)/self.discovered)
+            if fraction_complete > 0:
+                time_remaining_estimate = elapsed_time * (1 - fraction_complete) / fraction_complete
+            else:
+                # No completions yet. So just estimate 100 files/second.
+                time_remaining_estimate = float(self.discovered)/100
+            status = f"{self.finished}/{self.discovered} = {fraction_complete * 100:.2f}%, " \
+                     f"{mega_bytes/elapsed_time:.3f} MB/sec, {time_remaining_estimate:.2f} seconds remaining " \
+                     f"(estimated)"
+        line = f"{status} ----> {self.file_status}"
+        stream = self.stream or sys.stdout
+        stream.write(f"\r{line}{' ' * (self.line_length - len(line))}")
+        stream.flush()
+        self.line_length = len(line)
+
+    def _write_line(self, message):
+        stream = self.stream or sys.stdout
+        stream.write(message)
+        stream.flush()
+        self.line_length = 0
+
+    def download_started(self, name):
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.monotonic()
+            self.listing += 1
+            self.file_status = f"Listing {name}..."
+            self._render(force=True)
+
+    def file_discovered(self, path):
+        with self.lock:
+            self.discovered += 1
+            self._render()
+
+    def discovery_finished(self, file_count):
+        with self.lock:
+            self.listing -= 1
+            self._write_line(f"\n\nFound a total of {file_count} files.\n")
+            self._render(force=True)
+
+    def file_started(self, path, queued):
+        with self.lock:
+            self.file_status = f"Reading {path}..."
+            self._render()
+
+    def file_bytes(self, path, byte_count):
+        with self.lock:
+            self.total_bytes += byte_count
+            self._render()
+
+    def file_done(self, path, byte_count, skipped=False):
+        with self.lock:
+            self.finished += 1
+            self.file_status = f"Skipped unchanged {path}." if skipped else f"Read {path}."
+            self._render()
+
+    def file_failed(self, path, error, retry_delay=None):
+        with self.lock:
+            if retry_delay is None:
+                self.finished += 1
+                self.file_status = f"Failed to read {path}: {error}"
+            else:
+                self.file_status = f"Retrying {path} in {retry_delay:.1f} seconds: {error}"
+            self._render()
+
+    def directory_failed(self, path, error, retry_delay=None):
+        with self.lock:
+            if retry_delay is None:
+                self.file_status = f"Failed to list {path}: {error}"
+            else:
+                self.file_status = f"Retrying listing of {path} in {retry_delay:.1f} seconds: {error}"
+            self._render()
+
+    def download_finished(self, statistics):
+        with self.lock:
+            self._render(force=True)
@@ -0,0 +1,85 @@
+"""
+Spigot: checksums and verification of downloaded SPICE files.
+"""
+
+import concurrent.futures as cf
+import hashlib
+import os
+
+
+def new_hash(algorithm, path=None, length=0):
+    """
+    Start a hash for a file that is being downloaded. A resumed transfer first feeds in the length bytes already in
+    path, so the digest still covers the whole file.
+    :param algorithm: Any hashlib algorithm name, e.g. "sha256".
+    :param path:
+    :param length:
+    :return:
+    """
+    hasher = hashlib.new(algorithm)
+    if path and length:
+        with open(path, 'rb') as f:
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def hash_file(path, algorithm="sha256"):
+    """
+    Hash a whole file. This is a module level function so a process pool can run it.
+    :param path:
+    :param algorithm:
+    :return: Hex digest, or None if the file cannot be read.
+    """
+    try:
+        return new_hash(algorithm, path, os.path.getsize(path)).hexdigest()
+    except OSError:
+        return None
+
+
+class SpigotVerifier(object):
+    """
+    SpigotVerifier re-checks downloaded files against their manifest entries. Sizes are compared first; files with
+    a recorded checksum are then hashed by a process pool, so large mirrors are checked on all cores.
+    """
+
+    def __init__(self, algorithm="sha256", max_workers=None):
+        self.algorithm = algorithm
+        self.max_workers = max_workers
+
+    def verify(self, files):
+        """
+        Check files against their manifest entries.
+        :param files: Dictionary of key -> (local path, manifest entry).
+        :return: List of (key, reason) for every missing, short or corrupt file.
+        """
+        bad_files = []
+        to_hash = []
+        for key, (file_path, entry) in files.items():
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                bad_files.append((key, "missing"))
+                continue
+            if entry.get('size') is not None and size != entry['size']:
+                bad_files.append((key, f"size {size} instead of {entry['size']}"))
+            elif self.algorithm and entry.get(self.algorithm):
+                to_hash.append((key, file_path, entry[self.algorithm]))
+        if not to_hash:
+            return bad_files
+
+        max_workers = self.max_workers or os.cpu_count() or 1
+        # Scan directories hold many small files, so hand them to the workers in batches.
+        chunksize = max(1, min(64, len(to_hash) // (4 * max_workers)))
+        with cf.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            digests = executor.map(hash_file, [file_path for _, file_path, _ in to_hash],
+                                   [self.algorithm] * len(to_hash), chunksize=chunksize)
+            for (key, _, expected), digest in zip(to_hash, digests):
+                if digest != expected:
+                    bad_files.append((key, f"{self.algorithm} mismatch"))
+        return bad_files
@@ -0,0 +1,44 @@
+"""
+Spigot: downloads streamed into a zip archive.
+"""
+
+import time
+import warnings
+import zipfile
+from Downloaders.SpigotSink import SpigotSink
+
+
+class SpigotZipSink(SpigotSink):
+    """
+    SpigotZipSink writes downloaded files into one zip archive: target is a path or a writable binary file object,
+    which need not be seekable. SPICE data files are text and compress well, so entries are deflated by default;
+    pass zipfile.ZIP_STORED to keep them as they are. Unlike a tar archive, a zip file ends with a directory of its
+    entries, which stays in memory until the sink is closed.
+    """
+
+    def __init__(self, target, compression=zipfile.ZIP_DEFLATED, max_buffer=64 * 1024 * 1024):
+        super().__init__(max_buffer)
+        self.archive = zipfile.ZipFile(target, 'w', compression=compression, allowZip64=True)
+        self.entry = None
+
+    def _start_entry(self, name, size, mtime):
+        info = zipfile.ZipInfo(name, time.localtime(mtime if mtime is not None else time.time())[:6])
+        info.compress_type = self.archive.compression
+        info.external_attr = 0o644 << 16
+        info.file_size = size
+        # Sizes past 2 GB need the ZIP64 extension, which has to be chosen before the entry is written. A retried
+        # file that was streamed is added again under the same name, which zipfile warns about.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            self.entry = self.archive.open(info, 'w', force_zip64=size > 0x7fffffff)
+
+    def _write_entry(self, data):
+        self.entry.write(data)
+
+    def _finish_entry(self):
+        self.entry.close()
+        self.entry = None
+
+    def close(self):
+        with self.write_lock:
+            self.archive.close()
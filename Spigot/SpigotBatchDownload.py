@@ -0,0 +1,148 @@
+"""
+Spigot: command-line batch download of SPICE experiments.
+
+Jobs are given as INSTRUMENT:IPTS:EXPERIMENT, e.g. "hb3a:21007:714", on the command line or one per line in a jobs
+file (blank lines and lines starting with # are ignored). The IPTS number is only used for SFTP.
+
+--include, --exclude and --scans select part of each experiment, e.g. --include "Datafiles/*.dat" --scans 10-42.
+Patterns are relative to the experiment directory; see SpigotFilter for the rules.
+
+--follow SECONDS keeps a running experiment up to date until interrupted: every SECONDS, new files are downloaded
+and files that grew only transfer what was appended.
+
+--archive PATH writes every downloaded file into one tar (.tar, .tar.gz, .tgz) or zip (.zip) archive instead of a
+directory tree, and --archive - streams a tar archive to standard output, e.g. into ssh or an object store client;
+the status messages then go to standard error. Archives always hold complete downloads.
+"""
+
+import argparse
+import contextlib
+import re
+import sys
+from Downloaders.SpigotBatch import SpigotBatch
+from Downloaders.SpigotFilter import SpigotFilter
+from Downloaders.SpigotJSONLinesProgress import SpigotJSONLinesProgress
+from Downloaders.SpigotMetrics import SpigotMetrics
+from Downloaders.SpigotProgressGroup import SpigotProgressGroup
+from Downloaders.SpigotTarSink import SpigotTarSink
+from Downloaders.SpigotTerminalProgress import SpigotTerminalProgress
+from Downloaders.SpigotZipSink import SpigotZipSink
+
+
+def parse_job(text):
+    parts = text.replace(",", ":").split(":")
+    if len(parts) != 3 or not parts[2].strip().isdigit():
+        raise argparse.ArgumentTypeError(f"Job {text!r} is not INSTRUMENT:IPTS:EXPERIMENT.")
+    return parts[0].strip(), parts[1].strip(), int(parts[2])
+
+
+def make_sink(path):
+    """
+    Open the archive given to --archive.
+    :param path: Archive path, or "-" for a tar stream on standard output.
+    :return:
+    """
+    if path == "-":
+        return SpigotTarSink(sys.stdout.buffer)
+    if path.lower().endswith(".zip"):
+        return SpigotZipSink(path)
+    return SpigotTarSink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download many SPICE experiments over shared connections.")
+    parser.add_argument("jobs", nargs="*", type=parse_job, metavar="INSTRUMENT:IPTS:EXPERIMENT")
+    parser.add_argument("--jobs-file", help="file with one INSTRUMENT:IPTS:EXPERIMENT job per line")
+    parser.add_argument("--dest", required=True,
+                        help="local directory to mirror the experiments into; nothing is written there with --archive")
+    parser.add_argument("--protocol", choices=("http", "sftp"), default="http")
+    parser.add_argument("--user", help="SFTP user name")
+    parser.add_argument("--host", default="analysis.sns.gov", help="SFTP host")
+    parser.add_argument("--port", type=int, default=22, help="SFTP port")
+    parser.add_argument("--url-root", default="http://neutron.ornl.gov/", help="HTTP root url")
+    parser.add_argument("--max-workers", type=int,
+                        help="most requests in flight (HTTP, default 64) or SFTP channels (default 8) across all jobs")
+    parser.add_argument("--parallel-jobs", type=int, default=2, help="experiments downloaded at the same time")
+    parser.add_argument("--max-bandwidth", type=float, help="combined transfer rate limit in MB/s")
+    parser.add_argument("--full", action="store_true", help="download everything, not only new or changed files")
+    parser.add_argument("--verify", action="store_true",
+                        help="check the local copies against their checksums and download bad files again")
+    parser.add_argument("--follow", type=float, metavar="SECONDS",
+                        help="poll every SECONDS for new and grown files until interrupted")
+    parser.add_argument("--archive", metavar="PATH",
+                        help="write the files into this .tar, .tar.gz, .tgz or .zip archive, or - for a tar stream "
+                             "on standard output; implies --full")
+    parser.add_argument("--include", action="append",
+                        help="only download paths matching this glob (or re:REGEX); may be repeated")
+    parser.add_argument("--exclude", action="append",
+                        help="skip paths matching this glob (or re:REGEX), e.g. Images; may be repeated")
+    parser.add_argument("--scans", help="only download these scan numbers, e.g. 1-10,15,20-")
+    parser.add_argument("--listing-ttl", type=float, default=0, metavar="SECONDS",
+                        help="also reuse listings of active directories for this long, which can miss new files "
+                             "(default 0: only settled directories are reused)")
+    parser.add_argument("--events", help="also write progress events to this file as JSON lines")
+    parser.add_argument("--metrics", help="keep Prometheus text metrics in this file, e.g. for node_exporter")
+    args = parser.parse_args()
+
+    jobs = list(args.jobs)
+    if args.jobs_file:
+        with open(args.jobs_file, 'r') as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    try:
+                        jobs.append(parse_job(line))
+                    except argparse.ArgumentTypeError as e:
+                        parser.error(f"{args.jobs_file}:{lineno}: {e}")
+    if not jobs:
+        parser.error("no jobs given")
+    if args.protocol == "sftp" and args.max_workers is not None and args.max_workers < 2:
+        parser.error("--max-workers must be at least 2 for SFTP, one channel to list and one to download")
+    if args.follow is not None and (args.full or args.verify):
+        parser.error("--follow cannot be combined with --full or --verify")
+    if args.archive and (args.follow is not None or args.verify):
+        parser.error("--archive cannot be combined with --follow or --verify")
+    try:
+        file_filter = SpigotFilter(args.include, args.exclude, args.scans)
+    except (ValueError, re.error) as e:
+        parser.error(str(e))
+
+    sink = make_sink(args.archive) if args.archive else None
+    # The archive stream owns standard output, so everything else that is printed goes to standard error.
+    with contextlib.redirect_stdout(sys.stderr) if args.archive == "-" else contextlib.nullcontext():
+        return run(args, jobs, file_filter, sink)
+
+
+def run(args, jobs, file_filter, sink):
+    progress = SpigotTerminalProgress()
+    events_file = open(args.events, 'a') if args.events else None
+    if events_file:
+        progress = SpigotProgressGroup([progress, SpigotJSONLinesProgress(events_file)])
+    try:
+        batch = SpigotBatch(args.dest, args.protocol, args.user, args.host, args.url_root, sftp_port=args.port,
+                            max_workers=args.max_workers, max_parallel_jobs=args.parallel_jobs,
+                            max_bandwidth=args.max_bandwidth * 1024 * 1024 if args.max_bandwidth else None,
+                            progress=progress, metrics=SpigotMetrics(prometheus_path=args.metrics),
+                            file_filter=file_filter, listing_ttl=args.listing_ttl)
+        for job in jobs:
+            batch.add_job(*job)
+        if args.follow is not None:
+            try:
+                batch.follow(interval=args.follow)
+            except KeyboardInterrupt:
+                print("\n\nStopped following.")
+            results = batch.results
+        elif sink:
+            results = batch.run(incremental=False, sink=sink)
+        else:
+            results = batch.run(incremental=not args.full, verify=args.verify)
+    finally:
+        if sink:
+            sink.close()
+        if events_file:
+            events_file.close()
+    return 1 if any(isinstance(result, Exception) for _, result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+Benchmark of SpigotFileIndex against plain dictionaries for the files of a large synthetic archive, and of the
+HTTP engines' peak memory while they crawl and download an experiment of many small files.
+"""
+
+# Ugly hack to allow absolute import from the root folder.
+# noinspection PyUnboundLocalVariable
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    # noinspection PyShadowingBuiltins
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+    __package__ = "SpigotFileIndexBenchmark"
+
+import argparse
+import asyncio
+import contextlib
+import os
+import tempfile
+import time
+import tracemalloc
+from Downloaders.SpigotFileIndex import SpigotFileIndex
+from Downloaders.SpigotHTTP import SpigotHTTP
+from Downloaders.SpigotProgress import SpigotProgress
+from Tests.SpigotMockServers import make_experiment_tree, SpigotMockHTTPServer
+
+REMOTE_BASE = "/HFIR/HB3A/IPTS-21007"
+LOCAL_BASE = os.path.join(tempfile.gettempdir(), "spigot", "HB3A", "IPTS-21007")
+
+
+def make_remote_paths(experiment_count, files_per_experiment):
+    """
+    Generate the remote paths of an archive laid out like SPICE experiments: a few directories per experiment, with
+    most files in Datafiles.
+    :param experiment_count:
+    :param files_per_experiment:
+    :return: Generator of (remote path, size, mtime).
+    """
+    for experiment_number in range(experiment_count):
+        experiment_path = f"{REMOTE_BASE}/exp{experiment_number}"
+        for index in range(files_per_experiment):
+            directory = "Datafiles" if index % 10 else ("Images", "UBConf", "Logs")[index % 3]
+            name = f"HB3A_exp{experiment_number:04}_scan{index:04}.dat"
+            yield f"{experiment_path}/{directory}/{name}", 1024 + index, 1.5e9 + index
+
+
+def build_dictionary(remote_paths):
+    files = {}
+    for remote_path, _, _ in remote_paths:
+        files[remote_path] = os.path.join(LOCAL_BASE, remote_path[len(REMOTE_BASE) + 1:].replace("/", os.path.sep))
+    return files
+
+
+def build_index(remote_paths):
+    index = SpigotFileIndex(REMOTE_BASE, LOCAL_BASE)
+    for remote_path, size, mtime in remote_paths:
+        index.add_file(remote_path, size, mtime)
+    return index
+
+
+def measure(build, remote_paths):
+    """
+    Build a collection while tracing allocations.
+    :param build:
+    :param remote_paths:
+    :return: The collection, its memory in MB and the seconds it took to build.
+    """
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    collection = build(remote_paths)
+    elapsed_time = time.perf_counter() - start_time
+    memory = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+    return collection, memory, elapsed_time
+
+
+class DiscoveryMemory(SpigotProgress):
+    """
+    Records the traced memory when discovery finishes. Files are found much faster than they download, so that is
+    when nearly all of them wait in the engine's queue; later, the manifest of the finished files takes over.
+    """
+
+    def __init__(self):
+        self.memory = 0
+
+    def discovery_finished(self, file_count):
+        self.memory = tracemalloc.get_traced_memory()[0]
+
+
+def measure_engines(file_count):
+    """
+    Download an experiment of file_count tiny files with each HTTP engine while tracing allocations.
+    :param file_count:
+    :return:
+    """
+    with tempfile.TemporaryDirectory() as root:
+        make_experiment_tree(os.path.join(root, "server"), file_count=file_count, min_size=16, max_size=16)
+        server = SpigotMockHTTPServer(os.path.join(root, "server")).start()
+        try:
+            # Small chunks keep the read buffers from drowning out what the engines keep per file.
+            engines = [("SpigotHTTP", lambda progress: SpigotHTTP(
+                "HB-3A", 123, os.path.join(root, "http"), url_root=server.url_root, listing_cache=None,
+                chunk_size=4096, checksum=None, progress=progress).download())]
+            try:
+                from Downloaders.SpigotHTTPAsync import SpigotHTTPAsync
+                engines.append(("SpigotHTTPAsync", lambda progress: asyncio.run(SpigotHTTPAsync(
+                    "HB-3A", 123, os.path.join(root, "http_async"), url_root=server.url_root, listing_cache=None,
+                    chunk_size=4096, checksum=None, progress=progress).download())))
+            except ImportError as e:
+                print(f"Skipping SpigotHTTPAsync: {e}")
+            for name, download in engines:
+                progress = DiscoveryMemory()
+                tracemalloc.start()
+                start_time = time.perf_counter()
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    download(progress)
+                elapsed_time = time.perf_counter() - start_time
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"{name}: {file_count} files downloaded in {elapsed_time:.2f} s, memory when discovery "
+                      f"finished {progress.memory / (1024 * 1024):.1f} MB "
+                      f"({progress.memory / file_count:.0f} bytes per file), peak {peak_memory / (1024 * 1024):.1f} MB")
+        finally:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory of SpigotFileIndex and plain dictionaries.")
+    parser.add_argument("--experiments", type=int, default=200)
+    parser.add_argument("--files", type=int, default=2000, help="files per experiment")
+    parser.add_argument("--engine-files", type=int, default=5000,
+                        help="files of the experiment the HTTP engines download (0: skip)")
+    args = parser.parse_args()
+    file_count = args.experiments * args.files
+
+    # The paths are generated on the fly, so only what each collection keeps is measured.
+    files, dictionary_memory, dictionary_time = measure(
+        build_dictionary, make_remote_paths(args.experiments, args.files))
+    print(f"dict: {file_count} files, {dictionary_memory:.1f} MB, built in {dictionary_time:.2f} s")
+    index, index_memory, index_time = measure(build_index, make_remote_paths(args.experiments, args.files))
+    print(f"SpigotFileIndex: {len(index)} files, {index_memory:.1f} MB, built in {index_time:.2f} s")
+    if dict(index.files()) != files:
+        raise RuntimeError("SpigotFileIndex does not map the same paths as the dictionary.")
+
+    start_time = time.perf_counter()
+    count = sum(1 for _ in index.files())
+    print(f"Iterated {count} files in {time.perf_counter() - start_time:.2f} s")
+    with tempfile.TemporaryDirectory() as directory:
+        index_path = os.path.join(directory, "index.json")
+        start_time = time.perf_counter()
+        index.save(index_path)
+        save_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        loaded = SpigotFileIndex.load(index_path)
+        load_time = time.perf_counter() - start_time
+        print(f"Saved {os.path.getsize(index_path) / (1024 * 1024):.1f} MB in {save_time:.2f} s, "
+              f"loaded in {load_time:.2f} s")
+    if dict(loaded.files()) != files or loaded.get_listing(next(iter(files))) != index.get_listing(next(iter(files))):
+        raise RuntimeError("The loaded index differs from the saved one.")
+    if args.engine_files > 0:
+        measure_engines(args.engine_files)
+
+
+if __name__ == "__main__":
+    main()
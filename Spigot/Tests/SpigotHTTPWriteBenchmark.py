@@ -0,0 +1,110 @@
+"""
+Benchmark of the SpigotHTTP write path against a local HTTP server.
+"""
+
+# Ugly hack to allow absolute import from the root folder.
+# noinspection PyUnboundLocalVariable
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    # noinspection PyShadowingBuiltins
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+    __package__ = "SpigotHTTPWriteBenchmark"
+
+import argparse
+import functools
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import time
+import requests
+from Downloaders.SpigotHTTP import SpigotHTTP
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_files(root, file_count, file_size):
+    experiment_path = os.path.join(root, "user_data", "bench", "exp1")
+    os.makedirs(experiment_path)
+    block = os.urandom(1024 * 1024)
+    for index in range(file_count):
+        with open(os.path.join(experiment_path, f"BENCH_exp0001_scan{index:04}.dat"), 'wb') as f:
+            for _ in range(file_size // len(block)):
+                f.write(block)
+            f.write(block[:file_size % len(block)])
+    return experiment_path
+
+
+def legacy_download(url_root, experiment_path, target):
+    """
+    The original write loop: 8 KiB chunks from iter_content, flushed after every chunk.
+    :param url_root:
+    :param experiment_path:
+    :param target:
+    :return:
+    """
+    session = requests.Session()
+    os.makedirs(target)
+    total_bytes = 0
+    for filename in sorted(os.listdir(experiment_path)):
+        response = session.get(url_root + "user_data/bench/exp1/" + filename, stream=True)
+        with open(os.path.join(target, filename), 'wb') as f:
+            for chunk in response.iter_content(chunk_size=8192):
+                if chunk:
+                    f.write(chunk)
+                    f.flush()
+                    total_bytes += len(chunk)
+    return total_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure SpigotHTTP write throughput against a local server.")
+    parser.add_argument("--files", type=int, default=4, help="number of files")
+    parser.add_argument("--size-mb", type=int, default=128, help="size of each file in MB")
+    parser.add_argument("--workers", type=int, default=1, help="SpigotHTTP max_workers (1 compares like for like)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="spigot_bench_")
+    try:
+        experiment_path = make_files(os.path.join(root, "server"), args.files, args.size_mb * 1024 * 1024)
+        handler = functools.partial(QuietHandler, directory=os.path.join(root, "server"))
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url_root = f"http://127.0.0.1:{server.server_address[1]}/"
+        total_mb = float(args.files * args.size_mb)
+
+        start_time = time.perf_counter()
+        legacy_download(url_root, experiment_path, os.path.join(root, "legacy"))
+        elapsed_time = time.perf_counter() - start_time
+        results = [f"legacy 8 KiB + flush: {total_mb / elapsed_time:.1f} MB/s"]
+
+        # Without a checksum this measures the write path alone; with one, the hashing the workers do on top.
+        for checksum in (None, "sha256"):
+            for chunk_size in (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+                target = os.path.join(root, f"spigot_{chunk_size}")
+                spigot = SpigotHTTP("bench", 1, target, url_root=url_root, max_workers=args.workers,
+                                    chunk_size=chunk_size, listing_cache=None, checksum=checksum)
+                start_time = time.perf_counter()
+                spigot.download()
+                elapsed_time = time.perf_counter() - start_time
+                results.append(f"SpigotHTTP chunk_size={chunk_size // 1024} KiB, checksum={checksum}: "
+                               f"{total_mb / elapsed_time:.1f} MB/s")
+                shutil.rmtree(target)
+
+        server.shutdown()
+        print(f"\n\n{args.files} files x {args.size_mb} MB:")
+        for result in results:
+            print(f"  {result}")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
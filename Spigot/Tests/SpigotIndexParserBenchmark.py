@@ -0,0 +1,67 @@
+"""
+Benchmark of the SpigotIndexParser link extraction methods on synthetic autoindex pages.
+"""
+
+# Ugly hack to allow absolute import from the root folder.
+# noinspection PyUnboundLocalVariable
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    # noinspection PyShadowingBuiltins
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+    __package__ = "SpigotIndexParserBenchmark"
+
+import time
+from Downloaders.SpigotIndexParser import SpigotIndexParser, etree
+
+
+def make_apache_index(entry_count):
+    """
+    Build an Apache style autoindex page listing entry_count scan files and a few subdirectories.
+    :param entry_count:
+    :return:
+    """
+    rows = ['<tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th>'
+            '<th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th>'
+            '<th><a href="?C=S;O=A">Size</a></th></tr>',
+            '<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td>'
+            '<td><a href="/user_data/hb3a/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>']
+    for name in ("Datafiles/", "Images/", "UBConf/"):
+        rows.append(f'<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td>'
+                    f'<td><a href="{name}">{name}</a></td><td align="right">2019-05-01 10:12  </td>'
+                    f'<td align="right">  - </td></tr>')
+    for index in range(entry_count):
+        name = f"HB3A_exp0123_scan{index:04}.dat"
+        rows.append(f'<tr><td valign="top"><img src="/icons/text.gif" alt="[TXT]"></td>'
+                    f'<td><a href="{name}">{name}</a></td><td align="right">2019-05-01 10:12  </td>'
+                    f'<td align="right"> 12K</td></tr>')
+    page = '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html>\n <head>\n' \
+           '  <title>Index of /user_data/hb3a/exp123</title>\n </head>\n <body>\n' \
+           '<h1>Index of /user_data/hb3a/exp123</h1>\n  <table>\n' + "\n".join(rows) + \
+           '\n</table>\n<address>Apache Server at neutron.ornl.gov Port 80</address>\n</body></html>\n'
+    return page.encode("utf-8")
+
+
+def main():
+    methods = ["regex", "bs4"] if etree is None else ["regex", "lxml", "bs4"]
+    for entry_count in (100, 1000, 10000, 50000):
+        page = make_apache_index(entry_count)
+        expected = None
+        timings = []
+        for method in methods:
+            parser = SpigotIndexParser(method)
+            repeats = max(1, 20000 // entry_count)
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                links = parser.get_links(page)
+            elapsed_time = (time.perf_counter() - start_time) / repeats
+            if expected is None:
+                expected = links
+            elif links != expected:
+                raise RuntimeError(f"{method} found {len(links)} links, expected {len(expected)}.")
+            timings.append(f"{method} {elapsed_time * 1000:.2f} ms")
+        print(f"{entry_count} entries ({len(page) / 1024:.0f} KB): " + ", ".join(timings))
+
+
+if __name__ == "__main__":
+    main()
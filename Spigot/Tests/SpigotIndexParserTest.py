@@ -0,0 +1,70 @@
+"""
+Test of the links and modification dates SpigotIndexParser reads from nginx and Apache autoindex pages, with every
+extraction method.
+"""
+
+# Ugly hack to allow absolute import from the root folder.
+# noinspection PyUnboundLocalVariable
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    # noinspection PyShadowingBuiltins
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+    __package__ = "SpigotIndexParserTest"
+
+import calendar
+from Downloaders.SpigotIndexParser import SpigotIndexParser, etree
+
+NGINX_INDEX = b"""<html>
+<head><title>Index of /user_data/hb3a/exp123/</title></head>
+<body>
+<h1>Index of /user_data/hb3a/exp123/</h1><hr><pre><a href="../">../</a>
+<a href="Datafiles/">Datafiles/</a>                                         01-May-2019 10:12                   -
+<a href="HB3A_exp0123_scan0001.dat">HB3A_exp0123_scan0001.dat</a>                          02-Jun-2019 08:30               12288
+</pre><hr></body>
+</html>
+"""
+
+APACHE_INDEX = b"""<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html>
+ <head>
+  <title>Index of /user_data/hb3a/exp123</title>
+ </head>
+ <body>
+<h1>Index of /user_data/hb3a/exp123</h1>
+<table>
+<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th></tr>
+<tr><td><a href="/user_data/hb3a/">Parent Directory</a></td></tr>
+<tr><td><a href="../">Up</a></td></tr>
+<tr><td><a href="./">Here</a></td></tr>
+<tr><td><a href="Datafiles/../../exp124/">Elsewhere</a></td></tr>
+<tr><td><a href="http://neutron.ornl.gov/user_data/hb3a/exp124/">Other experiment</a></td></tr>
+<tr><td><a href="//neutron.ornl.gov/user_data/">Other host</a></td></tr>
+<tr><td><a href="Datafiles/">Datafiles/</a></td><td>2019-05-01 10:12  </td></tr>
+<tr><td><a href="./HB3A:exp0123.dat">HB3A:exp0123.dat</a></td><td>2019-06-02 08:30  </td></tr>
+<tr><td><a href="HB3A_exp0123_scan0001.dat">HB3A_exp0123_scan0001.dat</a></td><td>2019-05-20 23:59  </td></tr>
+</table>
+</body></html>
+"""
+
+
+def main():
+    methods = ["regex", "bs4"] if etree is None else ["regex", "lxml", "bs4"]
+    cases = [("nginx", NGINX_INDEX, ["Datafiles/", "HB3A_exp0123_scan0001.dat"]),
+             ("Apache", APACHE_INDEX, ["Datafiles/", "HB3A:exp0123.dat", "HB3A_exp0123_scan0001.dat"])]
+    for name, page, expected in cases:
+        for method in methods:
+            links = SpigotIndexParser(method).get_links(page)
+            if links != expected:
+                raise RuntimeError(f"{method} found {links} in the {name} page, expected {expected}.")
+        print(f"{name}: {', '.join(methods)} keep only the entries of the directory.")
+        newest_mtime = SpigotIndexParser().get_newest_mtime(page)
+        if newest_mtime != calendar.timegm((2019, 6, 2, 8, 30, 0)):
+            raise RuntimeError(f"The newest date in the {name} page was read as {newest_mtime}.")
+    if SpigotIndexParser().get_newest_mtime(b"<html><title>Directory listing for /</title></html>") is not None:
+        raise RuntimeError("A page without dates has a newest date.")
+    print("The newest modification date of both pages was found.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Local stand-ins for the SPICE HTTP and SFTP servers, serving synthetic experiment trees.
+"""
+
+import email.utils
+import functools
+import http.server
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import paramiko
+
+
+def make_experiment_tree(root, instrument="HB-3A", ipts_number=1, experiment_number=123, file_count=1000,
+                         min_size=1024, max_size=1024 * 1024, depth=2, directories_per_level=3, seed=0):
+    """
+    Write a synthetic SPICE experiment under root, laid out the way both servers publish it:
+    root/HFIR/<INSTRUMENT>/IPTS-<ipts>/exp<n> for SFTP and root/user_data/<instrument>/exp<n> (a link to the same
+    directory) for HTTP. File sizes are log-uniform between min_size and max_size, so there are many small scan
+    files and a few large ones.
+    :return: Path of the experiment directory and total number of bytes written.
+    """
+    rng = random.Random(seed)
+    instrument_part = instrument.upper().replace("-", "")
+    experiment_path = os.path.join(root, "HFIR", instrument_part, f"IPTS-{ipts_number:04}", f"exp{experiment_number}")
+
+    directories = [experiment_path]
+    level = [experiment_path]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for index in range(directories_per_level):
+                next_level.append(os.path.join(parent, f"Dir{index}"))
+        directories.extend(next_level)
+        level = next_level
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    total_bytes = 0
+    block = os.urandom(max_size)
+    for index in range(file_count):
+        size = int(min_size * (float(max_size) / min_size) ** rng.random()) if max_size > min_size else min_size
+        name = f"{instrument_part}_exp{experiment_number:04}_scan{index:04}.dat"
+        with open(os.path.join(rng.choice(directories), name), 'wb') as f:
+            f.write(block[:size])
+        total_bytes += size
+
+    http_parent = os.path.join(root, "user_data", instrument_part.lower())
+    os.makedirs(http_parent, exist_ok=True)
+    http_path = os.path.join(http_parent, f"exp{experiment_number}")
+    if not os.path.exists(http_path):
+        os.symlink(experiment_path, http_path, target_is_directory=True)
+    return experiment_path, total_bytes
+
+
+class SpigotMockHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Autoindex handler with ETag, Last-Modified, conditional GET and Range support, and optional injected latency
+    and failures: a fraction failure_rate of requests gets a 503 or has its body cut off halfway. With ranges
+    False, Range headers are ignored and every file is sent whole, as some servers do. The paths of directory
+    listings served are appended to listings.
+    """
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    failure_rate = 0.0
+    ranges = True
+    listings = None
+    cut_body = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.cut_body = False
+        if self.failure_rate and random.random() < self.failure_rate:
+            if random.random() < 0.5:
+                self.send_error(503)
+                return None
+            self.cut_body = True
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.exists(path):
+            if os.path.isdir(path) and self.listings is not None:
+                self.listings.append(self.path)
+            return super().send_head()
+
+        stat = os.stat(path)
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag or \
+                (self.headers.get('If-None-Match') is None and self.headers.get('If-Modified-Since') == last_modified):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        start = 0
+        byte_range = self.headers.get('Range')
+        if self.ranges and byte_range and byte_range.startswith("bytes=") and \
+                self.headers.get('If-Range') in (None, etag, last_modified):
+            start = int(byte_range[6:].split("-")[0])
+            if start >= stat.st_size:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{stat.st_size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{stat.st_size - 1}/{stat.st_size}")
+        else:
+            self.send_response(200)
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(stat.st_size - start))
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes' if self.ranges else 'none')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        if not self.cut_body:
+            return super().copyfile(source, outputfile)
+        data = source.read()
+        outputfile.write(data[:len(data) // 2])
+        self.close_connection = True
+
+
+class SpigotMockHTTPServer(object):
+    """
+    SpigotMockHTTPServer serves a directory over HTTP on localhost from a background thread, and records the
+    directory listings it serves in listings.
+    """
+
+    def __init__(self, root, latency=0.0, failure_rate=0.0, ranges=True):
+        self.listings = []
+        handler_class = type("Handler", (SpigotMockHTTPRequestHandler,), {'latency': latency,
+                                                                          'failure_rate': failure_rate,
+                                                                          'ranges': ranges,
+                                                                          'listings': self.listings})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler_class,
+                                                                                           directory=root))
+        # Many parallel connects would otherwise overflow the default backlog of 5 and stall on SYN retries.
+        self.server.socket.listen(128)
+        self.url_root = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SpigotMockSSHServer(paramiko.ServerInterface):
+    """
+    Accepts any password and SFTP sessions.
+    """
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class SpigotMockSFTPHandle(paramiko.SFTPHandle):
+    # Reads from this offset on fail, like a link that drops halfway through the file.
+    fail_offset = None
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def read(self, offset, length):
+        if self.fail_offset is not None and offset + length > self.fail_offset:
+            return paramiko.SFTP_FAILURE
+        return super().read(offset, length)
+
+
+def make_sftp_interface(root, latency, failure_rate=0.0):
+    """
+    Build a read-only SFTP server interface class that serves root and sleeps latency seconds per listing and open.
+    A fraction failure_rate of listings fails, and as many opened files: half of them right away, the other half
+    halfway through.
+    :param root:
+    :param latency:
+    :param failure_rate:
+    :return:
+    """
+
+    class SpigotMockSFTPInterface(paramiko.SFTPServerInterface):
+        def _local_path(self, path):
+            return os.path.join(root, self.canonicalize(path).lstrip("/"))
+
+        def canonicalize(self, path):
+            return os.path.normpath("/" + path).replace("\\", "/").replace("//", "/")
+
+        def list_folder(self, path):
+            if latency:
+                time.sleep(latency)
+            if failure_rate and random.random() < failure_rate:
+                return paramiko.SFTP_FAILURE
+            local_path = self._local_path(path)
+            try:
+                attributes = []
+                for filename in os.listdir(local_path):
+                    attribute = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, filename)))
+                    attribute.filename = filename
+                    attributes.append(attribute)
+                return attributes
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        def stat(self, path):
+            try:
+                return paramiko.SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            if latency:
+                time.sleep(latency)
+            failing = failure_rate and random.random() < failure_rate
+            if failing and random.random() < 0.5:
+                return paramiko.SFTP_FAILURE
+            try:
+                f = open(self._local_path(path), 'rb')
+            except OSError as e:
+                return paramiko.SFTPServer.convert_errno(e.errno)
+            handle = SpigotMockSFTPHandle(flags)
+            if failing:
+                handle.fail_offset = os.fstat(f.fileno()).st_size // 2
+            handle.filename = self._local_path(path)
+            handle.readfile = f
+            return handle
+
+    return SpigotMockSFTPInterface
+
+
+class SpigotMockSFTPServer(object):
+    """
+    SpigotMockSFTPServer serves a directory over SFTP on localhost, one paramiko transport per connection.
+    """
+
+    def __init__(self, root, latency=0.0, failure_rate=0.0):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.interface = make_sftp_interface(root, latency, failure_rate)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(connection)
+            # Clients hanging up are routine here, so keep the server side quiet.
+            transport.set_log_channel("spigot.mock.sftp")
+            logging.getLogger("spigot.mock.sftp").setLevel(logging.CRITICAL)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, self.interface)
+            transport.start_server(server=SpigotMockSSHServer())
+            self.transports.append(transport)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
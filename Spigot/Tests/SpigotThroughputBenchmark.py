@@ -0,0 +1,189 @@
+"""
+End-to-end throughput benchmark for SpigotHTTP and SpigotSFTP against local mock SPICE servers.
+"""
+
+# Ugly hack to allow absolute import from the root folder.
+# noinspection PyUnboundLocalVariable
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    # noinspection PyShadowingBuiltins
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+    __package__ = "SpigotThroughputBenchmark"
+
+import argparse
+import asyncio
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from Downloaders.SpigotHTTP import SpigotHTTP
+from Downloaders.SpigotHTTPAsync import SpigotHTTPAsync
+from Downloaders.SpigotSFTP import SpigotSFTP
+from Downloaders.SpigotSFTPAsync import SpigotSFTPAsync
+from Tests.SpigotMockServers import make_experiment_tree, SpigotMockHTTPServer, SpigotMockSFTPServer
+
+
+def run_benchmark(name, download, total_files, total_bytes, trace_memory, exact_bytes=True):
+    """
+    Run one download with its progress output suppressed and report discovery time, files/s, MB/s and peak memory.
+    :param name:
+    :param download: Callable that runs the download and returns its statistics.
+    :param total_files:
+    :param total_bytes:
+    :param trace_memory: Whether to measure peak Python memory with tracemalloc (slows the run down).
+    :param exact_bytes: Whether exactly total_bytes must arrive. A server that ignores Range sends a retried file
+                        whole again, so then only at least total_bytes must.
+    :return:
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        statistics = download()
+    elapsed_time = time.perf_counter() - start_time
+    peak_memory = ""
+    if trace_memory:
+        peak_memory = f", peak memory {tracemalloc.get_traced_memory()[1] / (1024 * 1024):.1f} MB"
+        tracemalloc.stop()
+    if statistics['files'] != total_files or statistics['bytes'] < total_bytes or \
+            (exact_bytes and statistics['bytes'] != total_bytes):
+        raise RuntimeError(f"{name} downloaded {statistics['files']} files / {statistics['bytes']} bytes, "
+                           f"expected {total_files} / {total_bytes}.")
+    print(f"{name}: discovery {statistics['discovery_time']:.2f} s, total {elapsed_time:.2f} s, "
+          f"{total_files / elapsed_time:.1f} files/s, {total_bytes / (1024 * 1024) / elapsed_time:.2f} MB/s"
+          f"{peak_memory}")
+
+
+def grow_files(experiment_path, every, size):
+    """
+    Append random bytes to every every-th file of the experiment, as a running experiment does.
+    :param experiment_path:
+    :param every:
+    :param size: Bytes to append to each file.
+    :return: Number of files grown.
+    """
+    file_paths = sorted(os.path.join(directory, name) for directory, _, names in os.walk(experiment_path)
+                        for name in names)
+    for file_path in file_paths[::every]:
+        with open(file_path, 'ab') as f:
+            f.write(os.urandom(size))
+    return len(file_paths[::every])
+
+
+def run_update(name, download, experiment_path, local_path, http_server):
+    """
+    Run an incremental download after files grew and check the local copy against the server's files, and that the
+    listing cache spared listing every directory again.
+    :param name:
+    :param download: Callable that runs the download and returns its statistics.
+    :param experiment_path: Experiment directory the mock servers publish.
+    :param local_path: Local copy of the experiment directory.
+    :param http_server:
+    :return:
+    """
+    directory_count = sum(1 for _ in os.walk(experiment_path))
+    listing_count = len(http_server.listings)
+    start_time = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        statistics = download()
+    elapsed_time = time.perf_counter() - start_time
+    for directory, _, names in os.walk(experiment_path):
+        for file_name in names:
+            remote_path = os.path.join(directory, file_name)
+            copy_path = os.path.join(local_path, os.path.relpath(remote_path, experiment_path))
+            with open(remote_path, 'rb') as remote_file, open(copy_path, 'rb') as copy_file:
+                if remote_file.read() != copy_file.read():
+                    raise RuntimeError(f"{name} left {copy_path} different from the server's file.")
+    listing_count = len(http_server.listings) - listing_count
+    print(f"{name} update: {statistics['files'] - statistics['skipped_files']} files changed, "
+          f"{statistics['bytes'] / (1024 * 1024):.2f} MB transferred in {elapsed_time:.2f} s, "
+          f"{listing_count} of {directory_count} directories listed")
+    if listing_count >= directory_count:
+        raise RuntimeError(f"{name} listed every directory again instead of using its listing cache.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Spigot downloads against local mock SPICE servers.")
+    parser.add_argument("--files", type=int, default=2000, help="number of files in the experiment")
+    parser.add_argument("--min-size", type=int, default=1024, help="smallest file size in bytes")
+    parser.add_argument("--max-size", type=int, default=1024 * 1024, help="largest file size in bytes")
+    parser.add_argument("--depth", type=int, default=2, help="directory depth below the experiment")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of latency per request/listing/open")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="fraction of requests/listings/reads the servers fail")
+    parser.add_argument("--http-workers", type=int, default=64, help="SpigotHTTP max_workers")
+    parser.add_argument("--sftp-workers", type=int, default=4, help="SpigotSFTP max_workers and max_list_workers")
+    parser.add_argument("--async-concurrency", type=int, default=100,
+                        help="SpigotHTTPAsync and SpigotSFTPAsync max_concurrency")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc peak memory measurement")
+    parser.add_argument("--grow-every", type=int, default=10,
+                        help="afterwards, grow every N-th file and time an incremental HTTP update (0: skip)")
+    parser.add_argument("--no-ranges", action="store_true",
+                        help="serve HTTP without Range support, so grown files are fetched whole")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="spigot_mock_")
+    try:
+        server_root = os.path.join(root, "server")
+        experiment_path, total_bytes = make_experiment_tree(server_root, "HB-3A", 1, 123, args.files, args.min_size,
+                                              args.max_size, args.depth)
+        print(f"Synthetic experiment: {args.files} files, {total_bytes / (1024 * 1024):.1f} MB, depth {args.depth}, "
+              f"latency {args.latency * 1000:.0f} ms, failure rate {args.failure_rate * 100:.1f}%.")
+
+        http_server = SpigotMockHTTPServer(server_root, args.latency, args.failure_rate,
+                                           ranges=not args.no_ranges).start()
+        sftp_server = SpigotMockSFTPServer(server_root, args.latency, args.failure_rate).start()
+        try:
+            http_target = os.path.join(root, "http")
+            # The mock server's listings show no dates, so the HTTP engines opt into reusing every listing for ten
+            # minutes for the update run.
+            spigot_http = SpigotHTTP("HB-3A", 123, http_target, url_root=http_server.url_root,
+                                     max_workers=args.http_workers, listing_ttl=600)
+            run_benchmark("SpigotHTTP", spigot_http.download, args.files, total_bytes, not args.no_memory,
+                          not args.no_ranges)
+
+            sftp_target = os.path.join(root, "sftp")
+            spigot_sftp = SpigotSFTP("HB-3A", 1, 123, sftp_target, "spigot", host="127.0.0.1",
+                                     sftp_port=sftp_server.port, max_workers=args.sftp_workers,
+                                     max_list_workers=args.sftp_workers, listing_cache=None)
+            run_benchmark("SpigotSFTP", lambda: spigot_sftp.download(password="spigot"), args.files, total_bytes,
+                          not args.no_memory)
+
+            try:
+                spigot_http_async = SpigotHTTPAsync("HB-3A", 123, os.path.join(root, "http_async"),
+                                                    url_root=http_server.url_root,
+                                                    max_concurrency=args.async_concurrency, listing_ttl=600)
+                spigot_sftp_async = SpigotSFTPAsync("HB-3A", 1, 123, os.path.join(root, "sftp_async"), "spigot",
+                                                    host="127.0.0.1", sftp_port=sftp_server.port,
+                                                    max_concurrency=args.async_concurrency, listing_cache=None,
+                                                    known_hosts=None)
+            except ImportError as e:
+                print(f"Skipping the asyncio engines: {e}")
+                spigot_http_async = None
+            if spigot_http_async:
+                run_benchmark("SpigotHTTPAsync", lambda: asyncio.run(spigot_http_async.download()), args.files,
+                              total_bytes, not args.no_memory, not args.no_ranges)
+                run_benchmark("SpigotSFTPAsync",
+                              lambda: asyncio.run(spigot_sftp_async.download(password="spigot")), args.files,
+                              total_bytes, not args.no_memory)
+
+            if args.grow_every > 0:
+                grown_files = grow_files(experiment_path, args.grow_every, 4096)
+                print(f"Grew {grown_files} files by 4 KB.")
+                run_update("SpigotHTTP", lambda: spigot_http.download(incremental=True), experiment_path,
+                           os.path.join(http_target, "hb3a", "exp123"), http_server)
+                if spigot_http_async:
+                    run_update("SpigotHTTPAsync", lambda: asyncio.run(spigot_http_async.download(incremental=True)),
+                               experiment_path, os.path.join(root, "http_async", "hb3a", "exp123"), http_server)
+        finally:
+            http_server.stop()
+            sftp_server.stop()
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Test of SpigotHTTP.verify and SpigotHTTPAsync.verify against a local mock server: a local directory of the
+experiment is deleted, and verify must report its files and download them again.
+"""
+
+# Ugly hack to allow absolute import from the root folder.
+# noinspection PyUnboundLocalVariable
+if __name__ == "__main__" and __package__ is None:
+    from sys import path
+    # noinspection PyShadowingBuiltins
+    from os.path import dirname as dir
+    path.append(dir(path[0]))
+    __package__ = "SpigotVerifyTest"
+
+import asyncio
+import contextlib
+import os
+import shutil
+import tempfile
+from Downloaders.SpigotHTTP import SpigotHTTP
+from Downloaders.SpigotHTTPAsync import SpigotHTTPAsync
+from Tests.SpigotMockServers import make_experiment_tree, SpigotMockHTTPServer
+
+
+def read_tree(path):
+    """
+    Read every file under path.
+    :param path:
+    :return: Dictionary of path relative to path -> file contents.
+    """
+    files = {}
+    for directory, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                files[os.path.relpath(os.path.join(directory, name), path)] = f.read()
+    return files
+
+
+def check_verify(name, download, verify, experiment_path, local_path):
+    """
+    Download the experiment, delete one of its local directories and check that verify restores it.
+    :param name:
+    :param download: Callable that runs the download.
+    :param verify: Callable that runs verify and returns the bad files.
+    :param experiment_path: Served experiment directory.
+    :param local_path: Local copy of the experiment.
+    :return:
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        download()
+        deleted = [path for path in read_tree(local_path) if path.startswith("Dir1" + os.sep)]
+        shutil.rmtree(os.path.join(local_path, "Dir1"))
+        bad_files = verify()
+    if len(bad_files) != len(deleted):
+        raise RuntimeError(f"{name}: verify reported {len(bad_files)} bad files, expected {len(deleted)}.")
+    if read_tree(local_path) != read_tree(experiment_path):
+        raise RuntimeError(f"{name}: verify did not restore the deleted directory.")
+    print(f"{name}: {len(deleted)} files of a deleted directory downloaded again.")
+
+
+def main():
+    root = tempfile.mkdtemp(prefix="spigot_verify_")
+    try:
+        experiment_path, _ = make_experiment_tree(os.path.join(root, "server"), file_count=100,
+                                                  max_size=64 * 1024)
+        http_server = SpigotMockHTTPServer(os.path.join(root, "server")).start()
+        try:
+            http_target = os.path.join(root, "http")
+            spigot_http = SpigotHTTP("HB-3A", 123, http_target, url_root=http_server.url_root)
+            check_verify("SpigotHTTP", spigot_http.download, spigot_http.verify, experiment_path,
+                         os.path.join(http_target, "hb3a", "exp123"))
+
+            http_async_target = os.path.join(root, "http_async")
+            try:
+                spigot_http_async = SpigotHTTPAsync("HB-3A", 123, http_async_target, url_root=http_server.url_root)
+            except ImportError as e:
+                print(f"Skipping SpigotHTTPAsync: {e}")
+                return
+            check_verify("SpigotHTTPAsync", lambda: asyncio.run(spigot_http_async.download()),
+                         lambda: asyncio.run(spigot_http_async.verify()), experiment_path,
+                         os.path.join(http_async_target, "hb3a", "exp123"))
+        finally:
+            http_server.stop()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()